@@ -0,0 +1,173 @@
+# Incremental build of the clean database and the deprivation index
+# The pipeline is split into declared stages (acs, rent, evictions, crime,
+# merge, index). Each stage lists its raw files, upstream stages, code and
+# parameters; a manifest of content hashes skips every stage whose inputs
+# did not change since its output was written.
+
+import glob
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+CLEAN_DATA_DIR = os.path.join(os.path.dirname(__file__), "data_bases", "clean_data")
+INDEX_DIR = os.path.join(os.path.dirname(__file__), "index")
+MANIFEST = "manifest.json"
+
+
+class Stage:
+    '''
+    A step of the pipeline.
+
+    Inputs:
+        name   : stage name
+        files  : raw files and code it reads
+        deps   : names of the upstream stages (their outputs are inputs)
+        params : JSON serializable parameters
+        output : path of the file it writes
+        run    : function of the upstream output paths that writes output
+    '''
+    def __init__(self, name, files, deps, params, output, run):
+        self.name = name
+        self.files = files
+        self.deps = deps
+        self.params = params
+        self.output = output
+        self.run = run
+
+
+def file_digest(path, known):
+    '''
+    SHA-256 of a file. Digests are reused from the manifest (known) while the
+    size and modification time of the file are unchanged.
+    '''
+    stat = os.stat(path)
+    entry = known.get(path)
+    if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(1 << 20), b""):
+            digest.update(block)
+    known[path] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+    return known[path][2]
+
+
+def write_frame(df, path):
+    df.to_parquet(path, index=False)
+
+
+def make_stages(data_path, clean_path, output_path, build_dir, years=None,
+                geocode=False, index_options=None):
+    '''
+    Declares the stages of the pipeline, in topological order.
+
+    Inputs:
+        data_path     : folder with the raw data
+        clean_path    : clean database written by the merge stage (csv)
+        output_path   : processed data written by the index stage (csv)
+        build_dir     : folder for the intermediate outputs
+        years, geocode: as in clean_db
+        index_options : dictionary overriding k, thresholds, travel_data,
+                        weighted and n_rep of the index stage (defaults from
+                        index.py)
+
+    Returns: list of Stage
+    '''
+    from deprivation_evictions.data_bases.clean_data import cleaning_data as cd
+    from deprivation_evictions.data_bases.clean_data.raw_cache import source_files
+    from deprivation_evictions.index import index
+
+    panel = years is not None
+    years = sorted(years) if panel else [cd.FILTER_YEAR]
+    options = {"k": index.k, "thresholds": index.thresholds,
+               "travel_data": index.transport_data, "weighted": True,
+               "n_rep": index.n_replicates}
+    options.update(index_options or {})
+    clean_code = sorted(glob.glob(os.path.join(CLEAN_DATA_DIR, "*.py")))
+    index_code = sorted(glob.glob(os.path.join(INDEX_DIR, "*.py")))
+    tracts = data_path + "bound_census_tracts.geojson"
+    zips = data_path + "bound_zip_codes.geojson"
+
+    def intermediate(name):
+        return os.path.join(build_dir, name + ".parquet")
+
+    def run_merge(acs, rent, evictions, crime):
+        merged_db = cd.merge_sources(*[pd.read_parquet(p) for p in (acs, rent, evictions, crime)],
+                                     panel)
+        merged_db.to_csv(clean_path, index=False)
+
+    def run_index(clean):
+        mdpi = index.MultiDimensionalDeprivation(options["k"], clean, options["thresholds"],
+                                                 travel_data=options["travel_data"])
+        mdpi.extend_data(output_path, weighted=options["weighted"], n_rep=options["n_rep"])
+
+    return [
+        Stage("acs", source_files("acs", data_path) + clean_code, [],
+              {"years": years}, intermediate("acs"),
+              lambda: write_frame(cd.clean_acs(data_path, years), intermediate("acs"))),
+        Stage("rent", [data_path + "zillow_data.csv"] + clean_code, [],
+              {"years": years}, intermediate("rent"),
+              lambda: write_frame(cd.clean_rent(data_path, years), intermediate("rent"))),
+        Stage("evictions", [data_path + "eviction_data.csv", tracts, zips] + clean_code, [],
+              {"years": years}, intermediate("evictions"),
+              lambda: write_frame(cd.clean_evictions(data_path, years),
+                                  intermediate("evictions"))),
+        Stage("crime", source_files("crime", data_path)
+              + [zips, os.path.join(CLEAN_DATA_DIR, "crime_taxonomy.json")] + clean_code, [],
+              {"years": years, "geocode": geocode}, intermediate("crime"),
+              lambda: write_frame(cd.clean_crime(data_path, years, geocode),
+                                  intermediate("crime"))),
+        Stage("merge", clean_code, ["acs", "rent", "evictions", "crime"],
+              {"panel": panel}, clean_path, run_merge),
+        Stage("index", [options["travel_data"]] + index_code, ["merge"],
+              {key: options[key] for key in ("k", "thresholds", "weighted", "n_rep")},
+              output_path, run_index),
+    ]
+
+
+def build(stages, build_dir, force=False):
+    '''
+    Runs the stages whose inputs changed (or whose output is missing or was
+    modified) and skips the others. The manifest in build_dir records, for
+    each stage, the hash of its inputs and of its output; it is saved after
+    every stage so an interrupted build keeps its progress.
+
+    Returns: list of (stage name, 'ran' or 'skipped')
+    '''
+    os.makedirs(build_dir, exist_ok=True)
+    manifest_path = os.path.join(build_dir, MANIFEST)
+    manifest = {"files": {}, "stages": {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, "r") as fp:
+            manifest = json.load(fp)
+    known = manifest["files"]
+
+    by_name = {stage.name: stage for stage in stages}
+    outputs, status = {}, []
+    for stage in stages:
+        key = hashlib.sha256(json.dumps(
+            [stage.params,
+             [[os.path.basename(f), file_digest(f, known)] for f in stage.files],
+             [[dep, outputs[dep]] for dep in stage.deps]],
+            sort_keys=True).encode()).hexdigest()
+
+        record = manifest["stages"].get(stage.name)
+        fresh = (not force and record is not None and record["key"] == key
+                 and os.path.exists(stage.output)
+                 and file_digest(stage.output, known) == record["output"])
+        if fresh:
+            status.append((stage.name, "skipped"))
+        else:
+            stage.run(*[by_name[dep].output for dep in stage.deps])
+            record = {"key": key, "output": file_digest(stage.output, known)}
+            manifest["stages"][stage.name] = record
+            with open(manifest_path, "w") as fp:
+                json.dump(manifest, fp, indent=1)
+            status.append((stage.name, "ran"))
+        outputs[stage.name] = record["output"]
+
+    with open(manifest_path, "w") as fp:
+        json.dump(manifest, fp, indent=1)
+    return status
@@ -0,0 +1,239 @@
+# Command-line entry point for the data pipeline
+# Usage: python -m deprivation_evictions.cli {clean,index,sweep,build,travel} [options]
+#
+# Only argparse is imported here; every subcommand imports the modules it
+# needs when it runs.
+
+import argparse
+import sys
+
+
+def parse_assignment(text):
+    '''
+    Parses a NAME=VALUE option.
+
+    Returns: (name, value) tuple of strings
+    '''
+    name, sep, value = text.partition('=')
+    if not sep or not name or not value:
+        raise argparse.ArgumentTypeError(f"expected NAME=VALUE, got '{text}'")
+    return name, value
+
+
+def parse_grid_values(text):
+    '''
+    Parses the candidate cutoffs of a sweep: either START:STOP:NUM (NUM
+    evenly spaced values) or a comma separated list of values.
+
+    Returns: list of floats
+    '''
+    if ':' in text:
+        start, stop, num = text.split(':')
+        step = (float(stop) - float(start)) / max(int(num) - 1, 1)
+        return [float(start) + i * step for i in range(int(num))]
+    return [float(value) for value in text.split(',')]
+
+
+def parse_years(values):
+    '''
+    Expands a list of years where each item is a year or a START-END range.
+
+    Returns: sorted list of ints
+    '''
+    years = set()
+    for value in values:
+        start, _, end = value.partition('-')
+        years.update(range(int(start), int(end or start) + 1))
+    return sorted(years)
+
+
+def run_clean(args):
+    from deprivation_evictions.data_bases.clean_data import cleaning_data
+
+    cleaning_data.clean_db(pull_API_data_bool=args.pull_api,
+                           geocode=args.geocode,
+                           data_path=args.data_path,
+                           output_path=args.output,
+                           years=parse_years(args.years) if args.years else None,
+                           n_jobs=args.jobs)
+
+
+def parse_thresholds(args, index):
+    thresholds = dict(index.thresholds)
+    for name, value in args.threshold:
+        if name not in thresholds:
+            raise SystemExit(f"unknown indicator '{name}', expected one of "
+                             f"{list(thresholds)}")
+        thresholds[name] = float(value)
+    return thresholds
+
+
+def build_index(args, index):
+    return index.MultiDimensionalDeprivation(args.k, args.clean_data,
+                                             parse_thresholds(args, index),
+                                             travel_data=args.travel_data)
+
+
+def run_index(args):
+    from deprivation_evictions.index import index
+
+    mdpi = build_index(args, index)
+    mdpi.extend_data(args.output, weighted=not args.no_weights,
+                     n_rep=args.replicates)
+
+
+def run_sweep(args):
+    from deprivation_evictions.index import index
+
+    mdpi = build_index(args, index)
+    grid = {name: parse_grid_values(values) for name, values in args.grid}
+    results, ranks = mdpi.sweep(grid, ks=args.ks, n_jobs=args.jobs)
+    results.to_csv(args.output, index_label='config')
+    if args.ranks_output:
+        ranks.to_csv(args.ranks_output, index_label='config')
+
+
+def run_build(args):
+    from deprivation_evictions import build
+    from deprivation_evictions.index import index
+
+    thresholds = parse_thresholds(args, index)
+    build_dir = args.build_dir or args.data_path + "cache/build/"
+    stages = build.make_stages(args.data_path, args.clean_data, args.output, build_dir,
+                               years=parse_years(args.years) if args.years else None,
+                               geocode=args.geocode,
+                               index_options={'k': args.k, 'thresholds': thresholds,
+                                              'travel_data': args.travel_data,
+                                              'weighted': not args.no_weights,
+                                              'n_rep': args.replicates})
+    for name, status in build.build(stages, build_dir, force=args.force):
+        print(f"{name:10s} {status}")
+
+
+def run_travel(args):
+    from deprivation_evictions.data_bases.raw_data import google_dist
+
+    google_dist.update_travel_data(args.destination, args.origins, api_url=args.api_url,
+                                   output_path=args.output, graph_path=args.graph,
+                                   sampling=args.sampling, seed=args.seed,
+                                   summary_path=args.summary)
+
+
+def add_index_options(parser, index_defaults):
+    parser.add_argument('--clean-data', default=index_defaults['cleaned_data'],
+                        help='clean database (csv)')
+    parser.add_argument('--travel-data', default=index_defaults['transport_data'],
+                        help='travel times of the origin points (csv)')
+    parser.add_argument('-k', type=int, default=index_defaults['k'],
+                        help='fixed cutoff of the AF method')
+    parser.add_argument('--threshold', type=parse_assignment, action='append',
+                        default=[], metavar='NAME=VALUE',
+                        help='override the cutoff of one indicator')
+
+
+def make_parser():
+    # Defaults are duplicated here so that --help does not import the index
+    index_defaults = {
+        'cleaned_data': "deprivation_evictions/data_bases/clean_data/clean_database.csv",
+        'transport_data': "deprivation_evictions/data_bases/raw_data/google_distancematrix.csv",
+        'output_path': "deprivation_evictions/data_bases/final_data/processed_data.csv",
+        'k': 0,
+    }
+
+    parser = argparse.ArgumentParser(prog='python -m deprivation_evictions.cli',
+                                     description='Evictions and deprivation data pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    clean = subparsers.add_parser('clean', help='build the clean database')
+    clean.add_argument('--data-path', default="deprivation_evictions/data_bases/raw_data/",
+                       help='folder with the raw data (with a trailing /)')
+    clean.add_argument('--output', default=index_defaults['cleaned_data'],
+                       help='clean database (csv)')
+    clean.add_argument('--pull-api', action='store_true',
+                       help='pull fresh data from the APIs first (needs API keys)')
+    clean.add_argument('--geocode', action='store_true',
+                       help='reverse-geocode crimes online instead of the offline '
+                            'point-in-polygon assignment')
+    clean.add_argument('--years', nargs='+', metavar='YEAR|START-END',
+                       help='panel mode: clean these years into a (zip_code, year) table')
+    clean.add_argument('--jobs', type=int, default=1,
+                       help='worker processes for the source steps (1: serial)')
+    clean.set_defaults(func=run_clean)
+
+    index = subparsers.add_parser('index', help='compute the deprivation index')
+    add_index_options(index, index_defaults)
+    index.add_argument('--output', default=index_defaults['output_path'],
+                       help='processed data (csv)')
+    index.add_argument('--no-weights', action='store_true',
+                       help='skip the PCA/factor weighted index (wdi)')
+    index.add_argument('--replicates', type=int, default=2000,
+                       help='bootstrap replicates for the intervals (0 to skip)')
+    index.set_defaults(func=run_index)
+
+    sweep = subparsers.add_parser('sweep', help='threshold and k sensitivity sweep')
+    add_index_options(sweep, index_defaults)
+    sweep.add_argument('--grid', type=parse_assignment, action='append',
+                       default=[], metavar='NAME=START:STOP:NUM|V1,V2,...',
+                       help='candidate cutoffs of one indicator')
+    sweep.add_argument('--ks', type=int, nargs='+',
+                       help='fixed cutoffs to evaluate (default: all)')
+    sweep.add_argument('--jobs', type=int, help='worker processes')
+    sweep.add_argument('--output', required=True,
+                       help='results by configuration (csv)')
+    sweep.add_argument('--ranks-output', help='zipcode ranks by configuration (csv)')
+    sweep.set_defaults(func=run_sweep)
+
+    build = subparsers.add_parser('build', help='incremental build: clean database '
+                                  'and index, skipping the stages whose inputs did not change')
+    add_index_options(build, index_defaults)
+    build.add_argument('--data-path', default="deprivation_evictions/data_bases/raw_data/",
+                       help='folder with the raw data (with a trailing /)')
+    build.add_argument('--years', nargs='+', metavar='YEAR|START-END',
+                       help='panel mode: clean these years into a (zip_code, year) table')
+    build.add_argument('--geocode', action='store_true',
+                       help='reverse-geocode crimes online instead of the offline '
+                            'point-in-polygon assignment')
+    build.add_argument('--output', default=index_defaults['output_path'],
+                       help='processed data (csv)')
+    build.add_argument('--no-weights', action='store_true',
+                       help='skip the PCA/factor weighted index (wdi)')
+    build.add_argument('--replicates', type=int, default=2000,
+                       help='bootstrap replicates for the intervals (0 to skip)')
+    build.add_argument('--build-dir', help='intermediate outputs and manifest '
+                       '(default: DATA_PATH/cache/build/)')
+    build.add_argument('--force', action='store_true', help='rerun every stage')
+    build.set_defaults(func=run_build)
+
+    travel = subparsers.add_parser('travel', help='travel time and distance from random '
+                                   'origins in every zipcode to the CBD')
+    travel.add_argument('--graph', help='route offline on this GraphML street graph '
+                        '(e.g. deprivation_evictions/data_bases/raw_data/test_graph.graphml) '
+                        'instead of the Google Distance Matrix API')
+    travel.add_argument('--origins', type=int, default=13,
+                        help='random origin points per zipcode')
+    travel.add_argument('--sampling', choices=['uniform', 'population'], default='uniform',
+                        help='uniform random origins, or origins spread by tract population '
+                             'with quasi-random points (needs raw_data/tract_population.csv, '
+                             'see pull_acs_data.pull_tract_population)')
+    travel.add_argument('--seed', type=int, default=20220224,
+                        help='seed of the origin points')
+    travel.add_argument('--summary', help='mean and standard error of the travel data '
+                        'of every zipcode (csv)')
+    travel.add_argument('--destination', default="41.875556,-87.6244014",
+                        help='destination as LAT,LNG (default: the Loop)')
+    travel.add_argument('--api-url', default="https://maps.googleapis.com/maps/api/distancematrix/json",
+                        help='Distance Matrix endpoint (needs GOOGLE_TOKEN)')
+    travel.add_argument('--output', default=index_defaults['transport_data'],
+                        help='travel data of the origin points (csv)')
+    travel.set_defaults(func=run_travel)
+
+    return parser
+
+
+def main(argv=None):
+    args = make_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,236 +1,281 @@
 # Code written by Santiago Segovia
 # Lines 76-85 written by Gregory Ho
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import pandas as pd
 import geopandas as gpd
-import numpy as np
-import geopy
-import json
 
-# Import the code to pull the data from the APIs
-from deprivation_evictions.data_bases.raw_data.pull_crime_data import pull_crime_data
-from deprivation_evictions.data_bases.raw_data.pull_acs_data import pull_acs_data
-from deprivation_evictions.data_bases.raw_data.google_dist import update_travel_data
+from deprivation_evictions.data_bases.clean_data.crime_counts import stream_crime_counts
+from deprivation_evictions.data_bases.clean_data.crosswalk import allocate, load_crosswalk
+from deprivation_evictions.data_bases.clean_data.raw_cache import read_raw, zillow_mean_rent
+from deprivation_evictions.data_bases.clean_data.zip_grid import load_grid
+
+# The API clients (and geopy) are imported only when fresh data is pulled
 
 DATA_PATH = "deprivation_evictions/data_bases/raw_data/"
+CLEAN_PATH = "deprivation_evictions/data_bases/clean_data/clean_database.csv"
 FILTER_YEAR = 2019
-
-def clean_db(pull_API_data_bool = True, lat_lon_dict = True):
+GEOCODE_DOMAIN = "nominatim.openstreetmap.org"
+
+# Chicago zip codes (removed 60666, O'Hare)
+ZIP_CODES = ['60601', '60602', '60603', '60604',
+             '60605', '60606', '60607', '60608',
+             '60609', '60610', '60611', '60612',
+             '60613', '60614', '60615', '60616',
+             '60617', '60618', '60619', '60620',
+             '60621', '60622', '60623', '60624',
+             '60625', '60626', '60628', '60629',
+             '60630', '60631', '60632', '60633',
+             '60634', '60636', '60637', '60638',
+             '60639', '60640', '60641', '60642',
+             '60643', '60644', '60645', '60646',
+             '60647', '60649', '60651', '60652',
+             '60653', '60654', '60655', '60656',
+             '60657', '60659', '60660', '60661',
+             '60707', '60827']
+# Every source is grouped by (zip_code, year)
+KEYS = ["zip_code", "year"]
+
+def clean_db(pull_API_data_bool = False, geocode = False,
+             data_path = DATA_PATH, output_path = CLEAN_PATH, years = None,
+             n_jobs = 1):
     """
     Creates a clean database with all the relevant variables from the different
-    data sources employed.
+    data sources employed. Each source is cleaned by its own function
+    (clean_acs, clean_rent, clean_evictions, clean_crime) and the results are
+    combined by merge_sources; build.py runs the same steps as separate
+    cached stages.
 
     Input:
         pull_API_data_bool (boolean): False (default) if we don't want to pull 
         fresh data from the APIs. True if we do. This step takes about 10 minutes
 
-        lat_lon_dict (boolean): True (default) if there is already a dictionary 
-            containing a mapping for zipcodes and lat-lon coordinates.
-            False to generate that dictionary using helper function.
+        geocode (boolean): False (default) to assign crimes to zipcodes offline,
+            with a point-in-polygon test against bound_zip_codes.geojson. True
+            to reverse-geocode the coordinates instead (see mapping_coord_zip)
+
+        data_path (str): folder with the raw data files
+
+        output_path (str): path of the clean database
+
+        years (list of int): None (default) to clean FILTER_YEAR only. Otherwise
+            panel mode: every raw file is read once, grouped by year, and the
+            output is a long table keyed by (zip_code, year)
+
+        n_jobs (int): worker processes for the source steps (1, default:
+            serial; None: one per source). The output does not depend on it
 
     Output:
-        - A .csv file that is stored in the current folder
-    """
-
-    # Defining initial arguments:
-    zip = {'zip_code': ['60601', '60602', '60603', '60604',
-                        '60605', '60606', '60607', '60608',
-                        '60609', '60610', '60611', '60612',
-                        '60613', '60614', '60615', '60616',
-                        '60617', '60618', '60619', '60620',
-                        '60621', '60622', '60623', '60624',
-                        '60625', '60626', '60628', '60629',
-                        '60630', '60631', '60632', '60633',
-                        '60634', '60636', '60637', '60638',
-                        '60639', '60640', '60641', '60642',
-                        '60643', '60644', '60645', '60646',
-                        '60647', '60649', '60651', '60652',
-                        '60653', '60654', '60655', '60656',
-                        '60657', '60659', '60660', '60661',
-                        '60707', '60827']} #Removed 60666 (O'Hare)
-    zipcodes = pd.DataFrame(data = zip)
+        - A .csv file that is stored in output_path
+    """
+    panel = years is not None
+    years = list(years) if panel else [FILTER_YEAR]
 
     # Optionally pull fresh data from the APIs
     if pull_API_data_bool:
-        pull_API_data()
-
-    # ACS DATA:
-    # Filter by zipcodes from Chicago:
-    acs_data = pd.read_csv(DATA_PATH + "acs_data.csv")
-    acs_data = acs_data.drop(columns=["Unnamed: 0"])
-    acs_data['zip_code'] = acs_data['zip_code'].astype("string")
-    acs_data = acs_data[acs_data["zip_code"].isin(zipcodes["zip_code"])]
-
-    # ZILLOW DATA:
-    # Filter by year (2019) and zip codes of Chicago:
-    rent_data = pd.read_csv(DATA_PATH + "zillow_data.csv")
-    rent_data = rent_data[rent_data["State"]=="IL"]
-    date_cols = rent_data.filter(like='20', axis=1)
-    rent_data = rent_data.melt(id_vars=["RegionName","State"],value_vars=date_cols,
-                var_name="Date",value_name="RentPrice")
-    rent_data['RegionName'] = rent_data['RegionName'].astype("string")
-    rent_data = rent_data.rename(columns={"RegionName":"zip_code"})
-    rent_data["Date"] = pd.to_datetime(rent_data["Date"], format = "%Y-%m-%d")
-    rent_data = rent_data[rent_data["Date"].dt.year == FILTER_YEAR]
-
-    # Calculate the mean rent in a zipcode:
-    rent_data = rent_data[rent_data["zip_code"].isin(zipcodes["zip_code"])]
-    mean_rent = rent_data.groupby("zip_code")["RentPrice"].mean().reset_index()
-
-    # EVICTIONS DATA:
+        pull_API_data(years)
+
+    merged_db = merge_sources(*clean_sources(data_path, years, geocode, n_jobs),
+                              panel)
+
+    #Exporting the database:
+    merged_db.to_csv(output_path,index=False)
+
+def clean_sources(data_path, years, geocode = False, n_jobs = 1):
+    """
+    Runs the source steps (ACS, rent, evictions, crime), which share no data
+    until they are merged. With n_jobs > 1 they run concurrently in a process
+    pool (each one writes only its own caches), so the wall time is close to
+    that of the slowest step.
+
+    Output: list with the outputs of clean_acs, clean_rent, clean_evictions
+        and clean_crime
+    """
+    steps = [(clean_acs, (data_path, years)),
+             (clean_rent, (data_path, years)),
+             (clean_evictions, (data_path, years)),
+             (clean_crime, (data_path, years, geocode))]
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, len(steps))
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(func, *args) for func, args in steps]
+            return [future.result() for future in futures]
+    return [func(*args) for func, args in steps]
+
+def clean_acs(data_path, years):
+    """
+    ACS data of the Chicago zip codes (the raw files are read from their typed
+    Parquet cache, see raw_cache.py). A single ACS vintage is used for every
+    year unless the file has a year column.
+
+    Output: DataFrame keyed by (zip_code, year)
+    """
+    acs_data = read_raw("acs", data_path)
+    acs_data = acs_data[acs_data["zip_code"].isin(ZIP_CODES)]
+    if "year" in acs_data.columns:
+        acs_data = acs_data[acs_data["year"].isin(years)]
+    else:
+        acs_data = acs_data.merge(pd.DataFrame({"year": years}), how="cross")
+    return acs_data
+
+def clean_rent(data_path, years):
+    """
+    Mean rent in a zipcode (by year), reading only the months of the
+    requested years and the rows of the zip codes of Chicago.
+
+    Output: DataFrame with zip_code, year and RentPrice
+    """
+    return zillow_mean_rent(data_path, ZIP_CODES, years)
+
+def clean_evictions(data_path, years):
+    """
+    Eviction counts by zipcode. The counts of each tract are apportioned among
+    the zipcodes it overlaps, by share of area (see crosswalk.py), so a tract
+    on a border is not counted in full in every zipcode it touches. The median
+    back rent is averaged with the same weights.
+
+    Output: DataFrame keyed by (zip_code, year)
+    """
     # Filter by year and select specific columns:
-    evic_data = pd.read_csv(DATA_PATH + "eviction_data.csv")
-    evic_data = evic_data[evic_data["filing_year"] == FILTER_YEAR]
     cols_to_keep = ["filing_year","tract","eviction_filings_completed","back_rent_0",
                     "back_rent_1_to_999","back_rent_1000_to_2499","back_rent_2500_to_4999",
                     "back_rent_5000_or_more","back_rent_median","eviction_order_yes"]
-    evic_data = evic_data[cols_to_keep]
-
-    # Load censustract and zipcode boundary to find zipcodes:
-    zipcodes_gdf = gpd.read_file(DATA_PATH + 'bound_zip_codes.geojson')
-    census_tracts_gdf = gpd.read_file(DATA_PATH + 'bound_census_tracts.geojson')
-    merged_gdf = gpd.sjoin(census_tracts_gdf, zipcodes_gdf, how='inner', predicate='intersects')
-    merged_gdf = merged_gdf.rename(columns={"zip":"zip_code"})
+    evic_data = read_raw("evictions", data_path, columns = cols_to_keep)
+    evic_data = evic_data[evic_data["filing_year"].isin(years)]
 
-    # Convert the 'Geoid10' column to str to ensure join match:
-    census_tracts_gdf['Geoid10'] = census_tracts_gdf['geoid10'].astype(str)
+    # Convert the tract to str to match the 'geoid10' of the crosswalk:
     evic_data['tract'] = evic_data['tract'].astype(str)
-    evic_data = evic_data.rename(columns={'tract': 'geoid10'})
+    evic_data = evic_data.rename(columns={'tract': 'geoid10', 'filing_year': 'year'})
 
-    evic_data = pd.merge(evic_data,census_tracts_gdf["geoid10"],how="inner")
-    evic_data = pd.merge(evic_data,merged_gdf[["geoid10","zip_code"]],how="inner")
-    evic_data = evic_data[evic_data["zip_code"].isin(zipcodes["zip_code"])]
-
-    # Aggregate data by zipcode:
+    crosswalk = load_crosswalk(data_path)
     back_rent_cols = list(filter(lambda x:'back_rent_' in x, list(evic_data.columns)))
     cols_aggregate = ["eviction_filings_completed"] + back_rent_cols[0:len(back_rent_cols)-1]
-    num_evics = evic_data.groupby("zip_code")[cols_aggregate].sum().reset_index()
-    mean_back_rent = evic_data.groupby("zip_code")["back_rent_median"].mean().reset_index()
-    num_evics = pd.merge(num_evics,mean_back_rent)
-
-    # CRIME DATA:
-    # Define types of crimes that are going to be aggregated by zip code:
-    crime_data = pd.read_csv(DATA_PATH + "crime_data.csv")
-    violent_crime = ["ASSAULT","BATTERY","ROBBERY","CRIM SEXUAL ASSAULT",
-                    "CRIMINAL SEXUAL ASSAULT","SEX OFFENSE","INTIMIDATION","HOMICIDE",
-                    "KIDNAPPING","HUMAN TRAFFICKING","THEFT","ARSON","PROSTITUTION",
-                    "OFFENSE INVOLVING CHILDREN"]
-    non_offensive = ["OTHER OFFENSE","NARCOTICS","WEAPONS VIOLATION","MOTOR VEHICLE THEFT",
-                    "LIQUOR LAW VIOLATION","GAMBLING","DECEPTIVE PRACTICE","CRIMINAL DAMAGE",
-                    "CRIMINAL TRESPASS","BURGLARY","INTERFERENCE WITH PUBLIC OFFICER",
-                    "PUBLIC PEACE VIOLATION","CONCEALED CARRY LICENSE VIOLATION",
-                    "STALKING","OBSCENITY","NON-CRIMINAL","OTHER NARCOTIC VIOLATION",
-                    "PUBLIC INDECENCY"]
-    cols_to_keep = ['id', 'date', 'primary_type','latitude','longitude']
-    crime_data = crime_data[cols_to_keep]
-    crime_data = crime_data[crime_data["latitude"].isna() == False] #2042 registers without coordinates
-
-    crime_data["crime"] = 1
-    crime_data["violent_crime"] = np.where(crime_data["primary_type"].isin(violent_crime),1,0)
-    crime_data["non_offensive_crime"] = np.where(crime_data["primary_type"].isin(non_offensive),1,0)
+    evic_data["has_median"] = evic_data["back_rent_median"].notna().astype(float)
+    evic_data["back_rent_median"] = evic_data["back_rent_median"].fillna(0)
+    num_evics = allocate(evic_data, crosswalk, cols_aggregate + ["back_rent_median", "has_median"],
+                         by = ["year"])
+    num_evics["back_rent_median"] = num_evics["back_rent_median"] / num_evics["has_median"]
+    num_evics = num_evics.drop(columns=["has_median"])
+    return num_evics[num_evics["zip_code"].isin(ZIP_CODES)]
+
+def clean_crime(data_path, years, geocode = False, monthly = False,
+                taxonomy = None):
+    """
+    Number of crimes by zipcode: all of them ('crime') and one column per
+    category of the crime taxonomy (violent_crime and non_offensive_crime, see
+    crime_taxonomy.json). The crime records are streamed in batches (see
+    crime_counts.py), so memory does not grow with the number of incidents.
 
+    Input:
+        geocode (boolean): reverse-geocode the coordinates instead of the
+            offline point-in-polygon assignment
+        monthly (boolean): True to count by (zip_code, year, month)
+        taxonomy (dict): {category: [primary types]} replacing the config
+
+    Output: DataFrame keyed by (zip_code, year)
+    """
     #Map coordinates to zip code:
-    if lat_lon_dict:
-        with open(DATA_PATH + "lat_lon_dict.txt", "r") as fp:
-            lat_lon_dict = json.load(fp)
+    if geocode:
+        locate = lambda coords: mapping_coord_zip(coords, data_path)
     else:
-        mapping_coord_zip(crime_data)
-    
-    crime_data["key"] = crime_data["latitude"].astype(str) + "/" + crime_data["longitude"].astype(str)
-    crime_data["zip_code"] = crime_data["key"].map(lat_lon_dict)
-    crime_data = crime_data[crime_data["zip_code"].isin(zipcodes["zip_code"])]
-    crime_data = crime_data[~crime_data["zip_code"].isnull()]
-
-    #Aggregation by zip code:
-    cols_aggregate = ["crime","violent_crime","non_offensive_crime"]
-    num_crimes = crime_data.groupby("zip_code")[cols_aggregate].sum().reset_index()
-
-    #MERGING DATA:
-    merged_db = pd.merge(acs_data,mean_rent,on="zip_code",how="outer")
-    merged_db = pd.merge(merged_db,num_evics,on="zip_code",how="outer")
-    merged_db = pd.merge(merged_db,num_crimes,on="zip_code",how="outer")
-
-    #Some zipcodes don't have rent data, so the median rent price is assigned to them:
-    median_price = mean_rent["RentPrice"].median()
+        zipcodes_gdf = gpd.read_file(data_path + 'bound_zip_codes.geojson')
+        grid = load_grid(zipcodes_gdf, data_path + "zip_grid.npz")
+        locate = lambda coords: grid.lookup(coords["latitude"], coords["longitude"])
+
+    #Aggregation by zip code (and year):
+    return stream_crime_counts(data_path, ZIP_CODES, years, locate, taxonomy, monthly)
+
+def merge_sources(acs_data, mean_rent, num_evics, num_crimes, panel = False):
+    """
+    Merges the clean sources into the clean database, fills missing values and
+    scales counts by population. The year column is dropped unless we are
+    building a panel.
+
+    Output: DataFrame with one row per zip code (and year)
+    """
+    merged_db = pd.merge(acs_data,mean_rent,on=KEYS,how="outer")
+    merged_db = pd.merge(merged_db,num_evics,on=KEYS,how="outer")
+    merged_db = pd.merge(merged_db,num_crimes,on=KEYS,how="outer")
+    #A zipcode without recorded crimes in a year has zero crimes:
+    crime_cols = [c for c in num_crimes.columns if c not in KEYS]
+    merged_db[crime_cols] = merged_db[crime_cols].fillna(0)
+
+    #Some zipcodes don't have rent data, so the median rent price (of the
+    #year) is assigned to them:
+    median_price = merged_db["year"].map(mean_rent.groupby("year")["RentPrice"].median())
     merged_db["RentPrice"] = merged_db["RentPrice"].fillna(median_price)
 
     #Scale some variables by population:
-    cols_scale = ["eviction_filings_completed","crime","violent_crime",
-                  "non_offensive_crime"]
+    cols_scale = ["eviction_filings_completed"] + crime_cols
     for c in cols_scale:
         new_name = c + "_scaled"
         merged_db[new_name] = merged_db[c].div(merged_db["total_population"])
-    
-    #Exporting the database:
-    merged_db.to_csv("deprivation_evictions/data_bases/clean_data/clean_database.csv",index=False)
-
-def mapping_coord_zip(df):
-    """
-    Helper function that based on some coordinates retrieve the associated zip codes.
-    The task is split in part because there are a finite amount of calls allowed
-    using the get_zipcode function.
-
-    Input (DataFrame): Must contain the columns with the latitude and longitude
-        thata are going to be used as inputs to calculate the zip code.
-    
-    Output: A .txt file that contains the information of a dictionary where its
-        keys are latitude/longitude pairs and its values are zipcodes
-    """
-    #Initial arguments:
-    num_rows = 5000
-    num_splits = round(df.shape[0]/num_rows)
-
-    #Function to get the zip codes (adapted from the following urls):
-    #https://gis.stackexchange.com/questions/352961/converting-lat-lon-to-postal-code-using-python)
-    #https://stackoverflow.com/questions/66227003/reverse-geocoding-getting-postal-code-with-geopy-nominatim
-
-    def get_zipcode(geolocator, lat, lon):
-        try:
-            location = geolocator.reverse((lat, lon))
-            return location.raw['address']['postcode']
-        except KeyError:
-            pass
-
-    geolocator = geopy.Nominatim(user_agent='ssegovba@uchicago.edu')
-
-    #Retrieving the indexes:  
-    for s in range(num_splits+1):
-        if s == 0:
-            lat_lon_dict = {}
-        else:
-            with open(DATA_PATH + "lat_lon_dict_" + str(s-1) +".txt", "r") as fp:
-                lat_lon_dict = json.load(fp)
-
-        lower_idx = num_rows*s
-        upper_idx = num_rows*(s+1)
-        if s == num_splits:
-            df_loop = df[lower_idx:].copy()
-        else:
-            df_loop = df[lower_idx:upper_idx].copy()
-
-        df_loop = df_loop.reset_index()
-        for _, row in df_loop.iterrows():
-            key = str(row["latitude"]) + "/" + str(row["longitude"])
-            if key not in lat_lon_dict:
-                lat_lon_dict[key] = get_zipcode(geolocator,row["latitude"],row["longitude"])
-        
-        with open("lat_lon_dict_" + str(s) +".txt", "w") as fp:
-            json.dump(lat_lon_dict, fp)
-    
-    #Creating the final dictionary:
-    with open("lat_lon_dict_" + str(num_splits) +".txt", "r") as fp:
-                lat_lon_dict = json.load(fp)
-    with open("lat_lon_dict.txt", "w") as fp:
-            json.dump(lat_lon_dict, fp)
-
-def pull_API_data():
+
+    if not panel:
+        merged_db = merged_db.drop(columns=["year"])
+    return merged_db
+
+def mapping_coord_zip(df, data_path = DATA_PATH, cache_path = None,
+                      domain = GEOCODE_DOMAIN, scheme = "https"):
+    """
+    Helper function that retrieves the zip codes of some coordinates by
+    reverse-geocoding them (Nominatim). Coordinates are normalized and
+    deduplicated, and every answer is stored in a persistent SQLite cache
+    (see geocode.py), so re-running after an interruption only requests the
+    coordinates that are still missing.
+
+    Input:
+        df (DataFrame): Must contain the columns with the latitude and longitude
+            that are going to be used as inputs to calculate the zip code.
+        data_path (str): folder where the cache is kept by default
+        cache_path (str): path of the SQLite cache (default: data_path +
+            "geocode_cache.sqlite")
+        domain, scheme (str): geocoding server, e.g. "localhost:8080" and
+            "http" for a local stand-in
+
+    Output: A pandas series of zip codes aligned with df (missing when the
+        geocoder gives no postcode or the request kept failing)
+    """
+    from deprivation_evictions.data_bases.clean_data import geocode
+
+    if cache_path is None:
+        cache_path = data_path + "geocode_cache.sqlite"
+
+    keys = geocode.coordinate_keys(df["latitude"], df["longitude"])
+    postcode = geocode.make_reverse(domain, scheme, user_agent = 'ssegovba@uchicago.edu')
+    cache = geocode.GeocodeCache(cache_path)
+    try:
+        zip_codes = geocode.resolve(keys, cache, postcode)
+    finally:
+        cache.close()
+
+    return pd.Series(keys, index = df.index).map(zip_codes).astype("string")
+
+def pull_API_data(years = (FILTER_YEAR,)):
     """
     Helper function to pull the data from the different APIs. The default is
     False since the process takes approx. 10 minutes.
-    """    
-    pull_crime_data(FILTER_YEAR)
-    pull_acs_data()
+
+    Input:
+        years (list of int): years of crime and ACS data to pull (a year
+            whose ACS vintage is not published yet gets the latest one, see
+            pull_acs_data.acs_year)
+    """
+    # Import the code to pull the data from the APIs (these need the API keys
+    # in constants.py)
+    from deprivation_evictions.data_bases.raw_data.pull_crime_data import download_crime_data
+    from deprivation_evictions.data_bases.raw_data.pull_acs_data import pull_acs_data
+    from deprivation_evictions.data_bases.raw_data.google_dist import update_travel_data
+
+    download_crime_data(years)
+    pull_acs_data(years, ZIP_CODES)
     update_travel_data("41.875556,-87.6244014" , 13)
 
 #Includes a call to the function to be able to run it from the command line:
-clean_db()
\ No newline at end of file
+if __name__ == "__main__":
+    clean_db(pull_API_data_bool = True)
\ No newline at end of file
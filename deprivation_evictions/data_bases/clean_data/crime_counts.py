@@ -0,0 +1,147 @@
+# Streaming aggregation of crime records into counts by zipcode
+# The crime cache is read in batches. Each batch is classified through a code
+# lookup table built from the taxonomy config (crime_taxonomy.json) and folded
+# into dense running counts, so memory depends on the number of zipcodes (and
+# periods), not on the number of incidents.
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from deprivation_evictions.data_bases.clean_data.raw_cache import cache_path, raw_schema
+
+TAXONOMY_PATH = os.path.join(os.path.dirname(__file__), "crime_taxonomy.json")
+BATCH_ROWS = 100_000
+
+
+def load_taxonomy(path=TAXONOMY_PATH):
+    '''
+    Reads the crime taxonomy: {category column: [primary types]}. A primary
+    type may belong to several categories (or to none); every record counts
+    in the 'crime' column.
+    '''
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def category_lookup(primary_types, taxonomy):
+    '''
+    Code lookup table of a batch: one row per distinct primary type (the
+    dictionary of the categorical column), one column per category.
+
+    Returns: (types x categories) int64 matrix of 0/1 flags
+    '''
+    types = pd.Index(primary_types)
+    lookup = np.zeros((len(types), len(taxonomy)), dtype=np.int64)
+    for j, members in enumerate(taxonomy.values()):
+        lookup[types.isin(members), j] = 1
+    return lookup
+
+
+class CrimeCounts:
+    '''
+    Running counts of crimes by zip code and year (or year and month), for
+    every category of the taxonomy.
+    '''
+    def __init__(self, zip_codes, years, categories, monthly=False):
+        self.zip_codes = pd.Index(sorted(zip_codes))
+        self.years = pd.Index(sorted(years))
+        self.categories = list(categories)
+        self.monthly = monthly
+        self.n_periods = len(self.years) * (12 if monthly else 1)
+        self.counts = np.zeros((len(self.zip_codes) * self.n_periods,
+                                1 + len(self.categories)), dtype=np.int64)
+
+    def add(self, zip_codes, years, months, flags):
+        '''
+        Folds a batch into the counts.
+
+        Inputs:
+            zip_codes, years, months : arrays with one value per record
+            flags                    : (records x categories) 0/1 matrix
+        '''
+        zip_idx = self.zip_codes.get_indexer(zip_codes)
+        period = self.years.get_indexer(years)
+        keep = (zip_idx >= 0) & (period >= 0)
+        if self.monthly:
+            period = period * 12 + (np.asarray(months) - 1)
+        cell = (zip_idx * self.n_periods + period)[keep]
+
+        size = len(self.counts)
+        self.counts[:, 0] += np.bincount(cell, minlength=size)
+        for j in range(len(self.categories)):
+            self.counts[:, j + 1] += np.bincount(cell, weights=flags[keep, j],
+                                                 minlength=size).astype(np.int64)
+
+    def frame(self):
+        '''
+        Returns: dataframe with zip_code, year (and month) and the counts of
+                 the cells with at least one crime
+        '''
+        cells = np.flatnonzero(self.counts[:, 0])
+        zip_idx, period = np.divmod(cells, self.n_periods)
+        data = {"zip_code": pd.array(self.zip_codes[zip_idx], dtype="string")}
+        if self.monthly:
+            data["year"] = self.years[period // 12].to_numpy(dtype=np.int64)
+            data["month"] = period % 12 + 1
+        else:
+            data["year"] = self.years[period].to_numpy(dtype=np.int64)
+        columns = ["crime"] + self.categories
+        for j, col in enumerate(columns):
+            data[col] = self.counts[cells, j]
+        return pd.DataFrame(data)
+
+
+def stream_crime_counts(data_path, zip_codes, years, locate, taxonomy=None,
+                        monthly=False, batch_rows=BATCH_ROWS):
+    '''
+    Counts crimes by zip code and year (or month) from the crime cache.
+
+    Inputs:
+        data_path : folder with the raw data
+        zip_codes : zip codes to keep
+        years     : years to keep
+        locate    : function of a batch dataframe (with latitude and
+                    longitude) returning the zip code of each record
+        taxonomy  : {category: [primary types]} (default: crime_taxonomy.json)
+        monthly   : True to count by year and month
+
+    Returns: dataframe of counts (see CrimeCounts.frame)
+    '''
+    if taxonomy is None:
+        taxonomy = load_taxonomy()
+    raw_schema("crime", data_path)
+    counts = CrimeCounts(zip_codes, years, taxonomy.keys(), monthly)
+
+    # Row group by row group, without read-ahead
+    batches = pq.ParquetFile(cache_path("crime", data_path)).iter_batches(
+        columns=["date", "primary_type", "latitude", "longitude"], batch_size=batch_rows)
+    for batch in batches:
+        # Records without coordinates cannot be located
+        batch = batch.filter(batch.column("latitude").is_valid())
+        if not batch.num_rows:
+            continue
+        # Dates come as ISO strings (e.g. 2019-01-01T00:00:00.000):
+        date = batch.column("date")
+        batch_years = pc.utf8_slice_codeunits(date, 0, 4).cast(pa.int64()).to_numpy()
+        months = pc.utf8_slice_codeunits(date, 5, 7).cast(pa.int64()).to_numpy() \
+            if monthly else None
+
+        types = batch.column("primary_type")
+        if not pa.types.is_dictionary(types.type):
+            types = pc.dictionary_encode(types)
+        lookup = category_lookup(types.dictionary.to_pylist(), taxonomy)
+        codes = types.indices.fill_null(0).to_numpy(zero_copy_only=False)
+        flags = lookup[codes] * types.is_valid().to_numpy(zero_copy_only=False)[:, None]
+
+        coords = pd.DataFrame({"latitude": batch.column("latitude").to_numpy(),
+                               "longitude": batch.column("longitude").to_numpy()})
+        located = np.asarray(locate(coords), dtype=object)
+        counts.add(located, batch_years, months, flags)
+
+    return counts.frame()
@@ -0,0 +1,134 @@
+# Census tract to zipcode crosswalk
+# Each tract is split among the zipcodes it overlaps with allocation factors
+# (shares of its area, or of its population), so counts reported by tract are
+# apportioned instead of being added to every zipcode the tract touches.
+
+import json
+import os
+
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from scipy import sparse
+
+from deprivation_evictions.data_bases.clean_data.raw_cache import CACHE_DIR
+
+# Equal-area CRS for the area shares (NAD83 / Conus Albers). State Plane
+# Illinois East (EPSG:3435) is a Transverse Mercator projection, which keeps
+# shapes but not areas
+AREA_CRS = "EPSG:5070"
+# Pieces smaller than this share of their tract (slivers from boundaries
+# that do not line up exactly) are dropped
+MIN_WEIGHT = 1e-4
+CROSSWALK_FILE = "tract_zip_crosswalk.parquet"
+
+
+def build_crosswalk(tracts_gdf, zipcodes_gdf, population=None,
+                    min_weight=MIN_WEIGHT):
+    '''
+    Computes the allocation factors of every tract with a polygon overlay.
+
+    Inputs:
+        tracts_gdf   : tract boundaries with a 'geoid10' column
+        zipcodes_gdf : zip code boundaries with a 'zip' column
+        population   : optional GeoDataFrame of points with a 'population'
+                       column (e.g. census block centroids). If given, the
+                       factor of a piece is the share of the tract population
+                       inside it; tracts without population use area shares
+
+    Returns: dataframe with the columns geoid10, zip_code and weight. The
+             weights of a tract add up to (at most) one; the part of a tract
+             outside every zip code is not allocated
+    '''
+    tracts = tracts_gdf[["geoid10", "geometry"]].to_crs(AREA_CRS)
+    tracts["geoid10"] = tracts["geoid10"].astype(str)
+    zips = zipcodes_gdf[["zip", "geometry"]].to_crs(AREA_CRS)
+    zips = zips.rename(columns={"zip": "zip_code"})
+    zips["zip_code"] = zips["zip_code"].astype(str)
+
+    pieces = gpd.overlay(tracts, zips, how="intersection", keep_geom_type=True)
+    tract_area = tracts.set_index("geoid10").area.groupby(level=0).sum()
+    pieces["weight"] = pieces.area / pieces["geoid10"].map(tract_area).to_numpy()
+
+    if population is not None:
+        points = population[["population", "geometry"]].to_crs(AREA_CRS)
+        located = gpd.sjoin(points, pieces[["geoid10", "zip_code", "geometry"]],
+                            how="inner", predicate="within")
+        piece_pop = located.groupby(["geoid10", "zip_code"])["population"].sum()
+        tract_pop = piece_pop.groupby(level="geoid10").sum()
+        pop_weight = (piece_pop / tract_pop.reindex(piece_pop.index, level="geoid10"))
+        pop_weight = pop_weight[tract_pop.reindex(pop_weight.index, level="geoid10") > 0]
+
+        has_pop = pieces["geoid10"].isin(pop_weight.index.get_level_values("geoid10"))
+        keys = pd.MultiIndex.from_frame(pieces[["geoid10", "zip_code"]])
+        pieces.loc[has_pop, "weight"] = pop_weight.reindex(keys[has_pop]).fillna(0).to_numpy()
+
+    crosswalk = pieces.groupby(["geoid10", "zip_code"], as_index=False)["weight"].sum()
+    return crosswalk[crosswalk["weight"] >= min_weight].reset_index(drop=True)
+
+
+def boundary_stamp(paths):
+    '''
+    Identifies the versions of the boundary files (sizes and modification
+    times) and the CRS of the area shares, stored in the metadata of the
+    cached crosswalk.
+    '''
+    return json.dumps([AREA_CRS] + [[os.stat(p).st_size, os.stat(p).st_mtime_ns]
+                                    for p in paths])
+
+
+def load_crosswalk(data_path, population=None):
+    '''
+    Returns the crosswalk between bound_census_tracts.geojson and
+    bound_zip_codes.geojson, computing it only when the cached table in
+    data_path/cache is missing, older than the boundary files or computed in
+    another CRS.
+    Population weighted crosswalks are not cached.
+    '''
+    tract_path = data_path + "bound_census_tracts.geojson"
+    zip_path = data_path + "bound_zip_codes.geojson"
+    if population is not None:
+        return build_crosswalk(gpd.read_file(tract_path), gpd.read_file(zip_path),
+                               population)
+
+    path = os.path.join(data_path + CACHE_DIR, CROSSWALK_FILE)
+    stamp = boundary_stamp([tract_path, zip_path]).encode()
+    if os.path.exists(path) and pq.read_schema(path).metadata.get(b"boundaries") == stamp:
+        return pq.read_table(path).to_pandas()
+
+    crosswalk = build_crosswalk(gpd.read_file(tract_path), gpd.read_file(zip_path))
+    table = pa.Table.from_pandas(crosswalk, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"boundaries"] = stamp
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    pq.write_table(table.replace_schema_metadata(metadata), path)
+    return crosswalk
+
+
+def allocate(data, crosswalk, columns, by=(), key="geoid10"):
+    '''
+    Apportions tract level counts to zip codes as a single sparse matrix
+    product: (zip code, *by) groups x data rows, times data rows x columns.
+
+    Inputs:
+        data      : dataframe with the key column, the by columns and the
+                    columns to allocate
+        crosswalk : dataframe with key, zip_code and weight (build_crosswalk)
+        columns   : columns to allocate
+        by        : other columns that define the groups (e.g. ['year'])
+
+    Returns: dataframe with zip_code, the by columns and the allocated columns
+    '''
+    by = list(by)
+    links = (data[[key] + by].reset_index(drop=True).rename_axis("row").reset_index()
+             .merge(crosswalk, on=key, how="inner"))
+    groups = links[["zip_code"] + by].drop_duplicates().sort_values(["zip_code"] + by)
+    groups = groups.reset_index(drop=True)
+    group_id = (links[["zip_code"] + by].merge(groups.reset_index(), how="left")["index"]
+                .to_numpy())
+
+    matrix = sparse.csr_matrix((links["weight"].to_numpy(), (group_id, links["row"].to_numpy())),
+                               shape=(len(groups), len(data)))
+    values = matrix @ data[columns].to_numpy(dtype=float)
+    return pd.concat([groups, pd.DataFrame(values, columns=columns)], axis=1)
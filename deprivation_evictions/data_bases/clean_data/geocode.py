@@ -0,0 +1,156 @@
+# Persistent cache of reverse-geocoded zip codes
+# Lookups are stored in SQLite as they complete, so an interrupted run
+# resumes with only the coordinates that are still missing
+
+import sqlite3
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+
+# Decimals kept when normalizing coordinates (~1 cm), so that the same point
+# written with a different float repr maps to the same key
+PRECISION = 7
+# Nominatim's usage policy allows at most one request per second
+MIN_DELAY = 1.0
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+# Results written to disk per transaction
+COMMIT_EVERY = 100
+
+
+def coordinate_keys(lat, lon, precision=PRECISION):
+    '''
+    Normalizes coordinates into cache keys ('lat/lon' with fixed decimals).
+
+    Returns: numpy array of strings
+    '''
+    fmt = '{:.%df}/{:.%df}' % (precision, precision)
+    lat = np.round(np.asarray(lat, dtype=float), precision)
+    lon = np.round(np.asarray(lon, dtype=float), precision)
+    return np.array([fmt.format(a, b) for a, b in zip(lat, lon)], dtype=object)
+
+
+class GeocodeCache:
+    '''
+    Key-value store of reverse-geocoded zip codes. A key without a postcode
+    in the geocoder's answer is stored with a NULL zip code, so it is not
+    requested again; failed requests are not stored.
+    '''
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS geocodes '
+                          '(key TEXT PRIMARY KEY, zip_code TEXT)')
+        self.conn.commit()
+
+    def get_many(self, keys):
+        '''
+        Returns: dictionary {key: zip code or None} of the cached keys
+        '''
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (key TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM wanted')
+        self.conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?)',
+                              ((key,) for key in keys))
+        rows = self.conn.execute('SELECT g.key, g.zip_code FROM geocodes g '
+                                 'JOIN wanted w ON g.key = w.key')
+        return dict(rows.fetchall())
+
+    def put_many(self, items):
+        self.conn.executemany('INSERT OR REPLACE INTO geocodes VALUES (?, ?)', items)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def make_reverse(domain, scheme, user_agent, min_delay=MIN_DELAY,
+                 max_retries=MAX_RETRIES, timeout=10):
+    '''
+    Builds a rate-limited Nominatim reverse lookup returning the postcode of
+    a (lat, lon) pair. domain/scheme point it to any Nominatim compatible
+    server (e.g. 'localhost:8080' and 'http' for a local stand-in).
+    The limiter is shared by all threads; errors are retried max_retries
+    times and then raised.
+    '''
+    from geopy.extra.rate_limiter import RateLimiter
+    from geopy.geocoders import Nominatim
+
+    geolocator = Nominatim(user_agent=user_agent, domain=domain, scheme=scheme,
+                           timeout=timeout)
+    reverse = RateLimiter(geolocator.reverse, min_delay_seconds=min_delay,
+                          max_retries=max_retries, error_wait_seconds=min_delay,
+                          swallow_exceptions=False)
+
+    def postcode(lat, lon):
+        location = reverse((lat, lon), exactly_one=True)
+        if location is None:
+            return None
+        return location.raw.get('address', {}).get('postcode')
+
+    return postcode
+
+
+def resolve(keys, cache, postcode, max_workers=MAX_WORKERS,
+            commit_every=COMMIT_EVERY):
+    '''
+    Reverse-geocodes the keys that are not in the cache yet, concurrently,
+    writing results to the cache as they arrive.
+
+    Inputs:
+        keys     : iterable of normalized keys (see coordinate_keys)
+        cache    : GeocodeCache
+        postcode : function (lat, lon) -> zip code or None (see make_reverse)
+
+    Returns: dictionary {key: zip code or None} for every key that was
+             resolved. Failed keys are left out and retried on the next run;
+             their number is reported with a warning, and if every lookup
+             fails (e.g. the server refuses the requests) an error is raised.
+    '''
+    keys = set(keys)
+    found = cache.get_many(keys)
+    missing = sorted(keys - set(found))
+
+    def lookup(key):
+        lat, lon = key.split('/')
+        return key, postcode(float(lat), float(lon))
+
+    pending = []
+    failures = []
+    collected = set()
+
+    def collect(future):
+        collected.add(future)
+        try:
+            key, zip_code = future.result()
+        except Exception as exc:
+            failures.append(exc)
+            return
+        found[key] = zip_code
+        pending.append((key, zip_code))
+
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [pool.submit(lookup, key) for key in missing]
+    try:
+        for future in as_completed(futures):
+            collect(future)
+            if len(pending) >= commit_every:
+                cache.put_many(pending)
+                pending = []
+    finally:
+        # On an interruption, drop the queued lookups and keep the results,
+        # including those of the lookups that were running
+        for future in futures:
+            future.cancel()
+        pool.shutdown()
+        for future in futures:
+            if future.done() and not future.cancelled() and future not in collected:
+                collect(future)
+        cache.put_many(pending)
+
+    if failures:
+        if len(failures) == len(missing):
+            raise RuntimeError(f"All {len(missing)} geocode lookups failed") from failures[-1]
+        warnings.warn(f"{len(failures)} geocode lookups failed (last error: {failures[-1]!r}); "
+                      f"{len(keys) - len(found)} of {len(keys)} coordinates remain "
+                      "unresolved and will be retried on the next run")
+    return found
@@ -0,0 +1,226 @@
+# Typed columnar cache of the raw inputs of clean_db
+# Each CSV (or set of downloaded pages) is parsed once with explicit dtypes
+# and stored as Parquet; later runs read only the columns they use. A cache
+# file is rebuilt whenever its raw files change (size or modification time).
+
+import glob
+import json
+import os
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+CACHE_DIR = "cache/"
+# Bump when the dtypes below change so existing caches are rebuilt
+CACHE_VERSION = 4
+
+# Rows per batch when converting and streaming the wide Zillow file
+ZILLOW_BATCH_ROWS = 10_000
+# Rows per chunk when converting a large CSV
+CSV_CHUNK_ROWS = 200_000
+
+# Raw file and dtypes of each source. Columns not listed keep the dtype
+# inferred by pandas (int64 or float64 for the numeric ones), or get
+# 'default' for the sources converted in chunks of 'chunk_rows' (inferred
+# dtypes could differ between chunks). A source with a 'pages' folder is read
+# from the Parquet pages in it when there are any (see download_crime_data in
+# raw_data/pull_crime_data.py), and one with a 'parquet' file from that file
+# when it exists (see pull_acs_data), instead of its CSV.
+RAW_SOURCES = {
+    'acs': {'file': "acs_data.csv",
+            'parquet': "acs_data.parquet",
+            'dtype': {'zip_code': "string"},
+            'drop': ["Unnamed: 0"]},
+    # Zillow has one float column per month after the region columns
+    'zillow': {'file': "zillow_data.csv",
+               'dtype': {'RegionID': "int64", 'SizeRank': "int64",
+                         'RegionName': "string", 'RegionType': "string",
+                         'StateName': "string", 'State': "category",
+                         'City': "category", 'Metro': "string",
+                         'CountyName': "string"},
+               'default': "float64",
+               'chunk_rows': ZILLOW_BATCH_ROWS,
+               'drop': []},
+    'evictions': {'file': "eviction_data.csv",
+                  'dtype': {},
+                  'drop': []},
+    'crime': {'file': "crime_data.csv",
+              'dtype': {'latitude': "float64", 'longitude': "float64",
+                        'primary_type': "category"},
+              'default': "string",
+              'chunk_rows': CSV_CHUNK_ROWS,
+              'pages': "crime_data/",
+              'drop': ["Unnamed: 0"]},
+}
+
+
+def source_files(name, data_path):
+    '''
+    Raw files of a source: its downloaded pages (in month and offset order),
+    its Parquet file or its CSV.
+    '''
+    source = RAW_SOURCES[name]
+    if 'pages' in source:
+        pages = sorted(glob.glob(os.path.join(data_path + source['pages'], "*",
+                                              "part-*.parquet")))
+        if pages:
+            return pages
+    if 'parquet' in source and os.path.exists(data_path + source['parquet']):
+        return [data_path + source['parquet']]
+    return [data_path + source['file']]
+
+
+def source_stamp(paths):
+    '''
+    Identifies the version of the raw files of a source (sizes, modification
+    times and the cache version), stored in the Parquet metadata.
+    '''
+    stats = [os.stat(p) for p in paths]
+    return json.dumps([[[s.st_size, s.st_mtime_ns] for s in stats], CACHE_VERSION])
+
+
+def cache_path(name, data_path):
+    return os.path.join(data_path + CACHE_DIR, name + ".parquet")
+
+
+def build_cache(name, data_path):
+    '''
+    Parses the raw files of a source with its dtypes and writes them as
+    Parquet.
+    '''
+    source = RAW_SOURCES[name]
+    paths = source_files(name, data_path)
+    stamp = source_stamp(paths)
+    path = cache_path(name, data_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if paths[0].endswith(".parquet"):
+        chunks = (pq.read_table(p).to_pandas().astype(source['dtype']) for p in paths)
+    elif 'chunk_rows' in source:
+        chunks = pd.read_csv(paths[0], dtype=defaultdict(lambda: source['default'],
+                                                         source['dtype']),
+                             chunksize=source['chunk_rows'])
+    else:
+        data = pd.read_csv(paths[0], dtype=source['dtype'])
+        data = data.drop(columns=[c for c in source['drop'] if c in data.columns])
+        table = pa.Table.from_pandas(data, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[b'raw_source'] = stamp.encode()
+        pq.write_table(table.replace_schema_metadata(metadata), path)
+        return
+
+    # Convert chunk by chunk; categories get a fixed dictionary type so that
+    # every chunk has the schema of the first one
+    writer = schema = None
+    try:
+        for chunk in chunks:
+            chunk = chunk.drop(columns=[c for c in source['drop'] if c in chunk.columns])
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                fields = [pa.field(f.name, pa.dictionary(pa.int32(), pa.string()))
+                          if pa.types.is_dictionary(f.type) else f for f in table.schema]
+                metadata = dict(table.schema.metadata or {})
+                metadata[b'raw_source'] = stamp.encode()
+                schema = pa.schema(fields, metadata=metadata)
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def raw_schema(name, data_path):
+    '''
+    Returns the Parquet schema of a source, (re)building its cache first if
+    it is missing or older than the raw files.
+    '''
+    path = cache_path(name, data_path)
+    stamp = source_stamp(source_files(name, data_path))
+    if os.path.exists(path):
+        schema = pq.read_schema(path)
+        if (schema.metadata or {}).get(b'raw_source') == stamp.encode():
+            return schema
+    build_cache(name, data_path)
+    return pq.read_schema(path)
+
+
+def read_raw(name, data_path, columns=None):
+    '''
+    Reads a raw source from its typed Parquet cache.
+
+    Inputs:
+        name      : 'acs', 'zillow', 'evictions' or 'crime'
+        data_path : folder with the raw data (the cache goes in data_path/cache)
+        columns   : list of columns to read, or a function that selects the
+                    columns from their names (default: all)
+
+    Returns: pandas dataframe
+    '''
+    names = raw_schema(name, data_path).names
+    if callable(columns):
+        columns = [c for c in names if columns(c)]
+    return pq.read_table(cache_path(name, data_path), columns=columns).to_pandas()
+
+
+def zillow_date_columns(names, years):
+    '''
+    Monthly columns of the wide Zillow file (named YYYY-MM-DD) that fall in
+    the given years.
+    '''
+    years = set(years)
+    return [c for c in names
+            if len(c) == 10 and c[:4].isdigit() and c[4] == "-" and int(c[:4]) in years]
+
+
+def zillow_mean_rent(data_path, zip_codes, years, state="IL",
+                     batch_rows=ZILLOW_BATCH_ROWS):
+    '''
+    Mean monthly rent of each zip code and year, read from the Zillow cache
+    without melting the wide file: only the date columns of the requested
+    years are read, rows are filtered on State and RegionName before they
+    are loaded, and the file is streamed in batches, so memory does not grow
+    with the number of months in the file.
+
+    Inputs:
+        data_path : folder with the raw data
+        zip_codes : zip codes to keep (strings)
+        years     : years to keep
+
+    Returns: dataframe with the columns zip_code, year and RentPrice (missing
+             when a zip code has no value in that year)
+    '''
+    date_cols = zillow_date_columns(raw_schema("zillow", data_path).names, years)
+    col_years = np.array([int(c[:4]) for c in date_cols])
+    dataset = ds.dataset(cache_path("zillow", data_path), format="parquet")
+    row_filter = ((ds.field("State") == state)
+                  & ds.field("RegionName").isin([str(z) for z in zip_codes]))
+
+    parts = []
+    for batch in dataset.to_batches(columns=["RegionName"] + date_cols,
+                                    filter=row_filter, batch_size=batch_rows):
+        if not batch.num_rows:
+            continue
+        zips = batch.column("RegionName").to_numpy(zero_copy_only=False)
+        values = np.column_stack([batch.column(c).to_numpy(zero_copy_only=False)
+                                  for c in date_cols]).astype(float)
+        # Only this batch is in long form (values in the order of a melt)
+        long = pd.DataFrame({"zip_code": np.tile(zips, len(date_cols)),
+                             "year": np.repeat(col_years, len(zips)),
+                             "RentPrice": values.ravel(order="F")})
+        parts.append(long.groupby(["zip_code", "year"])["RentPrice"]
+                     .agg(["sum", "count"]).rename(columns={"sum": "total"}))
+
+    if not parts:
+        return pd.DataFrame({"zip_code": pd.Series(dtype="string"),
+                             "year": pd.Series(dtype=int),
+                             "RentPrice": pd.Series(dtype=float)})
+    sums = pd.concat(parts).groupby(level=["zip_code", "year"]).sum()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rent = (sums["total"] / sums["count"]).rename("RentPrice")
+    rent = rent.reset_index()
+    rent["zip_code"] = rent["zip_code"].astype("string")
+    return rent
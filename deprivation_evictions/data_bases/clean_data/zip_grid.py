@@ -0,0 +1,163 @@
+# Precomputed grid raster for coordinate to zipcode (or any polygon label)
+# lookups. Cells fully inside one polygon store its label, so most points are
+# assigned with an integer array gather; only points in cells crossed by a
+# border fall back to an exact point-in-polygon test.
+
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+from shapely.geometry import box
+
+# Cell side in degrees (~110 m north-south and ~80 m east-west in Chicago)
+CELL_SIZE = 0.001
+OUTSIDE = -1
+BOUNDARY = -2
+
+
+def assign_zip_codes(df, zipcodes_gdf, label="zip"):
+    '''
+    Assigns coordinates to the zip code polygon that contains them. Repeated
+    coordinates (crimes are reported at the block level) are tested once,
+    and all points are matched in a single spatial join that uses the
+    spatial index of the polygons. The grid uses it for the points in
+    boundary cells.
+
+    Inputs:
+        df : DataFrame with the latitude and longitude columns (EPSG:4326)
+        zipcodes_gdf : GeoDataFrame with the label column
+    Returns: pandas series of labels aligned with df (missing outside the
+             boundaries). Points on a shared border get the first matching
+             polygon
+    '''
+    coords = df[["latitude", "longitude"]].to_numpy(dtype=float)
+    if len(coords) == 0:
+        return pd.Series(index=df.index, dtype="string")
+    unique_coords, inverse = np.unique(coords, axis=0, return_inverse=True)
+    points = gpd.GeoDataFrame(geometry=gpd.points_from_xy(unique_coords[:, 1],
+                              unique_coords[:, 0]), crs="EPSG:4326")
+    points = points.to_crs(zipcodes_gdf.crs)
+
+    matched = gpd.sjoin(points, zipcodes_gdf[[label, "geometry"]], how="inner",
+                        predicate="intersects")
+    matched = matched[~matched.index.duplicated(keep="first")]
+    zip_codes = matched[label].reindex(range(len(points)))
+
+    return pd.Series(zip_codes.to_numpy()[inverse.ravel()], index=df.index,
+                     dtype="string")
+
+
+def fingerprint(polygons, label, cell_size):
+    '''
+    Hashes the polygons, their labels and the cell size, so that a saved
+    grid is rebuilt when any of them changes.
+    '''
+    digest = hashlib.sha256()
+    for name, geom in zip(polygons[label].astype(str), polygons.geometry):
+        digest.update(name.encode())
+        digest.update(geom.wkb)
+    digest.update(repr((str(polygons.crs), cell_size)).encode())
+    return digest.hexdigest()
+
+
+class ZipGrid:
+    '''
+    Quantized grid over the extent of the polygons. codes[i, j] is the
+    index of the label of cell (row i, column j), OUTSIDE, or BOUNDARY.
+    '''
+    def __init__(self, codes, labels, origin, cell_size, key, polygons, label="zip"):
+        self.codes = codes
+        self.labels = np.asarray(labels, dtype=object)
+        self.origin = origin
+        self.cell_size = cell_size
+        self.key = key
+        self.polygons = polygons
+        self.label = label
+
+    @classmethod
+    def build(cls, polygons, cell_size=CELL_SIZE, label="zip"):
+        '''
+        Classifies every cell with two spatial joins: cells within a polygon
+        take its label, cells that intersect none are outside, and the rest
+        are boundary cells.
+        '''
+        polygons_4326 = polygons.to_crs("EPSG:4326")
+        minx, miny, maxx, maxy = polygons_4326.total_bounds
+        n_rows = int(np.ceil((maxy - miny) / cell_size))
+        n_cols = int(np.ceil((maxx - minx) / cell_size))
+
+        rows, cols = np.divmod(np.arange(n_rows * n_cols), n_cols)
+        x0, y0 = minx + cols * cell_size, miny + rows * cell_size
+        cells = gpd.GeoDataFrame(
+            geometry=[box(x, y, x + cell_size, y + cell_size) for x, y in zip(x0, y0)],
+            crs="EPSG:4326")
+
+        labels = sorted(polygons_4326[label].astype(str).unique())
+        label_codes = pd.Series(np.arange(len(labels)), index=labels)
+        shapes = polygons_4326[[label, "geometry"]].copy()
+        shapes[label] = shapes[label].astype(str)
+
+        codes = np.full(len(cells), OUTSIDE, dtype=np.int32)
+        touched = gpd.sjoin(cells, shapes, how="inner", predicate="intersects")
+        codes[np.unique(touched.index)] = BOUNDARY
+        inside = gpd.sjoin(cells, shapes, how="inner", predicate="within")
+        inside = inside[~inside.index.duplicated(keep=False)]
+        codes[inside.index] = label_codes.loc[inside[label]].to_numpy()
+
+        return cls(codes.reshape(n_rows, n_cols), labels, (minx, miny), cell_size,
+                   fingerprint(polygons, label, cell_size), polygons, label)
+
+    def save(self, path):
+        np.savez_compressed(path, codes=self.codes, labels=self.labels.astype(str),
+                            origin=np.array(self.origin), cell_size=self.cell_size,
+                            key=self.key)
+
+    @classmethod
+    def load(cls, path, polygons, label="zip"):
+        with np.load(path) as saved:
+            return cls(saved["codes"], saved["labels"].tolist(),
+                       tuple(saved["origin"]), float(saved["cell_size"]),
+                       str(saved["key"]), polygons, label)
+
+    def lookup(self, lat, lon):
+        '''
+        Labels of the points: a gather on the grid, plus the exact test for
+        the points in boundary cells.
+
+        Returns: numpy array of labels (None outside every polygon)
+        '''
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        row = np.floor((lat - self.origin[1]) / self.cell_size)
+        col = np.floor((lon - self.origin[0]) / self.cell_size)
+        n_rows, n_cols = self.codes.shape
+        on_grid = (row >= 0) & (row < n_rows) & (col >= 0) & (col < n_cols)
+
+        codes = np.full(len(lat), OUTSIDE, dtype=np.int32)
+        codes[on_grid] = self.codes[row[on_grid].astype(int), col[on_grid].astype(int)]
+
+        result = np.full(len(lat), None, dtype=object)
+        inside = codes >= 0
+        result[inside] = self.labels[codes[inside]]
+        border = codes == BOUNDARY
+        exact = assign_zip_codes(pd.DataFrame({"latitude": lat[border],
+                                               "longitude": lon[border]}),
+                                 self.polygons, self.label)
+        result[border] = exact.astype(object).where(exact.notna(), None).to_numpy()
+        return result
+
+
+def load_grid(polygons, path, cell_size=CELL_SIZE, label="zip"):
+    '''
+    Returns the grid saved in path, building (and saving) it first if it is
+    missing or was built from other polygons or another cell size.
+    '''
+    if os.path.exists(path):
+        grid = ZipGrid.load(path, polygons, label)
+        if grid.key == fingerprint(polygons, label, cell_size):
+            return grid
+    grid = ZipGrid.build(polygons, cell_size, label)
+    grid.save(path)
+    return grid
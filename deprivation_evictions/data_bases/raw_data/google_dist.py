@@ -1,27 +1,142 @@
 # Created by Gregory Ho
+# Origins are sent to the Distance Matrix API in batches (up to MAX_ORIGINS
+# per request) over pooled connections, by a few threads that share a token
+# bucket rate limiter. Answers are cached in SQLite by rounded origin and
+# destination, so a refresh only requests the points it has not seen.
+# Origins are uniform in each zipcode, or (sampling='population') spread in
+# proportion to the population of its census tracts with quasi-random
+# points, so their plain mean estimates the population-weighted travel time.
+
+import os
 
 import geopandas as gpd
-import random
-import shapely.geometry as geometry
 import pandas as pd
+import numpy as np
 import requests
-from random import randint
-from time import sleep
-
-# From a non-public doc of API keys
-from ...constants import GOOGLE_TOKEN
-
-#Google token for calling its API
-API_KEY = GOOGLE_TOKEN
+import shapely
+import sqlite3
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 #Path to Geojson file, from which zip code boundaries are stored
 ZIPCODE_PATH = "deprivation_evictions/data_bases/raw_data/bound_zip_codes.geojson"
+TRACT_PATH = "deprivation_evictions/data_bases/raw_data/bound_census_tracts.geojson"
+# Tract populations (geoid10, population), see pull_acs_data.pull_tract_population
+TRACT_POPULATION_PATH = "deprivation_evictions/data_bases/raw_data/tract_population.csv"
+OUTPUT_PATH = "deprivation_evictions/data_bases/raw_data/google_distancematrix.csv"
+CACHE_PATH = "deprivation_evictions/data_bases/raw_data/travel_cache.sqlite"
+
+API_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+MAX_ORIGINS = 25 # origins per request allowed by the API (with one destination)
+RATE = 5 # requests per second
+BURST = 5 # requests that can be sent at once after an idle period
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+TIMEOUT = 30
+PRECISION = 6 # decimals of the cache keys (~10 cm)
+# Answers that are worth retrying (other statuses are final)
+RETRY_STATUS = ("OVER_QUERY_LIMIT", "UNKNOWN_ERROR")
 
 DESTINATION = "41.875556,-87.6244014" # coordinates of the center of "The Loop, Chicago"
 NUM_ORIGIN = 13 # number of random points
 SEED = 20220224
+SAMPLING = ("uniform", "population")
+
+def sample_in_polygon(polygon, n, rng, oversample=1.2, engine=None):
+    '''
+    Draws n uniform random points inside a polygon. Candidates are drawn in
+    batches over its bounding box (sized from the share of the box the
+    polygon covers) and tested all at once against the prepared polygon.
+
+    Inputs:
+    polygon: shapely (Multi)Polygon with a positive area
+    n: number of points
+    rng: numpy random Generator
+    engine: optional scipy.stats.qmc engine of dimension 2; candidates are
+            then the next points of its (quasi-random) sequence
+
+    Returns:
+    x, y: numpy arrays of n longitudes and latitudes
+    '''
+    if polygon.is_empty or polygon.area <= 0:
+        raise ValueError("Cannot sample points in a polygon without area")
+    shapely.prepare(polygon)
+    minx, miny, maxx, maxy = polygon.bounds
+    share = polygon.area / ((maxx - minx) * (maxy - miny))
+
+    x, y = np.empty(n), np.empty(n)
+    found = 0
+    while found < n:
+        size = int(np.ceil((n - found) / share * oversample)) + 8
+        if engine is None:
+            cand_x = rng.uniform(minx, maxx, size)
+            cand_y = rng.uniform(miny, maxy, size)
+        else:
+            unit = engine.random(size)
+            cand_x = minx + unit[:, 0] * (maxx - minx)
+            cand_y = miny + unit[:, 1] * (maxy - miny)
+        inside = np.flatnonzero(shapely.contains_xy(polygon, cand_x, cand_y))[:n - found]
+        x[found:found + len(inside)] = cand_x[inside]
+        y[found:found + len(inside)] = cand_y[inside]
+        found += len(inside)
+    return x, y
+
 
-def define_origin_coor(NUM_ORIGIN):
+def population_strata(zipcodes, tract_path=TRACT_PATH,
+                      population_path=TRACT_POPULATION_PATH):
+    '''
+    Splits every zipcode into its pieces of census tracts, with the
+    population of each piece estimated as the tract population times the
+    share of the tract area in the piece.
+
+    Inputs:
+    zipcodes: GeoDataFrame of zipcode boundaries (their columns are kept)
+    tract_path, population_path: tract boundaries and populations
+
+    Returns:
+    GeoDataFrame of pieces (geoid10, the zipcode columns, population, geometry)
+    '''
+    if not os.path.exists(population_path):
+        raise FileNotFoundError(f"Population sampling needs the tract populations in "
+                                f"{population_path}; pull them with "
+                                "pull_acs_data.pull_tract_population()")
+
+    from deprivation_evictions.data_bases.clean_data.crosswalk import AREA_CRS, MIN_WEIGHT
+
+    tracts = gpd.read_file(tract_path)[['geoid10', 'geometry']].to_crs(zipcodes.crs)
+    tracts['geoid10'] = tracts['geoid10'].astype(str)
+    pieces = gpd.overlay(tracts, zipcodes, how='intersection', keep_geom_type=True)
+    tract_area = tracts.to_crs(AREA_CRS).set_index('geoid10').area.groupby(level=0).sum()
+    area = pieces.to_crs(AREA_CRS).area.to_numpy()
+    share = area / pieces['geoid10'].map(tract_area).to_numpy()
+
+    population = pd.read_csv(population_path, dtype={'geoid10': str})
+    population = population.set_index('geoid10')['population']
+    pieces['population'] = pieces['geoid10'].map(population).fillna(0).to_numpy() * share
+    # Slivers from boundaries that do not line up exactly
+    return pieces[share >= MIN_WEIGHT].reset_index(drop=True)
+
+
+def allocate_systematic(weights, n, rng):
+    '''
+    Splits n points among strata in proportion to their weights with a
+    systematic sample (n evenly spaced positions with a random start over
+    the cumulative weights): stratum counts differ from n * share by less
+    than one.
+
+    Returns:
+    numpy array of points per stratum
+    '''
+    cumulative = np.cumsum(weights) / np.sum(weights)
+    positions = (np.arange(n) + rng.random()) / n
+    stratum = np.minimum(np.searchsorted(cumulative, positions, side='right'),
+                         len(weights) - 1)
+    return np.bincount(stratum, minlength=len(weights))
+
+
+def define_origin_coor(NUM_ORIGIN, seed=SEED, sampling="uniform"):
     '''
     Opens zipcode shapefile, generates 'num_origin' random coordinates as origin
     points. As zip code boundaries come in different sizes, it is more appropriate 
@@ -33,42 +148,298 @@ def define_origin_coor(NUM_ORIGIN):
 
     Inputs: 
     NUM_ORIGIN: number of random origin points in a zipcode boundary
+    seed: seed of the random generator (the same seed gives the same points)
+    sampling: 'uniform' (uniform random points) or 'population' (points
+              allocated to the tract pieces of the zipcode in proportion to
+              their population, placed with a scrambled Halton sequence;
+              zipcodes without population fall back to the whole polygon)
 
-    Function:
-    Appends (zipcode, latitude, longitude) into a Pandas dataframe
+    Returns:
+    Pandas dataframe of (latitude, longitude, zipcode), NUM_ORIGIN rows per zipcode
     '''
+    if sampling not in SAMPLING:
+        raise ValueError(f"sampling must be one of {SAMPLING}, got '{sampling}'")
     # Open geojson shapefile
     zipcodes = gpd.read_file(ZIPCODE_PATH)
 
-    # Instantiate Pandas DF to store data
-    points_df = pd.DataFrame(columns=['latitude', 'longitude', 'zipcode'])
-
-    # Loop through each zipcode and generate n. random coordinates representing origin
-    for _, zipcode in zipcodes.iterrows():
-        for _ in range(NUM_ORIGIN):
-            # If random point is not within zipcode boundary, randomize again
-            point = None
-            while not point:
-                point = geometry.Point(random.uniform(zipcode.geometry.bounds[0], 
-                                                        zipcode.geometry.bounds[2]),
-                                    random.uniform(zipcode.geometry.bounds[1], 
-                                                    zipcode.geometry.bounds[3]))
-                if zipcode.geometry.contains(point):
-                    points_df = points_df.append({'latitude': point.y, 
-                                                    'longitude': point.x, 
-                                                    'zipcode': zipcode.zip}, 
-                                                    ignore_index=True)
-    
-    return points_df
+    # The output is allocated once and filled zipcode by zipcode
+    latitude = np.empty(len(zipcodes) * NUM_ORIGIN)
+    longitude = np.empty(len(zipcodes) * NUM_ORIGIN)
+
+    if sampling == "uniform":
+        rng = np.random.default_rng(seed)
+        for i, polygon in enumerate(zipcodes.geometry):
+            rows = slice(i * NUM_ORIGIN, (i + 1) * NUM_ORIGIN)
+            longitude[rows], latitude[rows] = sample_in_polygon(polygon, NUM_ORIGIN, rng)
+    else:
+        from scipy.stats import qmc
+
+        zipcodes = zipcodes.reset_index(drop=True)
+        pieces = population_strata(zipcodes.assign(row=np.arange(len(zipcodes))))
+        # One independent stream per zipcode, so the points of a zipcode do
+        # not depend on the other zipcodes
+        streams = np.random.SeedSequence(seed).spawn(len(zipcodes))
+        for i, polygon in enumerate(zipcodes.geometry):
+            rng = np.random.default_rng(streams[i])
+            engine = qmc.Halton(d=2, scramble=True, seed=rng)
+            mine = pieces[pieces['row'] == i]
+            if mine['population'].sum() <= 0:
+                shapes, counts = [polygon], [NUM_ORIGIN]
+            else:
+                shapes = mine.geometry
+                counts = allocate_systematic(mine['population'].to_numpy(), NUM_ORIGIN, rng)
+            start = i * NUM_ORIGIN
+            for shape, count in zip(shapes, counts):
+                if count:
+                    rows = slice(start, start + count)
+                    longitude[rows], latitude[rows] = sample_in_polygon(shape, count, rng,
+                                                                        engine=engine)
+                    start += count
+
+    return pd.DataFrame({'latitude': latitude, 'longitude': longitude,
+                         'zipcode': np.repeat(zipcodes['zip'].to_numpy(), NUM_ORIGIN)})
+
+
+def travel_summary(points_df, columns=('time_to_CBD', 'distance_to_CBD')):
+    '''
+    Mean travel data of every zipcode with its standard error, to judge how
+    many origins are needed for a target precision (the error shrinks with
+    the square root of the number of origins).
+
+    Inputs:
+    points_df: origin points with travel data (see update_travel_data)
+
+    Returns:
+    Pandas dataframe indexed by zipcode with n_origins (routed origins), the
+    means and their standard errors (columns ending in _se). The errors use
+    the simple random sampling formula, which does not credit the
+    stratification or the quasi-random points, so they are conservative
+    '''
+    grouped = points_df.groupby('zipcode')[list(columns)]
+    n = grouped.count()
+    summary = grouped.mean()
+    summary = summary.join((grouped.std(ddof=1) / np.sqrt(n)).add_suffix('_se'))
+    summary.insert(0, 'n_origins', n[columns[0]])
+    return summary
+
+
+def google_token():
+    '''
+    Google token for calling its API, from the non-public constants.py
+    '''
+    from ...constants import GOOGLE_TOKEN
+    return GOOGLE_TOKEN
+
+
+def location_key(location, precision=PRECISION):
+    '''
+    Normalizes a 'lat,lng' string (or a (lat, lng) pair) to fixed decimals,
+    so the same point always gets the same cache key. Other text (e.g. an
+    address) is kept as it is.
+    '''
+    if isinstance(location, str):
+        try:
+            lat, lng = (float(x) for x in location.split(","))
+        except ValueError:
+            return location.strip()
+    else:
+        lat, lng = location
+    fmt = "{:.%df},{:.%df}" % (precision, precision)
+    return fmt.format(round(lat, precision), round(lng, precision))
+
+
+class TokenBucket:
+    '''
+    Thread-safe rate limiter: tokens refill at 'rate' per second up to
+    'capacity', and every request takes one (waiting if there is none).
+    '''
+    def __init__(self, rate=RATE, capacity=BURST):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class TravelCache:
+    '''
+    Travel time and distance by (origin, destination) keys. Elements the API
+    answered without a route are stored with NULL values, so they are not
+    requested again; failed requests are not stored.
+    '''
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS travel (origin TEXT, '
+                          'destination TEXT, time REAL, distance REAL, '
+                          'PRIMARY KEY (origin, destination))')
+        self.conn.commit()
+
+    def get_many(self, origins, destination):
+        '''
+        Returns: dictionary {origin: (time, distance)} of the cached origins
+        '''
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted (origin TEXT PRIMARY KEY)')
+        self.conn.execute('DELETE FROM wanted')
+        self.conn.executemany('INSERT OR IGNORE INTO wanted VALUES (?)',
+                              ((origin,) for origin in origins))
+        rows = self.conn.execute('SELECT t.origin, t.time, t.distance FROM travel t '
+                                 'JOIN wanted w ON t.origin = w.origin '
+                                 'WHERE t.destination = ?', (destination,))
+        return {origin: (t, d) for origin, t, d in rows.fetchall()}
+
+    def put_many(self, destination, items):
+        self.conn.executemany('INSERT OR REPLACE INTO travel VALUES (?, ?, ?, ?)',
+                              ((origin, destination, t, d) for origin, (t, d) in items))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def parse_elements(data, n_origins):
+    '''
+    Reads the (time, distance) of every origin from a Distance Matrix answer
+    with one destination. Elements without a route (e.g. ZERO_RESULTS) get
+    (None, None), recorded as missing values rather than zeros.
+    '''
+    rows = data.get('rows', [])
+    if len(rows) != n_origins:
+        raise ValueError(f"Expected {n_origins} rows, got {len(rows)}")
+    results = []
+    for row in rows:
+        element = row['elements'][0]
+        if element.get('status') == 'OK':
+            results.append((element['duration']['value'], element['distance']['value']))
+        else:
+            results.append((None, None))
+    return results
+
+
+class RetriesExhausted(RuntimeError):
+    '''
+    A batch that kept failing with retryable errors (connection errors,
+    HTTP 429/5xx, RETRY_STATUS answers) after all its retries.
+    '''
+
+
+def fetch_batch(session, origins, destination, bucket, api_key, api_url=API_URL,
+                max_retries=MAX_RETRIES):
+    '''
+    Requests the travel data of a batch of origins to one destination,
+    retrying with exponential backoff on connection errors, HTTP 429/5xx and
+    OVER_QUERY_LIMIT or UNKNOWN_ERROR answers. Any other error (e.g. a
+    REQUEST_DENIED answer for a bad key) is raised at once.
+
+    Returns: list of (time, distance) in the order of origins
+    '''
+    params = {'units': 'imperial', 'origins': '|'.join(origins),
+              'destinations': destination, 'key': api_key}
+    for attempt in range(max_retries + 1):
+        bucket.acquire()
+        try:
+            response = session.get(api_url, params=params, timeout=TIMEOUT)
+            if response.status_code == 429 or response.status_code >= 500:
+                error = requests.HTTPError(f"{response.status_code} from {api_url}")
+            else:
+                response.raise_for_status()
+                data = response.json()
+                if data.get('status') == 'OK':
+                    return parse_elements(data, len(origins))
+                error = RuntimeError(f"Distance Matrix API: {data.get('status')}")
+                if data.get('status') not in RETRY_STATUS:
+                    raise error
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            error = exc
+        if attempt < max_retries:
+            time.sleep(2 ** attempt)
+    raise RetriesExhausted(f"{len(origins)} origins failed after {max_retries} "
+                           f"retries: {error}") from error
+
+
+def travel_times(origins, destination, cache, api_key, api_url=API_URL,
+                 batch_size=MAX_ORIGINS, bucket=None, max_workers=MAX_WORKERS):
+    '''
+    Travel time and distance from every origin to the destination. Origins
+    that are not in the cache are requested in batches, concurrently, and
+    saved to the cache as the batches complete.
+
+    Inputs:
+        origins     : list of 'lat,lng' strings or (lat, lng) pairs
+        destination : 'lat,lng' string (or an address)
+        cache       : TravelCache
+        api_key     : Google token
+        api_url     : Distance Matrix endpoint (e.g. a local stand-in)
+        batch_size  : origins per request
+        bucket      : TokenBucket shared by the requests (default: RATE)
+
+    Returns: numpy arrays time and distance in the order of origins (NaN
+             where the API had no route or the request failed after its
+             retries; failed origins are requested again on the next run)
+
+    Batches that fail after their retries are reported with a warning, and
+    an error is raised if none of them succeeded. Errors that retrying
+    cannot fix (e.g. REQUEST_DENIED) stop the requests and are raised.
+    '''
+    keys = [location_key(origin) for origin in origins]
+    destination = location_key(destination)
+    found = cache.get_many(set(keys), destination)
+    missing = sorted(set(keys) - set(found))
+    batches = [missing[i:i + batch_size] for i in range(0, len(missing), batch_size)]
+    bucket = bucket if bucket is not None else TokenBucket()
+    failed = []
+
+    with requests.Session() as session:
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(fetch_batch, session, batch, destination, bucket,
+                                   api_key, api_url): batch for batch in batches}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        results = future.result()
+                    except RetriesExhausted as exc:
+                        failed.append((futures[future], exc))
+                        continue
+                    items = list(zip(futures[future], results))
+                    found.update(items)
+                    cache.put_many(destination, items)
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    if failed:
+        origins_failed = sum(len(batch) for batch, _ in failed)
+        if len(failed) == len(batches):
+            raise RuntimeError(f"All {len(batches)} Distance Matrix batches failed") \
+                from failed[-1][1]
+        warnings.warn(f"{len(failed)} of {len(batches)} Distance Matrix batches "
+                      f"({origins_failed} origins) failed and are left missing; "
+                      f"last error: {failed[-1][1]}")
+
+    values = np.array([found.get(key, (None, None)) for key in keys], dtype=float)
+    values = values.reshape(len(keys), 2)
+    return values[:, 0], values[:, 1]
 
 
 def get_time_distance(origin, DESTINATION):
     '''
     API Call to obtain travel data from Google Distance Matrix API.
 
-    Helper function: 
-    --used in update_travel_data
-
     Inputs: 
     origin: starting coordinates
     DESTINATION: ending coordinates
@@ -76,43 +447,54 @@ def get_time_distance(origin, DESTINATION):
     Returns:
     time: travel time
     distance: travel distance 
+    (NaN when the API returns no route)
     '''
-    url = f"https://maps.googleapis.com/maps/api/distancematrix/json?units=imperial&origins={origin}&destinations={DESTINATION}&key={API_KEY}"
-    response = requests.get(url)
-    data = response.json()
-
-    # Key Error Handling: If API returns nothing, 
-    # record time, distance as 0 representing missing values
-    try:
-        time = data['rows'][0]['elements'][0]['duration']['value']
-        distance = data['rows'][0]['elements'][0]['distance']['value']
-    except KeyError:
-        time, distance = 0, 0
+    with requests.Session() as session:
+        results = fetch_batch(session, [location_key(origin)], location_key(DESTINATION),
+                              TokenBucket(), google_token())
+    time_, distance = results[0]
+    return (np.nan if time_ is None else time_), (np.nan if distance is None else distance)
 
-    return time, distance
 
-def update_travel_data(DESTINATION, NUM_ORIGIN):
+def update_travel_data(DESTINATION, NUM_ORIGIN, api_url=API_URL, cache_path=CACHE_PATH,
+                       output_path=OUTPUT_PATH, api_key=None, graph_path=None,
+                       sampling="uniform", seed=SEED, summary_path=None):
     '''
     Updates each observation in pandas df for DESTINATION (CBD)
 
     Inputs: 
     DESTINATION: destination either in text, or in (lat, lng)
+    NUM_ORIGIN: number of random origin points in a zipcode boundary
+    api_url, cache_path, output_path: endpoint, SQLite cache and csv file
+    api_key: Google token (default: GOOGLE_TOKEN of constants.py)
+    graph_path: GraphML street graph to route offline (see road_network.py)
+                instead of calling the API; DESTINATION must be 'lat,lng'
+    sampling, seed: how the origins are drawn (see define_origin_coor)
+    summary_path: optional csv for the means and standard errors of every
+                  zipcode (see travel_summary)
 
     Function:
-    Appends travel data (time_to_cbd, distance_to_cbd) into the Pandas dataframe
+    Appends travel data (time_to_cbd, distance_to_cbd) into the Pandas dataframe.
+    Origins without travel data are left missing (NaN). Nothing is written
+    if the API refuses the requests or no batch succeeds (see travel_times)
     '''
-    random.seed(SEED)
-    points_df = define_origin_coor(NUM_ORIGIN)
-
-    points_df['time_to_CBD'] = None
-    points_df['distance_to_CBD'] = None
-    
-    for i, row in points_df.iterrows():
-        origin = f"{row['latitude']},{row['longitude']}"
-        time, distance = get_time_distance(origin, DESTINATION)
-        points_df.at[i, 'time_to_CBD'] = time
-        points_df.at[i, 'distance_to_CBD'] = distance
-        sleep(randint(1,4))
+    points_df = define_origin_coor(NUM_ORIGIN, seed, sampling)
 
-    points_df.to_csv("deprivation_evictions/data_bases/raw_data/google_distancematrix.csv")
+    if graph_path is not None:
+        from .road_network import offline_travel_data
+        time_, distance = offline_travel_data(points_df, DESTINATION, graph_path)
+    else:
+        origins = list(zip(points_df['latitude'], points_df['longitude']))
+        cache = TravelCache(cache_path)
+        try:
+            time_, distance = travel_times(origins, DESTINATION, cache,
+                                           api_key if api_key is not None else google_token(),
+                                           api_url)
+        finally:
+            cache.close()
+    points_df['time_to_CBD'] = time_
+    points_df['distance_to_CBD'] = distance
 
+    points_df.to_csv(output_path)
+    if summary_path is not None:
+        travel_summary(points_df).to_csv(summary_path)
@@ -1,45 +1,244 @@
-# Retrieve 2019 data of the American Census Survey
+# Retrieve data of the American Census Survey
 # Written by: Stephania Tello Zamudio
+# Only the zip codes (ZCTAs) of Illinois that are needed are requested, one
+# request per ACS vintage (run concurrently). Every answer is kept in a local
+# cache keyed by vintage, table and variable set, and the result is written
+# as a typed Parquet file. Years whose vintage is not published yet get the
+# latest published one.
 
-import censusdata
+import hashlib
+import json
+import os
+import tempfile
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
 
-def pull_acs_data():
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+
+CENSUS_URL = "https://api.census.gov/data"
+SUBJECT_TABLE = "acs/acs5/subject"
+DETAILED_TABLE = "acs/acs5"
+OUTPUT_PATH = 'deprivation_evictions/data_bases/raw_data/acs_data.parquet'
+CACHE_DIR = 'deprivation_evictions/data_bases/raw_data/cache/acs/'
+STATE = '17' # Illinois
+COUNTY = '031' # Cook County
+# ZCTAs are nested in states up to the 2019 vintage only
+LAST_STATE_ZCTA_VINTAGE = 2019
+# Earlier vintages tried for a year whose vintage is not published
+MAX_VINTAGE_LAG = 3
+# The API accepts at most 50 variables per request (NAME included)
+MAX_VARIABLES = 48
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+TIMEOUT = 60
+# Annotation values (e.g. -666666666: not available) are below this
+MISSING_BELOW = -100000000
+
+# Subject table variables and their column names
+ACS_VARIABLES = {
+    'S0601_C01_047E': 'hh_median_income', 'S1901_C01_013E': 'hh_mean_income',
+    'S1501_C02_009E': 'perc_educ_highschool', 'S1501_C02_012E': 'perc_educ_bachelor',
+    'S2301_C04_001E': 'unemployment_rate', 'S0101_C01_001E': 'total_population',
+    'S0101_C01_002E': 'age_under_5', 'S0101_C01_003E': 'age_5_to_9',
+    'S0101_C01_004E': 'age_10_to_14', 'S0101_C01_005E': 'age_15_to_19',
+    'S0101_C01_006E': 'age_20_to_24', 'S0101_C01_007E': 'age_25_to_29',
+    'S0101_C01_008E': 'age_30_to_34', 'S0101_C01_009E': 'age_35_to_39',
+    'S0101_C01_010E': 'age_40_to_44', 'S0101_C01_011E': 'age_45_to_49',
+    'S0101_C01_012E': 'age_50_to_54', 'S0101_C01_013E': 'age_55_to_59',
+    'S0101_C01_014E': 'age_60_to_64', 'S0101_C01_015E': 'age_65_to_69',
+    'S0101_C01_016E': 'age_70_to_74', 'S0101_C01_017E': 'age_75_to_79',
+    'S0101_C01_018E': 'age_80_to_84', 'S0101_C01_019E': 'age_85_up',
+    'S0601_C01_014E': 'pop_white', 'S0601_C01_015E': 'pop_black',
+    'S0601_C01_016E': 'pop_native', 'S0601_C01_017E': 'pop_asian',
+    'S0601_C01_021E': 'pop_latino'}
+
+
+def zcta_geography(vintage, zip_codes=None):
+    '''
+    Geography parameters of a ZCTA request: the given zip codes, or every
+    ZCTA of Illinois (only for the vintages where ZCTAs are nested in states).
+    '''
+    zctas = '*' if zip_codes is None else ','.join(sorted(str(z) for z in zip_codes))
+    geography = {'for': 'zip code tabulation area:' + zctas}
+    if vintage <= LAST_STATE_ZCTA_VINTAGE:
+        geography['in'] = 'state:' + STATE
+    elif zip_codes is None:
+        raise ValueError(f"ZCTAs are not nested in states in the {vintage} ACS; "
+                         "list the zip codes to pull")
+    return geography
+
+
+def cache_file(cache_dir, vintage, table, variables, geography):
+    '''
+    Path of the cached answer of a request, keyed by vintage, table and
+    variable set (and geography).
+    '''
+    key = json.dumps([sorted(variables), geography], sort_keys=True)
+    digest = hashlib.sha256(key.encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{vintage}_{table.replace('/', '-')}_{digest}.json")
+
+
+def fetch_census(session, vintage, table, variables, geography, base_url=CENSUS_URL,
+                 cache_dir=CACHE_DIR, api_key=None, max_retries=MAX_RETRIES):
+    '''
+    Requests some variables of one table and vintage from the Census API,
+    or reads the answer from the cache. Connection errors, throttling (429)
+    and server errors are retried with exponential backoff.
+
+    Returns: list of rows (lists of strings), the first one with the names
+    '''
+    path = cache_file(cache_dir, vintage, table, variables, geography)
+    if os.path.exists(path):
+        with open(path, 'r') as fp:
+            return json.load(fp)
+
+    url = f"{base_url.rstrip('/')}/{vintage}/{table}"
+    params = dict(geography, get=','.join(variables))
+    if api_key:
+        params['key'] = api_key
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.get(url, params=params, timeout=TIMEOUT)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                if response.status_code == 204 or not response.content:
+                    raise ValueError(f"No data for {url} {geography}")
+                rows = response.json()
+                break
+            error = requests.HTTPError(f"{response.status_code} for {response.url}")
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            error = exc
+        if attempt == max_retries:
+            raise error
+        time.sleep(2 ** attempt)
+
+    # Written to a temporary file and renamed, so it is never half written;
+    # years falling back to the same vintage may write the same answer at
+    # once, so every writer has its own temporary file
+    os.makedirs(cache_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', dir=cache_dir, suffix='.tmp',
+                                     delete=False) as fp:
+        json.dump(rows, fp)
+    os.replace(fp.name, path)
+    return rows
+
+
+def fetch_table(session, vintage, table, variables, geography, keys, **options):
+    '''
+    Requests any number of variables, MAX_VARIABLES at a time, and joins the
+    answers on the geography columns (keys).
+
+    Returns: dataframe of strings with the key and variable columns
+    '''
+    frame = None
+    for i in range(0, len(variables), MAX_VARIABLES):
+        rows = fetch_census(session, vintage, table, variables[i:i + MAX_VARIABLES],
+                            geography, **options)
+        part = pd.DataFrame(rows[1:], columns=rows[0])
+        frame = part if frame is None else frame.merge(part, on=keys)
+    return frame[keys + list(variables)]
+
+
+def to_numeric(values):
+    '''
+    Converts API values to floats, with the annotation values as missing.
+    '''
+    values = pd.to_numeric(values, errors='coerce').astype(float)
+    return values.where(values > MISSING_BELOW)
+
+
+def acs_vintage(session, vintage, zip_codes=None, **options):
+    '''
+    ACS subject table variables of the zip codes (ZCTAs) for one vintage.
+
+    Returns: dataframe with the ACS_VARIABLES columns, zip_code and year
+    '''
+    key = 'zip code tabulation area'
+    data = fetch_table(session, vintage, SUBJECT_TABLE, list(ACS_VARIABLES),
+                       zcta_geography(vintage, zip_codes), [key], **options)
+    acs = pd.DataFrame({name: to_numeric(data[var]) for var, name in ACS_VARIABLES.items()})
+    acs['zip_code'] = data[key].astype('string')
+    acs['year'] = vintage
+    return acs.sort_values('zip_code').reset_index(drop=True)
+
+
+def acs_year(session, year, zip_codes=None, **options):
+    '''
+    ACS data for one year: its vintage or, while that vintage is not
+    published (the API answers 404), the latest earlier one, with a warning.
+    The rows keep the requested year.
+
+    Returns: dataframe with the ACS_VARIABLES columns, zip_code and year
+    '''
+    for vintage in range(year, year - MAX_VINTAGE_LAG - 1, -1):
+        try:
+            acs = acs_vintage(session, vintage, zip_codes, **options)
+        except requests.HTTPError as exc:
+            if exc.response is None or exc.response.status_code != 404:
+                raise
+            continue
+        if vintage != year:
+            warnings.warn(f"The {year} ACS is not published; using the {vintage} vintage")
+            acs['year'] = year
+        return acs
+    raise ValueError(f"No ACS vintage from {year - MAX_VINTAGE_LAG} to {year} is published")
+
+
+def pull_acs_data(years = (2019,), zip_codes = None, base_url = CENSUS_URL,
+                  output_path = OUTPUT_PATH, cache_dir = CACHE_DIR, api_key = None,
+                  max_workers = MAX_WORKERS):
+    """
+    Retrieves ACS 5-year data of the American Census Survey
+        from the US Census API for zip codes of Illinois
+
+    Input:
+        years (int or list of int): ACS vintages to pull (fetched concurrently);
+            a year whose vintage is not published gets the latest one
+            (see acs_year)
+        zip_codes (list of str): zip codes to pull (e.g. the ZIP_CODES of
+            clean_db); None for every ZCTA of Illinois (vintages up to 2019)
+        base_url (str): Census API (e.g. a local stand-in server)
+        output_path, cache_dir (str): Parquet output and cache of the answers
+        api_key (str): optional Census API key
+
+    Returns: None, writes the pulled data as a Parquet file in the provided
+            path, one row per zip code and year with typed columns.
+    """
+    years = [years] if isinstance(years, int) else sorted(years)
+    options = {'base_url': base_url, 'cache_dir': cache_dir, 'api_key': api_key}
+
+    with requests.Session() as session:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            frames = list(pool.map(lambda year: acs_year(session, year, zip_codes,
+                                                         **options), years))
+
+    acs_var = pd.concat(frames, ignore_index=True)
+    pq.write_table(pa.Table.from_pandas(acs_var, preserve_index=False), output_path)
+
+
+def pull_tract_population(year = 2019, base_url = CENSUS_URL,
+                          output_path = 'deprivation_evictions/data_bases/raw_data/tract_population.csv',
+                          cache_dir = CACHE_DIR, api_key = None):
     """
-    Retrieves 2019 data of the American Census Survey
-        from the US Census API
+    Retrieves the total population (table B01003) of the census tracts of
+    Cook County, used to sample travel origins by population (see
+    google_dist.define_origin_coor).
 
-    Input: None
+    Input: year (int): ACS 5-year vintage
 
-    Returns: None, writes the pulled data as a csv file in the provided path at
-            zip code level demographics for Illinois.
+    Returns: None, writes the pulled data as a csv file (geoid10, population)
+            in the provided path.
     """
+    keys = ['state', 'county', 'tract']
+    with requests.Session() as session:
+        data = fetch_table(session, year, DETAILED_TABLE, ['B01003_001E'],
+                           {'for': 'tract:*', 'in': f'state:{STATE} county:{COUNTY}'},
+                           keys, base_url=base_url, cache_dir=cache_dir, api_key=api_key)
 
-    acs_var = censusdata.download('acs5/subject', 2019, censusdata.censusgeo(
-        [('zip%20code%20tabulation%20area', '*')]),
-        ['S0601_C01_047E', 'S1901_C01_013E', 'S1501_C02_009E', 
-         'S1501_C02_012E', 'S2301_C04_001E', 'S0101_C01_001E',
-         'S0101_C01_002E', 'S0101_C01_003E', 'S0101_C01_004E',
-         'S0101_C01_005E', 'S0101_C01_006E', 'S0101_C01_007E',
-         'S0101_C01_008E', 'S0101_C01_009E', 'S0101_C01_010E',
-         'S0101_C01_011E', 'S0101_C01_012E', 'S0101_C01_013E',
-         'S0101_C01_014E', 'S0101_C01_015E', 'S0101_C01_016E',
-         'S0101_C01_017E', 'S0101_C01_018E', 'S0101_C01_019E',
-         'S0601_C01_014E', 'S0601_C01_015E', 'S0601_C01_016E',
-         'S0601_C01_017E', 'S0601_C01_021E', 'STATE', 
-         'ZCTA'])
-    
-    acs_var = acs_var[acs_var.STATE == 17]
-    acs_var = acs_var.drop('STATE', axis=1)
-    
-    acs_var.columns = ['hh_median_income', 'hh_mean_income', 'perc_educ_highschool',
-                        'perc_educ_bachelor', 'unemployment_rate', 'total_population',
-                        'age_under_5', 'age_5_to_9', 'age_10_to_14',
-                        'age_15_to_19', 'age_20_to_24', 'age_25_to_29',
-                        'age_30_to_34', 'age_35_to_39', 'age_40_to_44',
-                        'age_45_to_49', 'age_50_to_54', 'age_55_to_59',
-                        'age_60_to_64', 'age_65_to_69', 'age_70_to_74',
-                        'age_75_to_79', 'age_80_to_84', 'age_85_up',
-                        'pop_white', 'pop_black', 'pop_native',
-                        'pop_asian', 'pop_latino', 'zip_code']
-
-    acs_var.to_csv('deprivation_evictions/data_bases/raw_data/acs_data.csv')
\ No newline at end of file
+    tract_pop = pd.DataFrame({'geoid10': data['state'] + data['county'] + data['tract'],
+                              'population': to_numeric(data['B01003_001E'])})
+    tract_pop.to_csv(output_path, index=False)
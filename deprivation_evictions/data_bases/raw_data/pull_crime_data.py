@@ -1,11 +1,45 @@
 # Pull data on crime from the Chicago data API
 # Created by Andrew Dunn
+# download_crime_data pages through the SODA API one month at a time (months
+# are fetched concurrently), keeps only the columns clean_db uses and writes
+# every page as a Parquet file as soon as it arrives, with a checkpoint per
+# month so an interrupted download resumes where it stopped.
+
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import pandas as pd
-from sodapy import Socrata
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
+
+SODA_URL = "https://data.cityofchicago.org"
+DATASET = "ijzp-q8t2"
+OUTPUT_DIR = 'deprivation_evictions/data_bases/raw_data/crime_data/'
+# Columns used by clean_db, and their types in the Parquet pages (the API
+# returns every value as a string)
+PAGE_SCHEMA = pa.schema([("id", pa.string()), ("date", pa.string()),
+                         ("primary_type", pa.string()),
+                         ("latitude", pa.float64()), ("longitude", pa.float64())])
+PAGE_SIZE = 50_000
+MAX_WORKERS = 4
+MAX_RETRIES = 3
+TIMEOUT = 60
+CHECKPOINT = "_checkpoint.json"
+
 
-# From a non-public doc of API keys
-from ...constants import API_TOKEN
+def api_token():
+    '''
+    App token from the non-public constants.py, or None (anonymous requests
+    work but are throttled more).
+    '''
+    try:
+        from ...constants import API_TOKEN
+    except ImportError:
+        return None
+    return API_TOKEN
 
 
 def pull_crime_data(year):
@@ -13,18 +47,154 @@ def pull_crime_data(year):
     Retrieves crime data from Chicago Data Portal for a specific year.
     For info on the data: https://data.cityofchicago.org/Public-Safety/Crimes-2001-to-Present/ijzp-q8t2
 
-    Inputs (int): year of data to pull
+    Inputs (int or list of int): year(s) of data to pull
 
     Returns: None, writes the pulled data as a csv file in the provided path.
     '''
+    from sodapy import Socrata
 
     # The APP_TOKEN is saved in our local environment
     # To run this code, you will need to get your own API key info
     # See this page for more info https://dev.socrata.com/docs/app-tokens.html
-    client = Socrata("data.cityofchicago.org", API_TOKEN)
+    client = Socrata("data.cityofchicago.org", api_token())
 
-    data = client.get("ijzp-q8t2", select = '*', where = 'Year = ' + str(year), limit = 1000000)
+    years = [year] if isinstance(year, int) else list(year)
+    where = 'Year in (' + ', '.join(str(y) for y in years) + ')'
+    data = client.get("ijzp-q8t2", select = '*', where = where, limit = 1000000)
 
     # Convert to pd DataFrame and export the file
     results_df = pd.DataFrame.from_records(data)
-    results_df.to_csv('deprivation_evictions/data_bases/raw_data/crime_data.csv')
\ No newline at end of file
+    results_df.to_csv('deprivation_evictions/data_bases/raw_data/crime_data.csv')
+
+
+def month_where(year, month):
+    '''
+    SoQL condition selecting the crimes of one month.
+    '''
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return ("date >= '{}-{:02d}-01T00:00:00' AND date < '{}-{:02d}-01T00:00:00'"
+            .format(year, month, next_year, next_month))
+
+
+def page_table(records):
+    '''
+    Parquet table of a page of API records (missing values become nulls).
+    '''
+    columns = {name: pa.array([r.get(name) for r in records], type=pa.string())
+               for name in PAGE_SCHEMA.names}
+    return pa.table(columns).cast(PAGE_SCHEMA)
+
+
+def fetch_page(session, url, where, offset, limit, token=None,
+               max_retries=MAX_RETRIES):
+    '''
+    Requests one page of a month, retrying with exponential backoff on
+    connection errors, throttling (429) and server errors.
+
+    Returns: list of records (dictionaries)
+    '''
+    params = {"$select": ",".join(PAGE_SCHEMA.names), "$where": where,
+              "$order": ":id", "$limit": limit, "$offset": offset}
+    headers = {"X-App-Token": token} if token else {}
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.get(url, params=params, headers=headers, timeout=TIMEOUT)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                return response.json()
+            error = requests.HTTPError("{} for {}".format(response.status_code, response.url))
+        except (requests.ConnectionError, requests.Timeout) as exc:
+            error = exc
+        if attempt < max_retries:
+            time.sleep(2 ** attempt)
+    raise error
+
+
+def read_checkpoint(month_dir):
+    path = os.path.join(month_dir, CHECKPOINT)
+    if not os.path.exists(path):
+        return {"offset": 0, "done": False}
+    with open(path, "r") as fp:
+        return json.load(fp)
+
+
+def write_checkpoint(month_dir, state):
+    # Written to a temporary file and renamed, so it is never half written
+    path = os.path.join(month_dir, CHECKPOINT)
+    with open(path + ".tmp", "w") as fp:
+        json.dump(state, fp)
+    os.replace(path + ".tmp", path)
+
+
+def download_month(year, month, output_dir, url, token=None, page_size=PAGE_SIZE):
+    '''
+    Downloads one month page by page into output_dir/YYYY-MM/. Page files are
+    named after their offset (part-000000000.parquet, ...), and the checkpoint
+    holds the offset of the next page and whether the month is complete.
+
+    Returns: number of records of the month
+    '''
+    month_dir = os.path.join(output_dir, "{}-{:02d}".format(year, month))
+    os.makedirs(month_dir, exist_ok=True)
+    state = read_checkpoint(month_dir)
+    if state["done"]:
+        return state["offset"]
+
+    # Pages written after the last checkpoint are fetched again
+    for name in os.listdir(month_dir):
+        if name.startswith("part-") and int(name[5:14]) >= state["offset"]:
+            os.remove(os.path.join(month_dir, name))
+
+    where = month_where(year, month)
+    offset = state["offset"]
+    with requests.Session() as session:
+        while True:
+            records = fetch_page(session, url, where, offset, page_size, token)
+            if records:
+                path = os.path.join(month_dir, "part-{:09d}.parquet".format(offset))
+                pq.write_table(page_table(records), path + ".tmp")
+                os.replace(path + ".tmp", path)
+            offset += len(records)
+            done = len(records) < page_size
+            write_checkpoint(month_dir, {"offset": offset, "done": done})
+            if done:
+                return offset
+
+
+def download_crime_data(years, output_dir=OUTPUT_DIR, base_url=SODA_URL,
+                        app_token=None, page_size=PAGE_SIZE, max_workers=MAX_WORKERS):
+    '''
+    Downloads the crimes of the given years from the Chicago Data Portal
+    (SODA API), one partition per month. Running it again after an
+    interruption only fetches the missing pages; complete months are
+    skipped. The pages are read by the crime cache of clean_db
+    (clean_data/raw_cache.py) in place of crime_data.csv.
+
+    Inputs:
+        years       : int or list of int
+        output_dir  : folder of the partitions (one subfolder per month)
+        base_url    : scheme and domain of the API (e.g. a local stand-in)
+        app_token   : Socrata app token (default: API_TOKEN of constants.py)
+        page_size   : records per request
+        max_workers : months downloaded at the same time
+
+    Returns: dictionary {(year, month): number of records}
+    '''
+    years = [years] if isinstance(years, int) else list(years)
+    token = app_token if app_token is not None else api_token()
+    url = "{}/resource/{}.json".format(base_url.rstrip("/"), DATASET)
+    months = [(year, month) for year in years for month in range(1, 13)]
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(download_month, year, month, output_dir, url,
+                                   token, page_size): (year, month)
+                   for year, month in months}
+        try:
+            for future in as_completed(futures):
+                counts[futures[future]] = future.result()
+        finally:
+            # Months not started yet are left for the next run
+            for future in futures:
+                future.cancel()
+    return dict(sorted(counts.items()))
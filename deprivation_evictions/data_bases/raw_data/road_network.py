@@ -0,0 +1,168 @@
+# Offline travel times to the CBD on a street network
+# A street graph (GraphML, as exported by OSMnx) is loaded into a sparse
+# matrix. Origins are snapped to their nearest node with a k-d tree, and a
+# single shortest-path tree computed backwards from the destination answers
+# every origin at once.
+
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+
+# Small synthetic street grid over Chicago (for offline runs and checks)
+TEST_GRAPH = "deprivation_evictions/data_bases/raw_data/test_graph.graphml"
+GRAPHML_NS = "{http://graphml.graphdrawing.org/xmlns}"
+EARTH_RADIUS = 6_371_000 # meters
+DEFAULT_SPEED_KPH = 40 # for edges without travel_time or speed_kph
+MAX_SNAP = 2_000 # meters; origins farther from every node are not routed
+MIN_TIME = 1e-3 # seconds; zero weights would be dropped from the sparse graph
+
+
+def read_graphml(path):
+    '''
+    Reads the nodes and edges of a GraphML street graph. Nodes need the x
+    (longitude) and y (latitude) attributes and edges a length (meters);
+    the travel time (seconds) is taken from travel_time, or computed from
+    speed_kph or DEFAULT_SPEED_KPH. Undirected graphs get both directions.
+
+    Returns: nodes dataframe (node, latitude, longitude) and edges dataframe
+             (source, target, length, travel_time)
+    '''
+    root = ET.parse(path).getroot()
+    keys = {key.get("id"): key.get("attr.name") for key in root.iter(GRAPHML_NS + "key")}
+    graph = root.find(GRAPHML_NS + "graph")
+
+    def attributes(element):
+        return {keys.get(data.get("key")): data.text
+                for data in element.iter(GRAPHML_NS + "data")}
+
+    nodes = []
+    for node in graph.iter(GRAPHML_NS + "node"):
+        attrs = attributes(node)
+        nodes.append((node.get("id"), float(attrs["y"]), float(attrs["x"])))
+    nodes = pd.DataFrame(nodes, columns=["node", "latitude", "longitude"])
+
+    edges = []
+    for edge in graph.iter(GRAPHML_NS + "edge"):
+        attrs = attributes(edge)
+        edges.append((edge.get("source"), edge.get("target"), attrs.get("length"),
+                      attrs.get("travel_time"), attrs.get("speed_kph")))
+    edges = pd.DataFrame(edges, columns=["source", "target", "length",
+                                         "travel_time", "speed_kph"])
+    for col in ["length", "travel_time", "speed_kph"]:
+        edges[col] = pd.to_numeric(edges[col])
+    speed = edges["speed_kph"].fillna(DEFAULT_SPEED_KPH) / 3.6
+    edges["travel_time"] = edges["travel_time"].fillna(edges["length"] / speed)
+    edges = edges.drop(columns="speed_kph")
+
+    if graph.get("edgedefault") == "undirected":
+        reverse = edges.rename(columns={"source": "target", "target": "source"})
+        edges = pd.concat([edges, reverse], ignore_index=True)
+    return nodes, edges
+
+
+class RoadNetwork:
+    '''
+    Directed street graph with travel times (seconds) and lengths (meters).
+    Parallel edges keep the fastest one.
+    '''
+    def __init__(self, nodes, edges):
+        self.nodes = nodes.reset_index(drop=True)
+        n = len(self.nodes)
+        self.lat0 = np.radians(self.nodes["latitude"].mean())
+        self.tree = cKDTree(self.project(self.nodes["latitude"], self.nodes["longitude"]))
+
+        index = pd.Index(self.nodes["node"])
+        edges = edges.sort_values("travel_time", kind="stable")
+        edges = edges.drop_duplicates(["source", "target"])
+        u = index.get_indexer(edges["source"])
+        v = index.get_indexer(edges["target"])
+        self.time = sparse.csr_matrix(
+            (np.maximum(edges["travel_time"].to_numpy(float), MIN_TIME), (u, v)), shape=(n, n))
+        self.length = sparse.csr_matrix((edges["length"].to_numpy(float), (u, v)), shape=(n, n))
+
+    @classmethod
+    def from_graphml(cls, path):
+        return cls(*read_graphml(path))
+
+    def project(self, lat, lon):
+        '''
+        Equirectangular projection around the graph (meters), accurate at
+        the scale of a city for nearest node searches.
+        '''
+        lat = np.radians(np.asarray(lat, dtype=float))
+        lon = np.radians(np.asarray(lon, dtype=float))
+        return np.column_stack([EARTH_RADIUS * lon * np.cos(self.lat0), EARTH_RADIUS * lat])
+
+    def snap(self, lat, lon):
+        '''
+        Returns: index of the nearest node of every point and the distance
+                 to it (meters)
+        '''
+        distance, node = self.tree.query(self.project(lat, lon))
+        return node, distance
+
+    def tree_to(self, node):
+        '''
+        Fastest paths from every node to one node: Dijkstra from it on the
+        reversed graph.
+
+        Returns: arrays of travel time and length (inf when there is no path)
+                 of the fastest path of every node
+        '''
+        time, pred = dijkstra(self.time.T.tocsr(), directed=True, indices=node,
+                              return_predecessors=True)
+        # pred[i] is the next node on the way from i; the length of the path
+        # adds up the edges along the tree, by pointer jumping
+        has_next = pred >= 0
+        length = np.where(np.isfinite(time), 0.0, np.inf)
+        length[has_next] = np.asarray(self.length[np.flatnonzero(has_next),
+                                                  pred[has_next]]).ravel()
+        jump = np.where(has_next, pred, -1)
+        while (jump >= 0).any():
+            active = jump >= 0
+            length[active] = length[active] + length[jump[active]]
+            jump = np.where(active, jump[np.maximum(jump, 0)], -1)
+        return time, length
+
+    def travel_to(self, lat, lon, destination, max_snap=MAX_SNAP):
+        '''
+        Travel time (seconds) and distance (meters) from every point to the
+        destination along the fastest path between their nearest nodes.
+
+        Inputs:
+            lat, lon    : arrays of origin coordinates
+            destination : (lat, lon) of the destination
+            max_snap    : origins farther than this from every node (meters)
+                          are left missing
+
+        Returns: arrays time and distance (NaN without a path)
+        '''
+        dest_node, _ = self.snap([destination[0]], [destination[1]])
+        times, lengths = self.tree_to(dest_node[0])
+        node, snapped = self.snap(lat, lon)
+        time, distance = times[node], lengths[node]
+        missing = ~np.isfinite(time) | (snapped > max_snap)
+        return np.where(missing, np.nan, time), np.where(missing, np.nan, distance)
+
+
+def offline_travel_data(points_df, DESTINATION, graph_path=TEST_GRAPH, max_snap=MAX_SNAP):
+    '''
+    Travel data of the origin points computed on a street graph instead of
+    the Distance Matrix API.
+
+    Inputs:
+    points_df: dataframe of origins (latitude, longitude, zipcode)
+    DESTINATION: destination as 'lat,lng'
+    graph_path: GraphML street graph
+
+    Returns:
+    time_to_CBD, distance_to_CBD: arrays in the order of points_df
+    '''
+    network = RoadNetwork.from_graphml(graph_path)
+    destination = tuple(float(x) for x in DESTINATION.split(","))
+    return network.travel_to(points_df["latitude"], points_df["longitude"],
+                             destination, max_snap)
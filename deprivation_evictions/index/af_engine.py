@@ -0,0 +1,62 @@
+# Vectorized engine for the AF (Alkire-Foster) deprivation measures
+# Works on plain float arrays so it can be reused per geography and per year
+
+import numpy as np
+
+DEFAULT_ALPHAS = (1, 2)
+
+
+def af_measures(values, thresholds, k, alphas=DEFAULT_ALPHAS):
+    '''
+    Computes the censored deprivation matrix, the gap matrices and the
+    headline ratios of the AF method in one broadcasted computation.
+
+    Inputs:
+        values     : (n, d) array with the indicator values of n units
+        thresholds : (d,) array of deprivation cutoffs, or (..., d) to
+                     evaluate several threshold vectors at once
+        k          : fixed cutoff, scalar or an array broadcastable to the
+                     leading dimensions of thresholds
+        alphas     : powers of the gap matrices to compute (alpha=0, the
+                     censored deprivation matrix, is always included)
+
+    Returns: a dictionary with
+        'y'    : (..., n, d) censored deprivation matrix (bool)
+        'gaps' : {alpha: (..., n, d) matrix g^alpha(k)}
+        'm'    : {alpha: (...) ratio M_alpha}, so m[0] is M0, m[1] is M1...
+    '''
+    x = np.asarray(values, dtype=float)
+    z = np.asarray(thresholds, dtype=float)[..., None, :]
+    k = np.asarray(k, dtype=float)[..., None, None]
+
+    # Matrix Y: a unit is deprived in a dimension if it reaches the cutoff.
+    # Units with k or less deprivations are censored (following AF method)
+    y = x >= z
+    y = y & (y.sum(axis=-1, keepdims=True) > k)
+
+    # Normalized gap g1, set to 0 for missing, negative and censored entries
+    with np.errstate(divide='ignore', invalid='ignore'):
+        g1 = (x - z) / z
+    g1 = np.where(y & (g1 > 0), g1, 0.0)
+
+    gaps = {0: y.astype(float), 1: g1}
+    for alpha in alphas:
+        if alpha not in gaps:
+            gaps[alpha] = np.where(y, g1 ** alpha, 0.0)
+
+    return {'y': y, 'gaps': gaps,
+            'm': {alpha: headline_ratio(mat) for alpha, mat in gaps.items()}}
+
+
+def headline_ratio(mat):
+    '''
+    Averages a gap matrix over the units with at least one non-zero entry
+    and over all dimensions (M0 for g0, M1 for g1, M2 for g2).
+
+    Input: (..., n, d) gap matrix
+    Returns: (...) array of ratios (nan if no unit is deprived)
+    '''
+    num_non_zero_rows = (mat != 0).any(axis=-1).sum(axis=-1)
+    denominator = num_non_zero_rows * mat.shape[-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return mat.sum(axis=(-2, -1)) / denominator
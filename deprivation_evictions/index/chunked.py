@@ -0,0 +1,196 @@
+# Out-of-core computation of the deprivation index (census tracts, block
+# groups...). Partitioned Parquet input is streamed chunk by chunk, so memory
+# is bounded by the chunk size regardless of the size of the geography.
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from .af_engine import af_measures
+from .weights import correlation_matrix, fit_factors
+
+CHUNK_ROWS = 100_000
+
+
+class RunningMoments:
+    '''
+    Streaming column means and variances (and optionally the covariance
+    matrix), combined chunk by chunk with the pairwise update of Chan et al.
+    Missing values are skipped column by column, as in pandas.
+    '''
+    def __init__(self, d, covariance=False):
+        self.count = np.zeros(d)
+        self.mean = np.zeros(d)
+        self.m2 = np.zeros(d)
+        self.comoment = np.zeros((d, d)) if covariance else None
+
+    def update(self, x):
+        count_b = (~np.isnan(x)).sum(axis=0)
+        if not count_b.any():
+            return
+        with np.errstate(invalid='ignore'):
+            mean_b = np.nanmean(x, axis=0)
+        mean_b = np.nan_to_num(mean_b)
+        centered = np.where(np.isnan(x), 0.0, x - mean_b)
+
+        total = self.count + count_b
+        delta = mean_b - self.mean
+        share = np.divide(count_b, total, out=np.zeros_like(delta), where=total > 0)
+        correction = delta ** 2 * self.count * share
+
+        if self.comoment is not None:
+            # Covariances assume complete rows (no missing values)
+            n_a, n_b = self.count[0], count_b[0]
+            self.comoment += (centered.T @ centered
+                              + np.outer(delta, delta) * n_a * n_b / (n_a + n_b))
+        self.m2 += (centered ** 2).sum(axis=0) + correction
+        self.mean += delta * share
+        self.count = total
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    @property
+    def corr(self):
+        return correlation_matrix(self.comoment / (self.count[0] - 1))
+
+
+def read_chunks(source, columns=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Streams a Parquet file or a (hive) partitioned Parquet directory.
+
+    Yields: one dataframe per chunk of at most chunk_rows rows
+    '''
+    dataset = ds.dataset(source, format='parquet', partitioning='hive')
+    for batch in dataset.to_batches(columns=columns, batch_size=chunk_rows):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def indicator_values(chunk, indicators):
+    '''
+    Computes the intermediate ratios of a chunk (as compute_ratios) and
+    returns its (rows x indicators) matrix.
+    '''
+    if 'RTI_ratio' in indicators and 'RTI_ratio' not in chunk:
+        chunk['RTI_ratio'] = chunk['RentPrice'] / (chunk['hh_median_income'] / 12)
+    return chunk[indicators].to_numpy(dtype=float)
+
+
+def input_columns(source, indicators):
+    '''
+    Columns to read in the reduction passes: the indicators, or the inputs
+    of the ratios that are computed on the fly.
+    '''
+    available = ds.dataset(source, format='parquet', partitioning='hive').schema.names
+    columns = []
+    for ind in indicators:
+        if ind == 'RTI_ratio' and ind not in available:
+            columns += ['RentPrice', 'hh_median_income']
+        else:
+            columns.append(ind)
+    return columns
+
+
+def reduce_statistics(source, thresholds, k, chunk_rows=CHUNK_ROWS):
+    '''
+    Reduction pass over the whole input.
+
+    Returns: dictionary with the means and stds of the indicators (for the
+             normalized values), the correlation matrix of g1 (for the
+             factor weights), the min/max of g1_sum and the ratios M0, M1, M2
+    '''
+    indicators = list(thresholds.keys())
+    d = len(indicators)
+    raw = RunningMoments(d)
+    gaps = RunningMoments(d, covariance=True)
+    g1_sum_min, g1_sum_max = np.inf, -np.inf
+    m_sums, m_rows = np.zeros(3), np.zeros(3)
+
+    for chunk in read_chunks(source, input_columns(source, indicators), chunk_rows):
+        values = indicator_values(chunk, indicators)
+        raw.update(values)
+
+        af = af_measures(values, list(thresholds.values()), k)
+        g1 = af['gaps'][1]
+        gaps.update(g1)
+        g1_sum = g1.sum(axis=1)
+        g1_sum_min = min(g1_sum_min, g1_sum.min())
+        g1_sum_max = max(g1_sum_max, g1_sum.max())
+        for alpha in range(3):
+            m_sums[alpha] += af['gaps'][alpha].sum()
+            m_rows[alpha] += (af['gaps'][alpha] != 0).any(axis=1).sum()
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = m_sums / (m_rows * d)
+    return {'mean': raw.mean, 'std': raw.std, 'g1_corr': gaps.corr,
+            'g1_sum_min': g1_sum_min, 'g1_sum_max': g1_sum_max,
+            'm': dict(zip(['M0', 'M1', 'M2'], ratios))}
+
+
+def wdi_range(source, thresholds, k, weights, chunk_rows=CHUNK_ROWS):
+    '''
+    Reduction pass computing the min/max of the weighted index.
+    '''
+    indicators = list(thresholds.keys())
+    wdi_min, wdi_max = np.inf, -np.inf
+    for chunk in read_chunks(source, input_columns(source, indicators), chunk_rows):
+        af = af_measures(indicator_values(chunk, indicators),
+                         list(thresholds.values()), k)
+        wdi = af['gaps'][1] @ weights
+        wdi_min, wdi_max = min(wdi_min, wdi.min()), max(wdi_max, wdi.max())
+    return wdi_min, wdi_max
+
+
+def extend_chunks(source, output_dir, thresholds, k, n_comp, rotate_fn,
+                  weights=None, chunk_rows=CHUNK_ROWS):
+    '''
+    Out-of-core version of MultiDimensionalDeprivation.extend_data(). The
+    input must already contain the indicators (or RentPrice and
+    hh_median_income for RTI_ratio), e.g. travel times merged per unit.
+
+    Inputs:
+        source     : Parquet file or partitioned directory, one row per unit
+        output_dir : directory where one Parquet part per chunk is written
+        weights    : (d,) aggregated factor weights. If None they are fitted
+                     on the correlation matrix of g1 from the reduction pass
+    Returns: the global statistics of the reduction pass (see
+             reduce_statistics), with the weights and wdi min/max
+    '''
+    indicators = list(thresholds.keys())
+    stats = reduce_statistics(source, thresholds, k, chunk_rows)
+    if weights is None:
+        loadings, _ = fit_factors(stats['g1_corr'], n_comp, rotate_fn)
+        weights = loadings.sum(axis=0)
+    weights = np.asarray(weights, dtype=float)
+    wdi_min, wdi_max = wdi_range(source, thresholds, k, weights, chunk_rows)
+    stats.update(weights=weights, wdi_min=wdi_min, wdi_max=wdi_max)
+
+    os.makedirs(output_dir, exist_ok=True)
+    g1_sum_span = stats['g1_sum_max'] - stats['g1_sum_min']
+    for part, chunk in enumerate(read_chunks(source, chunk_rows=chunk_rows)):
+        values = indicator_values(chunk, indicators)
+        g1 = af_measures(values, list(thresholds.values()), k)['gaps'][1]
+
+        norm = (values - stats['mean']) / stats['std']
+        g1_sum = g1.sum(axis=1)
+        wdi = g1 @ weights
+        extended = pd.concat(
+            [chunk,
+             pd.DataFrame(norm, columns=[c + '_norm' for c in indicators],
+                          index=chunk.index),
+             pd.DataFrame(g1, columns=[c + '_g1' for c in indicators],
+                          index=chunk.index)], axis=1)
+        extended['g1_sum'] = g1_sum
+        extended['wdi'] = wdi
+        extended['wdi_scaled'] = (wdi - wdi_min) / (wdi_max - wdi_min)
+        extended['g1_sum_scaled'] = (g1_sum - stats['g1_sum_min']) / g1_sum_span
+
+        pq.write_table(pa.Table.from_pandas(extended, preserve_index=False),
+                       os.path.join(output_dir, f'part-{part:05d}.parquet'))
+    return stats
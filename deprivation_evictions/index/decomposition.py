@@ -0,0 +1,69 @@
+# Decomposition of the AF measures by indicator and population subgroup
+# The whole cube is built in one grouped aggregation so queries are lookups
+
+import numpy as np
+import pandas as pd
+
+# ACS population shares (in %) used to define subgroups of zipcodes
+SUBGROUP_COLUMNS = ['pop_white', 'pop_black', 'pop_native', 'pop_asian', 'pop_latino']
+MEASURES = {'M0': 0, 'M1': 1, 'M2': 2}
+ALL = 'all'
+
+
+def majority_group(data, columns=SUBGROUP_COLUMNS, cutoff=50):
+    '''
+    Labels each zipcode by its majority population group ('black' for a
+    majority-Black zipcode...), or 'no_majority' if no share reaches cutoff.
+
+    Returns: a pandas series of labels aligned with data
+    '''
+    shares = data[columns]
+    labels = shares.idxmax(axis=1).str.replace('pop_', '', regex=False)
+    return labels.where(shares.max(axis=1) >= cutoff, 'no_majority')
+
+
+def decomposition_cube(gaps, subgroups, indicators):
+    '''
+    Materializes the contributions of every indicator x subgroup x measure.
+
+    Inputs:
+        gaps       : {alpha: (n, d) gap matrix} for alpha = 0, 1, 2
+        subgroups  : (n,) subgroup label of each unit
+        indicators : names of the d dimensions
+
+    Returns: dataframe indexed by (measure, subgroup, indicator), including
+             'all' margins for subgroups and indicators, with columns
+        gap_sum      : sum of the gap matrix over the cell
+        ratio        : gap_sum over (deprived units of the subgroup x d), so
+                       that summing over indicators gives the subgroup's M
+        contribution : gap_sum over (deprived units of the city x d), so that
+                       summing over subgroups and indicators gives the city M
+        share        : contribution as a fraction of the city M
+    '''
+    d = len(indicators)
+    frames = {}
+    for measure, alpha in MEASURES.items():
+        frames[(measure, 'deprived')] = (gaps[alpha] != 0).any(axis=1)
+        for j, ind in enumerate(indicators):
+            frames[(measure, ind)] = gaps[alpha][:, j]
+
+    # Single grouped aggregation over all measures and indicators
+    sums = pd.DataFrame(frames).groupby(np.asarray(subgroups)).sum()
+    sums.loc[ALL] = sums.sum()
+
+    cells = []
+    for measure in MEASURES:
+        block = sums[measure].copy()
+        deprived = block.pop('deprived')
+        block[ALL] = block.sum(axis=1)
+        long = block.stack().rename('gap_sum').to_frame()
+        long.index.names = ['subgroup', 'indicator']
+
+        subgroup_deprived = deprived.reindex(long.index.get_level_values('subgroup'))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            long['ratio'] = long['gap_sum'].to_numpy() / (subgroup_deprived.to_numpy() * d)
+            long['contribution'] = long['gap_sum'] / (deprived[ALL] * d)
+            long['share'] = long['gap_sum'] / block.loc[ALL, ALL]
+        cells.append(pd.concat({measure: long}, names=['measure']))
+
+    return pd.concat(cells)
@@ -0,0 +1,166 @@
+# Incremental updates of the extended data when a few units' inputs change
+# Running sums and sorted values let the global statistics be patched
+# without re-deriving every matrix
+
+from bisect import bisect_left, insort
+
+import numpy as np
+import pandas as pd
+
+from .af_engine import af_measures
+
+# Clean data columns that are also reported per capita (see clean_db)
+POPULATION_SCALED = ('eviction_filings_completed', 'crime', 'violent_crime',
+                     'non_offensive_crime')
+
+
+class SortedValues:
+    '''
+    Sorted multiset of floats giving the min/max after any replacement.
+    '''
+    def __init__(self, values):
+        self.values = sorted(values)
+
+    def replace(self, old, new):
+        del self.values[bisect_left(self.values, old)]
+        insort(self.values, new)
+
+    @property
+    def min(self):
+        return self.values[0]
+
+    @property
+    def max(self):
+        return self.values[-1]
+
+
+class RunningSums:
+    '''
+    Per-column counts, sums and sums of squares (missing values skipped),
+    from which means and sample standard deviations are read.
+    '''
+    def __init__(self, values):
+        self.count = np.zeros(values.shape[1])
+        self.total = np.zeros(values.shape[1])
+        self.squares = np.zeros(values.shape[1])
+        self.add(values)
+
+    def add(self, values, sign=1):
+        present = ~np.isnan(values)
+        values = np.where(present, values, 0.0)
+        self.count += sign * present.sum(axis=0)
+        self.total += sign * values.sum(axis=0)
+        self.squares += sign * (values ** 2).sum(axis=0)
+
+    @property
+    def mean(self):
+        return self.total / self.count
+
+    @property
+    def std(self):
+        return np.sqrt((self.squares - self.total ** 2 / self.count) / (self.count - 1))
+
+
+class IncrementalIndex:
+    '''
+    Keeps the extended data of MultiDimensionalDeprivation together with the
+    running structures needed to patch it: indicator sums for the z-scores,
+    gap sums and deprived unit counts for M0, M1, M2, and sorted g1_sum and
+    wdi values for the min-max scaled columns. Factor weights, thresholds
+    and k are held fixed; the bootstrap interval columns are not updated.
+    Rows are identified by the unit key, and by (key, year) in a panel.
+    '''
+    def __init__(self, extended, thresholds, k, weights, key='zipcode'):
+        self.data = extended.copy()
+        self.thresholds = thresholds
+        self.indicators = list(thresholds.keys())
+        self.k = k
+        self.weights = np.asarray(weights, dtype=float)
+        self.key = key
+        self.keys = [key, 'year'] if 'year' in self.data else [key]
+        self._rows = pd.Series(np.arange(len(self.data)),
+                               index=pd.MultiIndex.from_frame(self.data[self.keys]))
+
+        values = self.data[self.indicators].to_numpy(dtype=float)
+        self.raw = RunningSums(values)
+        af = self._measures(values)
+        self.gap_sums = np.array([af['gaps'][a].sum() for a in range(3)])
+        self.deprived = np.array([(af['gaps'][a] != 0).any(axis=1).sum()
+                                  for a in range(3)])
+        self.g1_sum = SortedValues(self.data['g1_sum'])
+        self.wdi = SortedValues(self.data['wdi'])
+
+    def _measures(self, values):
+        return af_measures(values, list(self.thresholds.values()), self.k)
+
+    @property
+    def ratios(self):
+        '''
+        Current M0, M1 and M2 (as deprivation_share, adj_deprivation_gap
+        and adj_squared_gap)
+        '''
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratios = self.gap_sums / (self.deprived * len(self.indicators))
+        return dict(zip(['M0', 'M1', 'M2'], ratios))
+
+    def update(self, changed):
+        '''
+        Applies corrected inputs for a few units.
+
+        Input: dataframe with the unit key ('zipcode' or 'zip_code'), the
+               year in a panel, and the corrected columns of the clean data
+               (e.g. RentPrice, violent_crime, time_to_CBD)
+        Returns: the patched extended data
+        '''
+        changed = changed.rename(columns={'zip_code': self.key})
+        missing = [c for c in self.keys if c not in changed]
+        if missing:
+            raise ValueError(f"changed rows need the columns {missing}")
+        keys = pd.MultiIndex.from_frame(changed[self.keys].astype(self.data[self.keys].dtypes))
+        rows = self._rows.loc[keys].to_numpy()
+        columns = [c for c in changed.columns if c not in self.keys]
+
+        old_values = self.data[self.indicators].to_numpy(dtype=float)[rows]
+        old_af = self._measures(old_values)
+
+        # Overwrite inputs and the columns derived from them
+        block = self.data.iloc[rows].copy()
+        for col in columns:
+            block[col] = changed[col].to_numpy()
+        if {'RentPrice', 'hh_median_income'} & set(columns):
+            block['RTI_ratio'] = block['RentPrice'] / (block['hh_median_income'] / 12)
+        for col in POPULATION_SCALED:
+            if (col in columns or 'total_population' in columns) \
+                    and col + '_scaled' in block:
+                block[col + '_scaled'] = block[col].div(block['total_population'])
+
+        new_values = block[self.indicators].to_numpy(dtype=float)
+        new_af = self._measures(new_values)
+        g1 = new_af['gaps'][1]
+        g1_sum = g1.sum(axis=1)
+        wdi = g1 @ self.weights
+        block[[c + '_g1' for c in self.indicators]] = g1
+        block['g1_sum'] = g1_sum
+        block['wdi'] = wdi
+
+        # Patch the running structures
+        self.raw.add(old_values, sign=-1)
+        self.raw.add(new_values)
+        for a in range(3):
+            self.gap_sums[a] += new_af['gaps'][a].sum() - old_af['gaps'][a].sum()
+            self.deprived[a] += ((new_af['gaps'][a] != 0).any(axis=1).sum()
+                                 - (old_af['gaps'][a] != 0).any(axis=1).sum())
+        for old, new in zip(self.data['g1_sum'].to_numpy()[rows], g1_sum):
+            self.g1_sum.replace(old, new)
+        for old, new in zip(self.data['wdi'].to_numpy()[rows], wdi):
+            self.wdi.replace(old, new)
+
+        self.data.iloc[rows, [self.data.columns.get_loc(c) for c in block.columns]] = block
+
+        # Columns that depend on global statistics are re-derived from them
+        values = self.data[self.indicators].to_numpy(dtype=float)
+        self.data[[c + '_norm' for c in self.indicators]] = \
+            (values - self.raw.mean) / self.raw.std
+        for col, stats in [('g1_sum', self.g1_sum), ('wdi', self.wdi)]:
+            self.data[col + '_scaled'] = (self.data[col] - stats.min) / (stats.max - stats.min)
+        return self.data
@@ -2,9 +2,15 @@
 # Created by Gregory Ho
 
 import pandas as pd
-import matplotlib.pyplot as plt
-from sklearn.decomposition import PCA
-from factor_analyzer import FactorAnalyzer
+
+# matplotlib, sklearn, factor_analyzer (weights) and pyarrow (chunked) are
+# imported only by the methods that need them, so that the g1-based index
+# can be computed without loading them
+from .af_engine import af_measures, headline_ratio
+from .sweep import threshold_grid, sweep_configs
+from . import resample
+from .decomposition import majority_group, decomposition_cube, ALL
+from .incremental import IncrementalIndex
 
 ### To run, the following parameters are instantiated ###
 
@@ -22,7 +28,10 @@ thresholds = {
 #    k=0 because we have low count of sub-indicators
 k = 0
 
-# 3) path to clean data
+# 3) path to clean data (defaults, the CLI can override them).
+#    If the clean data is a panel (a 'year' column, see clean_db(years=...)),
+#    every (zipcode, year) row is processed in the same pass. Normalization
+#    and min-max scaling are pooled across years so trends are comparable.
 cleaned_data = "deprivation_evictions/data_bases/clean_data/clean_database.csv"
 transport_data = "deprivation_evictions/data_bases/raw_data/google_distancematrix.csv"
 output_path = "deprivation_evictions/data_bases/final_data/processed_data.csv"
@@ -30,17 +39,98 @@ output_path = "deprivation_evictions/data_bases/final_data/processed_data.csv"
 # 4) PCA parameters (This segment is for further analysis, unutilized in our viz)
 n_comp = 5
 rotate_fn = "varimax"
+pca_solver = "full" # 'randomized' or 'incremental' for large geographies
+weights_cache = "deprivation_evictions/data_bases/final_data/weights_cache"
+
+# 5) Replicates for the bootstrap/Monte Carlo confidence intervals appended
+#    to the output (0 to skip) and their coverage
+n_replicates = 2000
+ci_level = 0.9
+
+# 6) Stage graph of the index pipeline. Each stage lists the parameters and
+#    the upstream stages it depends on; a cached result is reused until one
+#    of them changes.
+STAGES = {
+    'travel_points': ((), ()),
+    'merged_data': ((), ('travel_points',)),
+    'mat_y_norm': (('indicators',), ('merged_data',)),
+    'af': (('k', 'thresholds'), ('merged_data',)),
+    'mat_y': ((), ('af',)),
+    'mat_g1': ((), ('af',)),
+    'cube': ((), ('af',)),
+    'weights': (('n_comp', 'rotate_fn', 'pca_solver'), ('mat_g1',)),
+}
 
 
 class MultiDimensionalDeprivation:
-    def __init__(self, k, cleaned_data, thresholds):
+    def __init__(self, k, cleaned_data, thresholds, travel_data=transport_data):
         '''
         constructor
         '''
         self.k = k
-        self.data = pd.read_csv(cleaned_data)
+        self.travel_data = travel_data
+        # cleaned_data may be None when only the chunked mode is used
+        self.data = pd.read_csv(cleaned_data) if cleaned_data is not None else None
         self.thresholds = thresholds
-        self.indicators = list(thresholds.keys())
+        self._cache = {}
+
+    @property
+    def indicators(self):
+        return list(self.thresholds.keys())
+
+    def _param(self, name):
+        '''
+        Returns a hashable snapshot of a parameter used by the stage graph.
+        Thresholds are read item by item so that in-place edits to the dict
+        are detected as well.
+        '''
+        if name == 'k':
+            return self.k
+        if name == 'thresholds':
+            return tuple(self.thresholds.items())
+        if name == 'indicators':
+            return tuple(self.indicators)
+        if name == 'n_comp':
+            return n_comp
+        if name == 'rotate_fn':
+            return rotate_fn
+        if name == 'pca_solver':
+            return pca_solver
+        raise KeyError(name)
+
+    def _stage_key(self, stage):
+        '''
+        Builds the cache key of a stage from its own parameters and the keys
+        of every upstream stage.
+        '''
+        params, upstream = STAGES[stage]
+        return (tuple(self._param(p) for p in params),
+                tuple(self._stage_key(u) for u in upstream))
+
+    def _cached(self, stage, compute):
+        '''
+        Returns the cached result of a stage, calling compute() only if the
+        stage was never run or one of its inputs changed since.
+        '''
+        key = self._stage_key(stage)
+        hit = self._cache.get(stage)
+        if hit is None or hit[0] != key:
+            hit = (key, compute())
+            self._cache[stage] = hit
+        return hit[1]
+
+    def invalidate(self, stage=None):
+        '''
+        Drops a cached stage and everything downstream of it (all stages if
+        stage is None). Needed only when self.data is edited in place.
+        '''
+        if stage is None:
+            self._cache.clear()
+            return
+        self._cache.pop(stage, None)
+        for name, (_, upstream) in STAGES.items():
+            if stage in upstream:
+                self.invalidate(name)
 
     def compute_ratios(self):
         '''
@@ -51,9 +141,13 @@ class MultiDimensionalDeprivation:
 
         Returns:
         extended_data   : processed data in the form of a pandas dataframe
+                          (cached, do not modify in place)
         '''
+        return self._cached('merged_data', self._compute_ratios)
+
+    def _compute_ratios(self):
         cleaned_data = self.data
-        travel_data = pd.read_csv(transport_data)
+        travel_data = self.travel_points()
         travel_data = travel_data.groupby('zipcode')[['time_to_CBD', 'distance_to_CBD']].mean()
 
         # Compute intermediate values
@@ -63,6 +157,15 @@ class MultiDimensionalDeprivation:
         merged_data = pd.merge(cleaned_data, travel_data, on='zipcode', how='inner')
         return merged_data
 
+    def travel_points(self):
+        '''
+        Loads the travel time and distance of every random origin point
+        (cached, do not modify in place). Points the API could not route
+        (missing values) are left out.
+        '''
+        return self._cached('travel_points', lambda: pd.read_csv(self.travel_data).dropna(
+            subset=['time_to_CBD', 'distance_to_CBD']).reset_index(drop=True))
+
     def raw_normalized_viz(self):
         '''
         Normalizes dimensions (for vizualization: radial plot)
@@ -70,7 +173,10 @@ class MultiDimensionalDeprivation:
         Input: merged_data
         Returns: matrix Y in normalized form
         '''
-        mat_y_norm = self.compute_ratios()
+        return self._cached('mat_y_norm', self._raw_normalized_viz)
+
+    def _raw_normalized_viz(self):
+        mat_y_norm = self.compute_ratios().copy()
 
         for col in mat_y_norm.columns:
             if col in self.indicators:
@@ -93,20 +199,10 @@ class MultiDimensionalDeprivation:
         
         Returns deprivation scores as a pandas dataframe
         '''
-        merged_data = self.compute_ratios()
-
-        #Generate binary matrix y
-        mat_y = pd.DataFrame(index=merged_data.index, columns=self.indicators)
-        merged_data['deprivation_share'] = 0
-        for ind in self.indicators:
-            mat_y[ind] = (merged_data[ind] >= self.thresholds[ind]).astype(int)
-            merged_data['deprivation_share'] += mat_y[ind]
+        return self._cached('mat_y', self._deprivation_matrix)
 
-        # for all zipcodes that has less than k deprivations assign all 
-        # elements to be 0 (following AF methodology)
-        mat_y[merged_data['deprivation_share'] <= self.k] = 0
-        
-        return mat_y
+    def _deprivation_matrix(self):
+        return self._as_frame(self.af_measures()['y'].astype(int))
 
 
     def normalized_gap(self):
@@ -118,27 +214,170 @@ class MultiDimensionalDeprivation:
         Input: Matrix Y from fn:deprivation_matrix()
         Returns: Matrix g^1(k) as a pandas dataframe
         '''
+        return self._cached('mat_g1', self._normalized_gap)
+
+    def _normalized_gap(self):
+        return self._as_frame(self.af_measures()['gaps'][1])
+
+    def af_measures(self):
+        '''
+        Runs the vectorized AF engine on the indicator matrix: censored
+        deprivation matrix Y, gap matrices g0, g1, g2 and the ratios M0, M1,
+        M2 are computed in one pass and cached together.
+
+        Returns: dictionary of numpy arrays (see af_engine.af_measures)
+        '''
+        return self._cached('af', self._af_measures)
+
+    def _af_measures(self):
+        values = self.compute_ratios()[self.indicators].to_numpy(dtype=float)
+        return af_measures(values, list(self.thresholds.values()), self.k)
+
+    def decomposition_cube(self):
+        '''
+        Contribution cube of the AF measures by indicator x subgroup x
+        measure (M0, M1, M2), with zipcodes grouped by their majority
+        population group in the ACS data. Cached, so decomposition queries
+        are lookups. In a panel, there is one cube per year.
+
+        Returns: dataframe indexed by (measure, subgroup, indicator), or
+                 (year, measure, subgroup, indicator) in a panel, see
+                 decomposition.decomposition_cube
+        '''
+        return self._cached('cube', self._decomposition_cube)
+
+    def _decomposition_cube(self):
         merged_data = self.compute_ratios()
-        mat_y = self.deprivation_matrix()
-        
-        # Compute the normalized gap - each element is expressed in their respective
-        # distance from the deprivation vector (threshold)
-        mat_g1 = pd.DataFrame(index=merged_data.index, columns=self.indicators)
-        for ind in self.indicators:
-            mat_g1[ind] = (merged_data[ind] - self.thresholds[ind]) / self.thresholds[ind]
-        
-        # Replace null and negative values with 0 
-        mat_g1 = mat_g1.fillna(0)
-        mat_g1[mat_g1 < 0] = 0
-        
-        # Apply mat_y to g1
-        for ind in self.indicators:
-            mat_g1[ind] *= mat_y[ind]
+        subgroups = majority_group(merged_data).to_numpy()
+        gaps = self.af_measures()['gaps']
+        if 'year' not in merged_data:
+            return decomposition_cube(gaps, subgroups, self.indicators)
+
+        years = merged_data['year'].to_numpy()
+        cubes = {}
+        for year in sorted(set(years)):
+            rows = years == year
+            cubes[year] = decomposition_cube({a: g[rows] for a, g in gaps.items()},
+                                             subgroups[rows], self.indicators)
+        return pd.concat(cubes, names=['year'])
+
+    def decompose(self, measure='M1', subgroup=ALL, indicator=ALL, year=None):
+        '''
+        Looks up one cell of the decomposition cube, e.g. how much of the
+        city's M1 comes from RTI_ratio in majority-Black zipcodes:
+        decompose('M1', 'black', 'RTI_ratio')['contribution']
+        In a panel, the year of the cell is required.
 
-        return mat_g1
+        Returns: pandas series with gap_sum, ratio, contribution and share
+        '''
+        cube = self.decomposition_cube()
+        if cube.index.nlevels == 4:
+            if year is None:
+                raise ValueError("The data is a panel: pass the year to decompose")
+            return cube.loc[(year, measure, subgroup, indicator)]
+        return cube.loc[(measure, subgroup, indicator)]
+
+    def _as_frame(self, matrix):
+        '''
+        Wraps a (zipcodes x indicators) array as a dataframe aligned with the
+        merged data.
+        '''
+        return pd.DataFrame(matrix, index=self.compute_ratios().index,
+                            columns=self.indicators)
 
 
-    def pca_weights(self, matrix, n_comp, rotate_fn):
+    def sweep(self, grid, ks=None, n_jobs=None):
+        '''
+        Sensitivity analysis: evaluates M0, M1, M2 and the zipcode ranking
+        (by g1 sum) for every combination of thresholds in grid and every k,
+        as batched tensor computations split across processes if the grid
+        is large.
+
+        Inputs:
+            grid   : dictionary {indicator: list of cutoffs} (indicators not
+                     listed keep their current threshold), or a dataframe
+                     of threshold vectors
+            ks     : fixed cutoffs to evaluate (default: every k from 0 to
+                     the number of indicators - 1)
+            n_jobs : worker processes (None: automatic, 1: serial)
+
+        Returns:
+            results : dataframe with one row per configuration (thresholds,
+                      k, M0, M1, M2)
+            ranks   : dataframe of zipcode ranks (1 = most deprived) with
+                      the same index as results and one column per zipcode
+        '''
+        if ks is None:
+            ks = range(len(self.indicators))
+        configs = threshold_grid(grid, self.thresholds)
+        configs = configs.merge(pd.DataFrame({'k': list(ks)}), how='cross')
+
+        merged_data = self.compute_ratios()
+        ratios, ranks = sweep_configs(merged_data[self.indicators], configs, n_jobs)
+
+        results = configs.assign(M0=ratios[:, 0], M1=ratios[:, 1], M2=ratios[:, 2])
+        ranks = pd.DataFrame(ranks, index=results.index,
+                             columns=merged_data['zipcode'])
+        return results, ranks
+
+    def confidence_intervals(self, n_rep=n_replicates, level=ci_level,
+                             seed=resample.SEED, n_jobs=None,
+                             income_cv=resample.INCOME_CV, weighted=True):
+        '''
+        Bootstrap/Monte Carlo intervals for the index and the zipcode ranks.
+        Each replicate draws crime counts from a Poisson distribution,
+        perturbs the median income (relative standard error income_cv) and
+        resamples the origin points behind the travel indicators. Factor
+        weights are held at their point estimate. In a panel, a zipcode's
+        points are resampled once for all its years, and ranks and M0, M1,
+        M2 are computed within each year.
+
+        Inputs:
+            n_rep  : number of replicates
+            level  : coverage of the percentile intervals
+            seed   : seed of the simulation (reproducible for any n_jobs)
+            n_jobs : worker processes (None: all cores, 1: serial)
+            weighted : if False, skip the wdi intervals (and the factor
+                       analysis)
+
+        Returns:
+            zip_intervals   : per-zipcode dataframe with the g1 rank and the
+                              low/high bounds of g1_sum, wdi and g1 rank
+            ratio_intervals : dataframe with the estimate and bounds of
+                              M0, M1, M2 (indexed by year and measure in a
+                              panel)
+        '''
+        merged_data = self.compute_ratios()
+        panel = 'year' in merged_data
+        inputs = {'indicators': self.indicators,
+                  'values': merged_data[self.indicators].to_numpy(dtype=float),
+                  'rent': merged_data['RentPrice'].to_numpy(dtype=float),
+                  'income': merged_data['hh_median_income'].to_numpy(dtype=float),
+                  'income_cv': income_cv,
+                  'travel': resample.travel_groups(self.travel_points(),
+                                                   merged_data['zipcode']),
+                  'years': merged_data['year'].to_numpy() if panel else None}
+        weights = self.g1_weights().sum(axis=0).to_numpy() if weighted else None
+
+        reps = resample.simulate(inputs, list(self.thresholds.values()), self.k,
+                                 weights, n_rep, seed, n_jobs)
+        years = sorted(merged_data['year'].unique()) if panel else None
+        zip_intervals, ratio_intervals = resample.interval_table(
+            reps, level, merged_data.index, years)
+
+        g1_sum = self.normalized_gap().sum(axis=1)
+        if panel:
+            g1_rank = g1_sum.groupby(merged_data['year']).rank(ascending=False, method='min')
+            estimate = self.ratios_by_year().stack().to_numpy()
+        else:
+            g1_rank = g1_sum.rank(ascending=False, method='min')
+            estimate = [self.deprivation_share(), self.adj_deprivation_gap(),
+                        self.adj_squared_gap()]
+        zip_intervals.insert(0, 'g1_rank', g1_rank)
+        ratio_intervals.insert(0, 'estimate', estimate)
+        return zip_intervals, ratio_intervals
+
+    def pca_weights(self, matrix, n_comp, rotate_fn, headless=False):
         '''
         Performs PCA to express deprivation weights as linear combinations of the
         eigenvectors of the variance-covariance matrix.
@@ -147,30 +386,26 @@ class MultiDimensionalDeprivation:
         n_comp equivalent to num of dimensions (default=5 (num dimensions), but 
         this parameter is should be set based on scree plot and Kaiser criterion)
         rotate_fn - function for factor rotations (generally: oblimin or varimax)
+        headless - if True, skip the scree plot and the communalities printout
+        (use estimate_weights() to get them as data)
         Returns: PCA or Factor weights
         '''
+        fitted = self.estimate_weights(matrix, n_comp, rotate_fn)
 
-        #PCA
-        pca = PCA()
-        pca.fit(matrix)
-
-        #Generate scree plot
-        plt.plot(range(1, len(pca.explained_variance_)+1),
-        pca.explained_variance_, 'ro-', linewidth=2)
-        plt.title('Scree Plot')
-        plt.xlabel('Principal Component')
-        plt.ylabel('Eigenvalues')
-        plt.show()
+        if not headless:
+            import matplotlib.pyplot as plt
 
-        # Factor analysis - Express factors as rotations
-        fa = FactorAnalyzer(n_factors=n_comp, rotation= rotate_fn)
-        fa.fit(matrix)
-        print(pd.DataFrame(fa.get_communalities(), 
-                           index=matrix.columns, 
-                           columns=['Communalities']))
+            #Generate scree plot
+            scree = fitted['scree']
+            plt.plot(scree.index, scree.values, 'ro-', linewidth=2)
+            plt.title('Scree Plot')
+            plt.xlabel('Principal Component')
+            plt.ylabel('Eigenvalues')
+            plt.show()
+            print(fitted['communalities'].to_frame())
 
         # Express weights as factor loadings
-        weights = fa.loadings_
+        weights = fitted['loadings'].to_numpy()
         weights = pd.DataFrame(weights, columns=self.indicators)
 
         # normalize each row to sum to 1 
@@ -179,6 +414,29 @@ class MultiDimensionalDeprivation:
         
         return weights
 
+    def estimate_weights(self, matrix, n_comp, rotate_fn):
+        '''
+        Headless weight estimation: fits (or loads from the on-disk cache)
+        the PCA and the rotated factor analysis of matrix.
+
+        Returns: dictionary with the factor 'loadings', the 'scree' data
+                 (PCA eigenvalues) and the 'communalities'
+        '''
+        from .weights import estimate_weights
+
+        return estimate_weights(matrix, n_comp, rotate_fn, pca_solver,
+                                cache_dir=weights_cache)
+
+    def g1_weights(self):
+        '''
+        Factor weights of matrix g1 using the module-level PCA parameters.
+        Cached, so the PCA and factor analysis only run once per g1.
+        '''
+        return self._cached('weights',
+                            lambda: self.pca_weights(self.normalized_gap(),
+                                                     n_comp, rotate_fn,
+                                                     headless=True))
+
     def weighted_deprivation_inx(self, matrix, weights):
         '''
         Computes weighted deprivation index for each zipcode
@@ -201,27 +459,77 @@ class MultiDimensionalDeprivation:
                                   'wdi_scaled': wdi_scaled}, index=self.data.index)
         return output_df
 
-    def extend_data(self):
+    def extend_data(self, path=output_path, weighted=True, n_rep=n_replicates):
         '''
         This function extends the processed dataset with the dimensions needed
         to produce our visualizations.
         '''
+        self.extended_data(weighted, n_rep).to_csv(path)
+        return None
+
+    def extended_data(self, weighted=True, n_rep=n_replicates):
+        '''
+        Builds the extended dataset written by extend_data()
+
+        Inputs:
+            weighted : if False, skip the PCA/factor weighted index (wdi)
+            n_rep    : replicates of the confidence intervals (0 to skip)
+
+        Returns: pandas dataframe
+        '''
         data_extended = (
             self.compute_ratios()
             .join(self.raw_normalized_viz().add_suffix('_norm'))
             .join(self.normalized_gap().add_suffix('_g1').assign(g1_sum=lambda x: x.sum(axis=1)))
-            .join(self.weighted_deprivation_inx(self.normalized_gap(), 
-                                                self.pca_weights(self.normalized_gap(),
-                                                                 n_comp, rotate_fn)))
         )
+        if weighted:
+            data_extended = data_extended.join(
+                self.weighted_deprivation_inx(self.normalized_gap(),
+                                              self.g1_weights()))
 
         # scale g1_sum using min-max scaling
         g1_sum_min = data_extended['g1_sum'].min()
         g1_sum_max = data_extended['g1_sum'].max()
         data_extended['g1_sum_scaled'] = (data_extended['g1_sum'] - g1_sum_min) / (g1_sum_max - g1_sum_min)
 
-        data_extended.to_csv(output_path)
-        return None
+        if n_rep > 0:
+            data_extended = data_extended.join(
+                self.confidence_intervals(n_rep, weighted=weighted)[0])
+
+        return data_extended
+
+    def incremental_index(self):
+        '''
+        Starts an incremental session on the extended data: corrected rows
+        passed to its update() method patch the deprivation rows, the
+        z-scores, M0/M1/M2 and the min-max scaled columns without a full
+        rebuild (factor weights are held fixed).
+
+        Returns: IncrementalIndex (its .data is the extended dataframe)
+        '''
+        weights = self.g1_weights().sum(axis=0)
+        # The interval columns are not updated, so they are not computed
+        return IncrementalIndex(self.extended_data(n_rep=0), self.thresholds,
+                                self.k, weights)
+
+    def extend_data_chunked(self, source, output_dir, chunk_rows=None):
+        '''
+        Out-of-core version of extend_data() for large geographies (tracts,
+        block groups). Reads partitioned Parquet input chunk by chunk: a
+        reduction pass keeps the global means/stds, the g1 correlations
+        (for the factor weights) and the min/max used for the scaled
+        columns, then the extended data is written one Parquet part per
+        chunk to output_dir. Memory is bounded by chunk_rows (default:
+        chunked.CHUNK_ROWS).
+
+        Returns: dictionary of the global statistics (means, stds, weights,
+                 min/max, M0, M1, M2)
+        '''
+        from . import chunked
+
+        return chunked.extend_chunks(source, output_dir, self.thresholds, self.k,
+                                     n_comp, rotate_fn,
+                                     chunk_rows=chunk_rows or chunked.CHUNK_ROWS)
     
 
     ## These additional functions were created as part of the AF methodology ##
@@ -237,8 +545,11 @@ class MultiDimensionalDeprivation:
         Input: Matrix g^1(k) from fn: normalized_gap()
         Returns: Matrix g^alpha(k) as a pandas dataframe
         '''
-        mat_g2 = self.normalized_gap() ** n
-        return mat_g2
+        af = self.af_measures()
+        if n in af['gaps']:
+            return self._as_frame(af['gaps'][n])
+        mat_g1 = af['gaps'][1]
+        return self._as_frame(mat_g1 ** n * af['y'])
 
     def deprivation_share(self):
         '''
@@ -249,13 +560,7 @@ class MultiDimensionalDeprivation:
         Input: Matrix Y from fn:deprivation_matrix()
         Returns: A ratio. 
         '''
-        mat_y = self.deprivation_matrix()
-        non_zero_rows = mat_y.any(axis=1)
-        num_non_zero_rows = non_zero_rows.sum()
-        denominator = num_non_zero_rows * mat_y.shape[1]
-        deprivation_share = mat_y.sum().sum() / denominator
-
-        return deprivation_share
+        return float(self.af_measures()['m'][0])
 
     def adj_deprivation_gap(self):
         '''
@@ -266,15 +571,36 @@ class MultiDimensionalDeprivation:
         Input: Matrix g1 from fn:normalized_gap()
         Returns: A ratio.
         '''
-        mat_g1 = self.normalized_gap()
-        non_zero_rows = mat_g1.any(axis=1)
-        num_non_zero_rows = non_zero_rows.sum()
-        denominator = num_non_zero_rows * mat_g1.shape[1]
-        deprivation_share = mat_g1.sum().sum() / denominator
+        return float(self.af_measures()['m'][1])
+
+    def ratios_by_year(self):
+        '''
+        Computes M0, M1 and M2 separately for each year of a panel
 
-        return deprivation_share
+        Returns: pandas dataframe indexed by year
+        '''
+        af = self.af_measures()
+        years = self.compute_ratios()['year'].to_numpy()
+        ratios = {}
+        for year in sorted(set(years)):
+            rows = years == year
+            ratios[year] = [float(headline_ratio(af['gaps'][a][rows])) for a in range(3)]
+        return pd.DataFrame.from_dict(ratios, orient='index', columns=['M0', 'M1', 'M2'])
+
+    def adj_squared_gap(self):
+        '''
+        Computes M2 (called Adjusted FGT measure in AF method)
+        Averages matrix g2, giving more weight to the most deprived
+        zipcodes (satisfies transfer)
+
+        Input: Matrix g2 from fn:power_gap(2)
+        Returns: A ratio.
+        '''
+        return float(self.af_measures()['m'][2])
     
     
-# Includes call to run from command line.
-mdpi = MultiDimensionalDeprivation(k, cleaned_data, thresholds)
-mdpi.extend_data()
\ No newline at end of file
+# Includes call to run from command line (see deprivation_evictions.cli for
+# the options).
+if __name__ == "__main__":
+    mdpi = MultiDimensionalDeprivation(k, cleaned_data, thresholds)
+    mdpi.extend_data()
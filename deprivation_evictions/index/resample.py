@@ -0,0 +1,180 @@
+# Bootstrap and Monte Carlo confidence intervals for the deprivation index
+# Replicates are simulated as arrays and run through the AF engine in batches
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .af_engine import af_measures, headline_ratio
+from .sweep import rank_scores
+
+SEED = 20230524
+# Indicators that are incident counts, perturbed with Poisson noise
+COUNT_COLUMNS = ('violent_crime', 'non_offensive_crime')
+# Indicators averaged over the random origin points of each zipcode,
+# bootstrapped by resampling those points
+TRAVEL_COLUMNS = ('time_to_CBD', 'distance_to_CBD')
+# Relative standard error assumed for the ACS median household income
+INCOME_CV = 0.05
+# Max number of cells (replicates x units x dimensions) in one batch
+BATCH_CELLS = 2_000_000
+
+
+def travel_groups(points, zipcodes):
+    '''
+    Arranges the origin points so that the points of each zipcode are
+    contiguous. In a panel a zipcode has one row per year but a single set
+    of points, so its points are grouped (and resampled) once and shared
+    by all its rows.
+
+    Inputs:
+        points   : dataframe of origin points with a 'zipcode' column and
+                   the travel columns
+        zipcodes : zipcode of each unit (row of the indicator matrix)
+
+    Returns: (P, t) array of point values, (g,) offsets of each zipcode's
+             first point, (g,) number of points per zipcode and (n,) group
+             of each unit
+    '''
+    units, unique = pd.factorize(np.asarray(zipcodes))
+    points = points.sort_values('zipcode', kind='stable')
+    bounds = points.groupby('zipcode').indices
+    starts = np.array([bounds[z][0] for z in unique])
+    sizes = np.array([len(bounds[z]) for z in unique])
+
+    offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    within = np.arange(sizes.sum()) - np.repeat(offsets, sizes)
+    order = np.repeat(starts, sizes) + within
+    values = points[list(TRAVEL_COLUMNS)].to_numpy(dtype=float)[order]
+    return values, offsets, sizes, units
+
+
+def simulate_batch(seed, n_rep, inputs, thresholds, k, weights):
+    '''
+    Draws a batch of perturbed inputs and recomputes the index on all of
+    them at once.
+
+    Inputs:
+        seed       : seed (or SeedSequence) of this batch
+        n_rep      : number of replicates in the batch
+        inputs     : dictionary built by MultiDimensionalDeprivation
+                     (point values, rent, income, travel points, and the
+                     year of each unit in a panel)
+        thresholds : (d,) deprivation cutoffs
+        k          : fixed cutoff
+        weights    : (d,) aggregated factor weights used for wdi (None to
+                     skip wdi)
+
+    Returns: dictionary of (n_rep, n) arrays 'g1_sum', 'wdi' (if weights
+             are given), 'rank' and a (n_rep, 3) array 'm' of M0, M1, M2.
+             In a panel, ranks are within each year and 'm' is a
+             (n_rep, years, 3) array of the ratios of every year.
+    '''
+    rng = np.random.default_rng(seed)
+    values = inputs['values']
+    columns = inputs['indicators']
+    n = values.shape[0]
+    x = np.repeat(values[None], n_rep, axis=0)
+
+    for j, col in enumerate(columns):
+        if col in COUNT_COLUMNS:
+            x[:, :, j] = rng.poisson(values[:, j], size=(n_rep, n))
+
+    if 'RTI_ratio' in columns:
+        noise = 1 + inputs['income_cv'] * rng.standard_normal((n_rep, n))
+        income = inputs['income'] * noise
+        x[:, :, columns.index('RTI_ratio')] = inputs['rent'] / (income / 12)
+
+    travel_cols = [c for c in TRAVEL_COLUMNS if c in columns]
+    if travel_cols:
+        points, offsets, sizes, units = inputs['travel']
+        point_offsets = np.repeat(offsets, sizes)
+        point_sizes = np.repeat(sizes, sizes)
+        draws = rng.random((n_rep, len(point_sizes)))
+        picks = point_offsets + (draws * point_sizes).astype(int)
+        means = np.add.reduceat(points[picks], offsets, axis=1) / sizes[:, None]
+        means = means[:, units]
+        for col in travel_cols:
+            x[:, :, columns.index(col)] = means[:, :, TRAVEL_COLUMNS.index(col)]
+
+    af = af_measures(x, thresholds, k)
+    g1 = af['gaps'][1]
+    g1_sum = g1.sum(axis=-1)
+    years = inputs.get('years')
+    if years is None:
+        rank = rank_scores(g1_sum)
+        m = np.stack([af['m'][0], af['m'][1], af['m'][2]], axis=1)
+    else:
+        rank = np.empty(g1_sum.shape, dtype=np.int32)
+        m = np.empty((n_rep, len(np.unique(years)), 3))
+        for i, year in enumerate(np.unique(years)):
+            rows = years == year
+            rank[:, rows] = rank_scores(g1_sum[:, rows])
+            for a in range(3):
+                m[:, i, a] = headline_ratio(af['gaps'][a][:, rows])
+    reps = {'g1_sum': g1_sum.astype(np.float32), 'rank': rank, 'm': m}
+    if weights is not None:
+        reps['wdi'] = (g1 @ weights).astype(np.float32)
+    return reps
+
+
+def simulate(inputs, thresholds, k, weights, n_rep, seed=SEED, n_jobs=None):
+    '''
+    Runs n_rep replicates split into batches. Every batch gets its own
+    child seed of seed, so results do not depend on n_jobs.
+
+    Returns: dictionary of stacked arrays (see simulate_batch)
+    '''
+    n, d = inputs['values'].shape
+    batch_size = max(1, BATCH_CELLS // (n * d))
+    sizes = [min(batch_size, n_rep - s) for s in range(0, n_rep, batch_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = (inputs, thresholds, k, weights)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+    n_jobs = min(n_jobs, len(sizes))
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = [pool.submit(simulate_batch, s, r, *args)
+                       for s, r in zip(seeds, sizes)]
+            batches = [f.result() for f in futures]
+    else:
+        batches = [simulate_batch(s, r, *args) for s, r in zip(seeds, sizes)]
+
+    return {key: np.concatenate([b[key] for b in batches])
+            for key in batches[0]}
+
+
+def interval_table(reps, level, index, years=None):
+    '''
+    Summarizes replicates as per-zipcode percentile intervals.
+
+    Inputs: years: sorted years of a panel (labels of the ratios), or None
+
+    Returns:
+        zip_intervals   : dataframe with low/high bounds of g1_sum, wdi and
+                          of the g1 rank (1 = most deprived)
+        ratio_intervals : dataframe with low/high bounds of M0, M1 and M2
+                          (indexed by year and measure in a panel)
+    '''
+    bounds = [(1 - level) / 2, (1 + level) / 2]
+    zip_intervals = {}
+    for key, name in [('g1_sum', 'g1_sum'), ('wdi', 'wdi'), ('rank', 'g1_rank')]:
+        if key not in reps:
+            continue
+        low, high = np.quantile(reps[key], bounds, axis=0)
+        zip_intervals[name + '_ci_low'] = low
+        zip_intervals[name + '_ci_high'] = high
+
+    low, high = np.nanquantile(reps['m'], bounds, axis=0)
+    ratio_index = ['M0', 'M1', 'M2']
+    if years is not None:
+        ratio_index = pd.MultiIndex.from_product([years, ratio_index],
+                                                 names=['year', 'measure'])
+    ratio_intervals = pd.DataFrame({'ci_low': low.ravel(), 'ci_high': high.ravel()},
+                                   index=ratio_index)
+    return pd.DataFrame(zip_intervals, index=index), ratio_intervals
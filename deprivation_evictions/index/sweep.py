@@ -0,0 +1,118 @@
+# Sensitivity analysis of the deprivation index to thresholds and k
+# Evaluates many configurations at once through the vectorized AF engine
+
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from .af_engine import af_measures
+
+# Max number of cells (configurations x units x dimensions) in one batch
+BATCH_CELLS = 2_000_000
+# Grids with fewer configurations than this are evaluated in-process
+MIN_PARALLEL_CONFIGS = 5_000
+
+
+def threshold_grid(grid, base_thresholds):
+    '''
+    Builds every combination of threshold values.
+
+    Inputs:
+        grid            : dictionary {indicator: list of cutoffs}, or a
+                          dataframe with one threshold vector per row
+        base_thresholds : dictionary of default cutoffs, used for the
+                          indicators not present in grid
+
+    Returns: a dataframe with one row per threshold vector and one column
+             per indicator (in the order of base_thresholds)
+    '''
+    indicators = list(base_thresholds.keys())
+    if isinstance(grid, pd.DataFrame):
+        grid = grid.reindex(columns=indicators)
+        return grid.fillna(pd.Series(base_thresholds)).reset_index(drop=True)
+
+    values = [grid.get(ind, [base_thresholds[ind]]) for ind in indicators]
+    return pd.DataFrame(list(itertools.product(*values)), columns=indicators)
+
+
+def rank_scores(scores):
+    '''
+    Ranks units within each row of scores, 1 being the highest score. Ties
+    share the lowest rank (as pandas' rank(method='min')).
+
+    Input: (b, n) array of scores
+    Returns: (b, n) array of integer ranks
+    '''
+    order = np.argsort(-scores, axis=1, kind='stable')
+    sorted_scores = np.take_along_axis(scores, order, axis=1)
+
+    position = np.arange(1, scores.shape[1] + 1)
+    new_value = np.ones(sorted_scores.shape, dtype=bool)
+    new_value[:, 1:] = sorted_scores[:, 1:] != sorted_scores[:, :-1]
+    sorted_ranks = np.maximum.accumulate(np.where(new_value, position, 0), axis=1)
+
+    ranks = np.empty(scores.shape, dtype=np.int32)
+    np.put_along_axis(ranks, order, sorted_ranks, axis=1)
+    return ranks
+
+
+def sweep_batch(values, thresholds, ks):
+    '''
+    Evaluates a batch of configurations in one tensor computation.
+
+    Inputs:
+        values     : (n, d) indicator matrix
+        thresholds : (b, d) threshold vectors
+        ks         : (b,) fixed cutoffs
+
+    Returns: (b, 3) array of M0, M1, M2 and (b, n) array of zipcode ranks
+             based on the sum of matrix g1
+    '''
+    af = af_measures(values, thresholds, ks)
+    ratios = np.stack([af['m'][0], af['m'][1], af['m'][2]], axis=1)
+    ranks = rank_scores(af['gaps'][1].sum(axis=-1))
+    return ratios, ranks
+
+
+def sweep_configs(values, configs, n_jobs=None, batch_size=None):
+    '''
+    Evaluates every configuration (threshold vector and k) of the sweep.
+
+    Inputs:
+        values     : (n, d) indicator matrix
+        configs    : dataframe with the d threshold columns followed by 'k'
+        n_jobs     : number of worker processes. None uses all cores when the
+                     grid is large enough, 1 forces a serial run
+        batch_size : configurations per tensor batch (by default sized to
+                     keep each batch under BATCH_CELLS cells)
+
+    Returns: (b, 3) array of M0, M1, M2 and (b, n) array of ranks
+    '''
+    values = np.asarray(values, dtype=float)
+    thresholds = configs.drop(columns='k').to_numpy(dtype=float)
+    ks = configs['k'].to_numpy(dtype=float)
+
+    if batch_size is None:
+        batch_size = max(1, BATCH_CELLS // values.size)
+    if len(configs) == 0:
+        return np.empty((0, 3)), np.empty((0, values.shape[0]), dtype=np.int32)
+
+    starts = range(0, len(configs), batch_size)
+    batches = [(thresholds[s:s + batch_size], ks[s:s + batch_size]) for s in starts]
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count() if len(configs) >= MIN_PARALLEL_CONFIGS else 1
+    n_jobs = min(n_jobs, len(batches))
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(sweep_batch, itertools.repeat(values),
+                                    *zip(*batches)))
+    else:
+        results = [sweep_batch(values, t, k) for t, k in batches]
+
+    ratios, ranks = zip(*results)
+    return np.concatenate(ratios), np.concatenate(ranks)
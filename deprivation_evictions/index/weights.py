@@ -0,0 +1,143 @@
+# Headless estimation of PCA / factor weights with an on-disk cache
+# Fitted results are keyed by a hash of the input matrix and the settings
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.decomposition import PCA, IncrementalPCA
+from factor_analyzer import FactorAnalyzer
+
+PCA_SOLVERS = ('full', 'randomized', 'incremental')
+# Rows per batch for the incremental PCA
+INCREMENTAL_BATCH = 10_000
+
+
+def weights_key(matrix, n_comp, rotate_fn, pca_solver):
+    '''
+    Hashes the input matrix (values and column names) together with the
+    estimation settings.
+
+    Returns: hexadecimal digest used as the cache file name
+    '''
+    digest = hashlib.sha256()
+    values = np.ascontiguousarray(matrix.to_numpy(dtype=float))
+    digest.update(str(values.shape).encode())
+    digest.update(values.tobytes())
+    settings = [list(map(str, matrix.columns)), n_comp, rotate_fn, pca_solver]
+    digest.update(json.dumps(settings).encode())
+    return digest.hexdigest()
+
+
+def correlation_matrix(cov):
+    '''
+    Correlation matrix of a covariance matrix. Dimensions without variation
+    (e.g. never deprived under some thresholds or year) are uncorrelated
+    with the others instead of giving NaNs.
+    '''
+    scale = np.sqrt(np.diag(cov))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        corr = cov / np.outer(scale, scale)
+    corr[~np.isfinite(corr)] = 0
+    np.fill_diagonal(corr, 1)
+    return corr
+
+
+def fit_factors(corr, n_comp, rotate_fn):
+    '''
+    Fits the rotated factor analysis on a correlation matrix. Only the
+    correlation matrix is needed, which keeps the cost independent of the
+    number of units once it is computed (possibly chunk by chunk).
+    Dimensions uncorrelated with all the others (e.g. without variation)
+    share no factor: they are left out of the fit (the rotation fails on
+    them) and get zero loadings.
+
+    Returns: (d, factors) array of loadings and (d,) array of communalities
+    '''
+    corr = np.asarray(corr, dtype=float)
+    d = corr.shape[0]
+    keep = (corr - np.eye(d) != 0).any(axis=1)
+    n_factors = min(n_comp, int(keep.sum()))
+    loadings = np.zeros((d, n_factors))
+    communalities = np.zeros(d)
+    if n_factors:
+        fa = FactorAnalyzer(n_factors=n_factors, rotation=rotate_fn, is_corr_matrix=True)
+        fa.fit(corr[np.ix_(keep, keep)])
+        loadings[keep] = fa.loadings_
+        communalities[keep] = fa.get_communalities()
+    return loadings, communalities
+
+
+def fit_weights(matrix, n_comp, rotate_fn, pca_solver='full'):
+    '''
+    Fits the PCA (for the scree data) and the rotated factor analysis.
+
+    Inputs:
+        matrix     : dataframe of units x dimensions (g0, g1, ..., gn)
+        n_comp     : number of factors
+        rotate_fn  : factor rotation (generally: oblimin or varimax)
+        pca_solver : 'full', 'randomized' (large number of dimensions) or
+                     'incremental' (large number of units)
+
+    Returns: dictionary with
+        'loadings'      : dataframe of factor loadings (dimensions x factors)
+        'scree'         : series of PCA eigenvalues by component
+        'communalities' : series of communalities by dimension
+    '''
+    if pca_solver not in PCA_SOLVERS:
+        raise ValueError(f"pca_solver must be one of {PCA_SOLVERS}")
+
+    values = matrix.to_numpy(dtype=float)
+    if pca_solver == 'incremental':
+        pca = IncrementalPCA(batch_size=max(INCREMENTAL_BATCH, values.shape[1]))
+    elif pca_solver == 'randomized':
+        pca = PCA(n_components=n_comp, svd_solver='randomized', random_state=0)
+    else:
+        pca = PCA()
+    pca.fit(values)
+
+    # Same correlation matrix as the chunked mode (see chunked.RunningMoments)
+    loadings, communalities = fit_factors(correlation_matrix(np.cov(values, rowvar=False)),
+                                          n_comp, rotate_fn)
+
+    factors = [f'factor_{i + 1}' for i in range(loadings.shape[1])]
+    components = range(1, len(pca.explained_variance_) + 1)
+    return {'loadings': pd.DataFrame(loadings, index=matrix.columns,
+                                     columns=factors),
+            'scree': pd.Series(pca.explained_variance_, index=components,
+                               name='eigenvalue'),
+            'communalities': pd.Series(communalities,
+                                       index=matrix.columns,
+                                       name='Communalities')}
+
+
+def estimate_weights(matrix, n_comp, rotate_fn, pca_solver='full', cache_dir=None):
+    '''
+    Returns the fitted weights of fit_weights(), reading them from
+    cache_dir when the same matrix and settings were already fitted.
+    No cache is used if cache_dir is None.
+    '''
+    if cache_dir is None:
+        return fit_weights(matrix, n_comp, rotate_fn, pca_solver)
+
+    path = os.path.join(cache_dir,
+                        weights_key(matrix, n_comp, rotate_fn, pca_solver) + '.json')
+    if os.path.exists(path):
+        with open(path, 'r') as fp:
+            cached = json.load(fp)
+        return {'loadings': pd.DataFrame(**cached['loadings']),
+                'scree': pd.Series(cached['scree'], name='eigenvalue',
+                                   index=range(1, len(cached['scree']) + 1)),
+                'communalities': pd.Series(**cached['communalities'],
+                                           name='Communalities')}
+
+    fitted = fit_weights(matrix, n_comp, rotate_fn, pca_solver)
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, 'w') as fp:
+        json.dump({'loadings': fitted['loadings'].to_dict(orient='split'),
+                   'scree': fitted['scree'].tolist(),
+                   'communalities': {'data': fitted['communalities'].tolist(),
+                                     'index': list(matrix.columns)}}, fp)
+    return fitted
@@ -0,0 +1,63 @@
+# Local stand-in servers for the API clients of raw_data
+# A test passes a handler (path, query) -> (status, body); the server runs in
+# a thread and records every request it receives.
+
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+
+class StandIn:
+    '''
+    HTTP server answering GET requests with a handler. Bodies that are not
+    bytes are sent as JSON.
+    '''
+    def __init__(self, handler):
+        self.requests = []
+        self.lock = threading.Lock()
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                with stand_in.lock:
+                    stand_in.requests.append((url.path, query))
+                status, body = handler(url.path, query)
+                if not isinstance(body, bytes):
+                    body = json.dumps(body).encode()
+                self.send_response(status)
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stand_in():
+    '''
+    Starts stand-in servers: stand_in(handler) returns a StandIn with its
+    base url. They are stopped at the end of the test.
+    '''
+    servers = []
+
+    def start(handler):
+        servers.append(StandIn(handler))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
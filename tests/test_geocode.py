@@ -0,0 +1,70 @@
+# Persistent geocode cache of mapping_coord_zip against a stand-in
+# Nominatim reverse geocoding server
+
+import pandas as pd
+import pytest
+
+from deprivation_evictions.data_bases.clean_data import cleaning_data, geocode
+
+POINTS = pd.DataFrame({"latitude": [41.881, 41.892, 41.881, 41.903],
+                       "longitude": [-87.623, -87.631, -87.623, -87.645]})
+ZIP_CODES = ["60601", "60602", "60601", "60603"]
+
+
+def nominatim(fails=()):
+    '''
+    Reverse geocoding answers with a zip code per latitude; latitudes in
+    fails get a 500 answer.
+    '''
+    postcodes = dict(zip(POINTS["latitude"], ZIP_CODES))
+
+    def handler(path, query):
+        assert path == "/reverse"
+        lat = float(query["lat"])
+        if lat in fails:
+            return 500, b""
+        return 200, {"lat": query["lat"], "lon": query["lon"], "display_name": "Chicago",
+                     "address": {"city": "Chicago", "postcode": postcodes[lat]}}
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def no_delay(monkeypatch):
+    make_reverse = geocode.make_reverse
+    monkeypatch.setattr(geocode, "make_reverse",
+                        lambda *args, **kwargs: make_reverse(*args, min_delay=0, **kwargs))
+
+
+def mapping(server, tmp_path):
+    return cleaning_data.mapping_coord_zip(POINTS, cache_path=str(tmp_path / "geocode.sqlite"),
+                                           domain=server.url.split("//")[1], scheme="http")
+
+
+def requested(server):
+    return sorted(float(query["lat"]) for _, query in server.requests)
+
+
+def test_duplicate_coordinates_are_requested_once(stand_in, tmp_path):
+    server = stand_in(nominatim())
+    zip_codes = mapping(server, tmp_path)
+
+    assert zip_codes.tolist() == ZIP_CODES
+    assert requested(server) == sorted(set(POINTS["latitude"]))
+
+
+def test_resumed_run_requests_only_missing_keys(stand_in, tmp_path):
+    failing = stand_in(nominatim(fails={41.903}))
+    with pytest.warns(UserWarning, match="1 geocode lookups failed"):
+        zip_codes = mapping(failing, tmp_path)
+    assert zip_codes.isna().tolist() == [False, False, False, True]
+
+    server = stand_in(nominatim())
+    zip_codes = mapping(server, tmp_path)
+    assert zip_codes.tolist() == ZIP_CODES
+    assert requested(server) == [41.903]
+
+
+def test_every_request_failing_is_raised(stand_in, tmp_path):
+    server = stand_in(nominatim(fails=set(POINTS["latitude"])))
+    with pytest.raises(RuntimeError, match="All 3 geocode lookups failed"):
+        mapping(server, tmp_path)
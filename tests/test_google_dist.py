@@ -0,0 +1,92 @@
+# Status handling of the Distance Matrix client against a stand-in server
+
+import os
+
+import numpy as np
+import pytest
+
+from deprivation_evictions.data_bases.raw_data import google_dist
+
+DESTINATION = "41.875556,-87.6244014"
+ORIGINS = [(41.9 + i / 1000, -87.7) for i in range(10)]
+BATCH = 4
+
+
+def distance_matrix(status=lambda origins, attempt: "OK"):
+    '''
+    Answers every origin with a route, unless status(origins, attempt)
+    gives another status (or an HTTP code) for the batch.
+    '''
+    attempts = {}
+
+    def handler(path, query):
+        origins = query["origins"].split("|")
+        attempts[origins[0]] = attempts.get(origins[0], 0) + 1
+        answer = status(origins, attempts[origins[0]])
+        if isinstance(answer, int):
+            return answer, b""
+        if answer != "OK":
+            return 200, {"status": answer, "rows": []}
+        rows = [{"elements": [{"status": "OK", "duration": {"value": 600},
+                               "distance": {"value": 5000}}]} for _ in origins]
+        return 200, {"status": "OK", "rows": rows}
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(google_dist.time, "sleep", lambda seconds: None)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = google_dist.TravelCache(str(tmp_path / "travel_cache.sqlite"))
+    yield cache
+    cache.close()
+
+
+def travel_times(server, cache):
+    return google_dist.travel_times(ORIGINS, DESTINATION, cache, "key", server.url,
+                                    batch_size=BATCH,
+                                    bucket=google_dist.TokenBucket(rate=1000, capacity=1000))
+
+
+def test_retry_status_is_retried(stand_in, cache):
+    server = stand_in(distance_matrix(
+        lambda origins, attempt: "OVER_QUERY_LIMIT" if attempt == 1 else "OK"))
+    time_, distance = travel_times(server, cache)
+
+    assert (time_ == 600).all() and (distance == 5000).all()
+    assert len(server.requests) == 2 * 3
+
+
+def test_request_denied_is_raised(stand_in, cache):
+    server = stand_in(distance_matrix(lambda origins, attempt: "REQUEST_DENIED"))
+    with pytest.raises(RuntimeError, match="REQUEST_DENIED"):
+        travel_times(server, cache)
+    # Not retried
+    assert len(server.requests) <= 3
+
+
+def test_failed_batches_are_reported_and_requested_again(stand_in, cache):
+    first = google_dist.location_key(ORIGINS[0])
+    failing = stand_in(distance_matrix(
+        lambda origins, attempt: 503 if origins[0] == first else "OK"))
+    with pytest.warns(UserWarning, match="1 of 3 Distance Matrix batches"):
+        time_, _ = travel_times(failing, cache)
+    assert np.isnan(time_[:BATCH]).all() and (time_[BATCH:] == 600).all()
+
+    server = stand_in(distance_matrix())
+    time_, _ = travel_times(server, cache)
+    assert (time_ == 600).all()
+    assert [query["origins"].split("|")[0] for _, query in server.requests] == [first]
+
+
+def test_nothing_is_written_when_every_batch_fails(stand_in, tmp_path):
+    server = stand_in(distance_matrix(lambda origins, attempt: 503))
+    output = tmp_path / "google_distancematrix.csv"
+    with pytest.raises(RuntimeError, match="batches failed"):
+        google_dist.update_travel_data(DESTINATION, 1, server.url,
+                                       str(tmp_path / "travel_cache.sqlite"),
+                                       str(output), api_key="key")
+    assert not os.path.exists(output)
@@ -0,0 +1,87 @@
+# Vintage geographies and the answer cache of pull_acs_data against a
+# stand-in Census API
+
+import pandas as pd
+import pytest
+
+from deprivation_evictions.data_bases.raw_data import pull_acs_data
+
+ZIP_CODES = ["60601", "60602", "60603"]
+ZCTA = "zip code tabulation area"
+
+
+def census(published=2021):
+    '''
+    Answers every variable of every requested ZCTA with the vintage as
+    value. Vintages after published are unknown (404).
+    '''
+    def handler(path, query):
+        vintage, table = path.strip("/").split("/", 1)
+        vintage = int(vintage)
+        assert table == pull_acs_data.SUBJECT_TABLE
+        if vintage > published:
+            return 404, b"unknown dataset"
+        # ZCTAs are only nested in states up to 2019
+        assert ("in" in query) == (vintage <= pull_acs_data.LAST_STATE_ZCTA_VINTAGE)
+        geography, zip_codes = query["for"].split(":")
+        assert geography == ZCTA
+        variables = query["get"].split(",")
+        keys = ["state", ZCTA] if vintage <= pull_acs_data.LAST_STATE_ZCTA_VINTAGE else [ZCTA]
+        rows = [variables + keys]
+        for zip_code in zip_codes.split(","):
+            rows.append([str(vintage)] * len(variables) + ["17", zip_code][-len(keys):])
+        return 200, rows
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(pull_acs_data.time, "sleep", lambda seconds: None)
+
+
+def pull(server, tmp_path, years):
+    output = tmp_path / "acs_data.parquet"
+    pull_acs_data.pull_acs_data(years, ZIP_CODES, base_url=server.url,
+                                output_path=str(output), cache_dir=str(tmp_path / "cache"))
+    return pd.read_parquet(output)
+
+
+def test_vintages_are_pulled_with_their_geography(stand_in, tmp_path):
+    server = stand_in(census())
+    acs = pull(server, tmp_path, [2019, 2021])
+
+    assert len(acs) == 2 * len(ZIP_CODES)
+    assert set(acs.columns) == set(pull_acs_data.ACS_VARIABLES.values()) | {"zip_code", "year"}
+    assert (acs["hh_median_income"] == acs["year"]).all()
+    assert sorted(acs.loc[acs["year"] == 2021, "zip_code"]) == ZIP_CODES
+    assert {path.split("/")[1] for path, _ in server.requests} == {"2019", "2021"}
+
+
+def test_cached_answers_are_not_requested_again(stand_in, tmp_path):
+    server = stand_in(census())
+    first = pull(server, tmp_path, [2019, 2021])
+    requested = len(server.requests)
+    assert requested > 0 and len(list((tmp_path / "cache").iterdir())) == requested
+
+    second = pull(server, tmp_path, [2019, 2021])
+    assert len(server.requests) == requested
+    pd.testing.assert_frame_equal(first, second)
+
+
+def test_unpublished_vintage_falls_back(stand_in, tmp_path):
+    server = stand_in(census(published=2021))
+    with pytest.warns(UserWarning, match="2023 ACS is not published"):
+        acs = pull(server, tmp_path, [2023])
+
+    assert (acs["year"] == 2023).all()
+    assert (acs["hh_median_income"] == 2021).all()
+
+
+def test_years_falling_back_to_one_vintage(stand_in, tmp_path):
+    server = stand_in(census(published=2021))
+    with pytest.warns(UserWarning):
+        acs = pull(server, tmp_path, [2022, 2023, 2024])
+
+    assert sorted(acs["year"].unique()) == [2022, 2023, 2024]
+    assert (acs["hh_median_income"] == 2021).all()
+    assert not list((tmp_path / "cache").glob("*.tmp"))
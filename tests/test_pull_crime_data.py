@@ -0,0 +1,97 @@
+# Paging and checkpoint resume of download_crime_data against a stand-in
+# SODA server
+
+import json
+import os
+import re
+
+import pandas as pd
+import pytest
+import requests
+
+from deprivation_evictions.data_bases.raw_data import pull_crime_data
+
+RECORDS = 23 # crimes in January 2019, none in the other months
+PAGE_SIZE = 5
+
+
+def record(i):
+    return {"id": str(i), "date": "2019-01-15T10:00:00.000", "primary_type": "THEFT",
+            "latitude": str(41.8 + i / 1000), "longitude": "-87.6"}
+
+
+def soda(fail_from=None):
+    '''
+    Pages of the January crimes ordered by id. Requests from offset fail_from
+    on get a 500 answer.
+    '''
+    def handler(path, query):
+        assert path == "/resource/{}.json".format(pull_crime_data.DATASET)
+        assert query["$order"] == ":id"
+        offset, limit = int(query["$offset"]), int(query["$limit"])
+        if fail_from is not None and offset >= fail_from:
+            return 500, b""
+        month = re.match(r"date >= '(\d+)-(\d+)", query["$where"]).groups()
+        if month != ("2019", "01"):
+            return 200, []
+        return 200, [record(i) for i in range(offset, min(offset + limit, RECORDS))]
+    return handler
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(pull_crime_data.time, "sleep", lambda seconds: None)
+
+
+def january(output_dir):
+    return os.path.join(output_dir, "2019-01")
+
+
+def test_pages_are_written_by_offset(stand_in, tmp_path):
+    server = stand_in(soda())
+    counts = pull_crime_data.download_crime_data(2019, str(tmp_path), server.url,
+                                                 app_token="", page_size=PAGE_SIZE)
+
+    assert counts[(2019, 1)] == RECORDS
+    assert sum(counts.values()) == RECORDS and len(counts) == 12
+    parts = sorted(name for name in os.listdir(january(tmp_path)) if name.startswith("part-"))
+    assert parts == ["part-{:09d}.parquet".format(o) for o in range(0, RECORDS, PAGE_SIZE)]
+
+    crimes = pd.read_parquet(january(tmp_path))
+    assert crimes["id"].tolist() == [str(i) for i in range(RECORDS)]
+    assert crimes["latitude"].dtype == float
+    with open(os.path.join(january(tmp_path), pull_crime_data.CHECKPOINT)) as fp:
+        assert json.load(fp) == {"offset": RECORDS, "done": True}
+
+
+def test_interrupted_month_resumes_from_checkpoint(stand_in, tmp_path):
+    failing = stand_in(soda(fail_from=2 * PAGE_SIZE))
+    with pytest.raises(requests.HTTPError):
+        pull_crime_data.download_crime_data(2019, str(tmp_path), failing.url,
+                                            app_token="", page_size=PAGE_SIZE)
+    with open(os.path.join(january(tmp_path), pull_crime_data.CHECKPOINT)) as fp:
+        assert json.load(fp) == {"offset": 2 * PAGE_SIZE, "done": False}
+
+    server = stand_in(soda())
+    counts = pull_crime_data.download_crime_data(2019, str(tmp_path), server.url,
+                                                 app_token="", page_size=PAGE_SIZE)
+
+    assert counts[(2019, 1)] == RECORDS
+    # Only the missing pages of January are requested again
+    january_offsets = [int(query["$offset"]) for _, query in server.requests
+                       if "2019-01-01" in query["$where"]]
+    assert min(january_offsets) == 2 * PAGE_SIZE
+    crimes = pd.read_parquet(january(tmp_path))
+    assert sorted(crimes["id"].astype(int)) == list(range(RECORDS))
+
+
+def test_complete_months_are_skipped(stand_in, tmp_path):
+    server = stand_in(soda())
+    pull_crime_data.download_crime_data(2019, str(tmp_path), server.url,
+                                        app_token="", page_size=PAGE_SIZE)
+    requested = len(server.requests)
+    counts = pull_crime_data.download_crime_data(2019, str(tmp_path), server.url,
+                                                 app_token="", page_size=PAGE_SIZE)
+
+    assert len(server.requests) == requested
+    assert counts[(2019, 1)] == RECORDS
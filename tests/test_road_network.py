@@ -0,0 +1,73 @@
+# Offline travel times on the bundled test graph, checked against a
+# shortest path search from every origin
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.sparse.csgraph import dijkstra
+
+from deprivation_evictions.data_bases.raw_data.road_network import (
+    MAX_SNAP, TEST_GRAPH, RoadNetwork, read_graphml)
+
+DESTINATION = 100
+ISOLATED = "isolated"
+
+
+@pytest.fixture(scope="module")
+def network():
+    '''
+    Test graph plus one node without edges (unreachable), placed between
+    two nodes of the grid.
+    '''
+    nodes, edges = read_graphml(TEST_GRAPH)
+    middle = nodes.iloc[[0, 1]][["latitude", "longitude"]].mean()
+    isolated = pd.DataFrame({"node": [ISOLATED], "latitude": [middle["latitude"]],
+                             "longitude": [middle["longitude"]]})
+    return RoadNetwork(pd.concat([nodes, isolated], ignore_index=True), edges)
+
+
+def brute_force(network, destination):
+    '''
+    Travel time and length of the fastest path from every node, with one
+    forward search per node.
+    '''
+    times, pred = dijkstra(network.time, directed=True, return_predecessors=True)
+    n = times.shape[0]
+    lengths = np.full(n, np.inf)
+    for origin in range(n):
+        if not np.isfinite(times[origin, destination]):
+            continue
+        length, node = 0.0, destination
+        while node != origin:
+            length += network.length[pred[origin, node], node]
+            node = pred[origin, node]
+        lengths[origin] = length
+    return times[:, destination], lengths
+
+
+def test_tree_matches_search_from_every_origin(network):
+    time, length = network.tree_to(DESTINATION)
+    expected_time, expected_length = brute_force(network, DESTINATION)
+
+    np.testing.assert_allclose(time, expected_time)
+    np.testing.assert_allclose(length, expected_length)
+    isolated = network.nodes.index[network.nodes["node"] == ISOLATED][0]
+    assert np.isinf(time[isolated])
+
+
+def test_travel_to_snaps_origins_and_leaves_missing_ones(network):
+    grid = network.nodes[network.nodes["node"] != ISOLATED]
+    destination = tuple(grid.loc[DESTINATION, ["latitude", "longitude"]])
+    expected_time, expected_length = brute_force(network, DESTINATION)
+
+    # Origins on grid nodes, the isolated node and one far from the graph
+    lat = np.append(network.nodes["latitude"], 43.5)
+    lon = np.append(network.nodes["longitude"], -87.7)
+    time, distance = network.travel_to(lat, lon, destination)
+
+    routed = (network.nodes["node"] != ISOLATED).to_numpy()
+    np.testing.assert_allclose(time[:-1][routed], expected_time[routed])
+    np.testing.assert_allclose(distance[:-1][routed], expected_length[routed])
+    assert np.isnan(time[:-1][~routed]).all() and np.isnan(distance[:-1][~routed]).all()
+    assert network.snap([43.5], [-87.7])[1][0] > MAX_SNAP
+    assert np.isnan(time[-1]) and np.isnan(distance[-1])
@@ -0,0 +1,57 @@
+# Coordinate to zipcode assignment on the bundled zip code boundaries,
+# checked against a point by point containment test
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import pytest
+
+from deprivation_evictions.data_bases.clean_data.cleaning_data import DATA_PATH
+from deprivation_evictions.data_bases.clean_data.zip_grid import ZipGrid, assign_zip_codes
+
+
+@pytest.fixture(scope="module")
+def zipcodes():
+    return gpd.read_file(DATA_PATH + "bound_zip_codes.geojson")
+
+
+@pytest.fixture(scope="module")
+def sample(zipcodes):
+    '''
+    Random points over the extent of the boundaries (some of them outside
+    every zip code), each one repeated as crimes on the same block are.
+    '''
+    rng = np.random.default_rng(0)
+    minx, miny, maxx, maxy = zipcodes.total_bounds
+    points = pd.DataFrame({"latitude": rng.uniform(miny, maxy, 500),
+                           "longitude": rng.uniform(minx, maxx, 500)})
+    return pd.concat([points, points.iloc[::3]], ignore_index=True)
+
+
+def point_by_point(sample, zipcodes):
+    '''
+    Zip code of the first polygon that contains each point, one point at a
+    time.
+    '''
+    points = gpd.points_from_xy(sample["longitude"], sample["latitude"])
+    zip_codes = []
+    for point in points:
+        found = zipcodes.loc[zipcodes.intersects(point), "zip"]
+        zip_codes.append(found.iloc[0] if len(found) else None)
+    return pd.Series(zip_codes, index=sample.index, dtype="string")
+
+
+def test_join_matches_point_by_point_test(sample, zipcodes):
+    zip_codes = assign_zip_codes(sample, zipcodes)
+    expected = point_by_point(sample, zipcodes)
+
+    pd.testing.assert_series_equal(zip_codes, expected)
+    assert zip_codes.notna().any() and zip_codes.isna().any()
+
+
+def test_grid_matches_join(sample, zipcodes):
+    grid = ZipGrid.build(zipcodes, cell_size=0.01)
+    labels = grid.lookup(sample["latitude"], sample["longitude"])
+    expected = assign_zip_codes(sample, zipcodes)
+
+    assert [None if pd.isna(z) else z for z in expected] == labels.tolist()